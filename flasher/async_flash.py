@@ -0,0 +1,240 @@
+'''
+asyncio interface to FlashUtil.
+
+Every device gets its own single worker thread, where all its blocking
+USB exchanges run.  Erase and program operations are issued without
+waiting for the flash, and the waits for the device to be done are
+awaitable sleeps between status polls, so one event loop can drive many
+boards and stay responsive.  Operations can be cancelled, or given a
+timeout, at any of these points; the board is always let out of reset.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import argparse
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from spiflash.serialflash import SerialFlashTimeout, Sst25FlashDevice
+from flash_util import FlashUtil, FlashVerifyError, VerifyRetriesDefault
+from flash_compare import CompareResult
+from flash_scheduler import InterleavedFlashScheduler
+from image_source import ImageSource
+
+log = logging.getLogger(__name__)
+
+AsyncReadChunkSize = 64*1024
+
+class AsyncFlashUtil:
+    '''
+        async wrapper of a FlashUtil; use as an async context manager, or
+        call close() when done.
+    '''
+    def __init__(self, deviceURI:str=None, flashUtil:FlashUtil=None):
+        self.flashUtil = flashUtil or FlashUtil()
+        if deviceURI is not None:
+            self.flashUtil.deviceURI = deviceURI
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix=f'flash-{self.flashUtil.deviceURI}')
+
+    async def _run(self, func, *args, **kwargs):
+        '''
+            run a blocking call on this device's thread
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def open(self):
+        flash = await self._run(lambda: self.flashUtil.flash)
+        if flash is None:
+            raise IOError(f'Could not access FTDI device {self.flashUtil.deviceURI}')
+        return self
+
+    async def close(self):
+        try:
+            await self._run(self.flashUtil.close)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, excType, excValue, tb):
+        await self.close()
+
+    @property
+    def _canIssue(self) -> bool:
+        '''
+            whether the flash can be driven a page/block at a time, without
+            blocking on it
+        '''
+        flash = self.flashUtil._flash
+        device = getattr(flash, 'uncached', flash)
+        return hasattr(flash, 'start_program_page') and not isinstance(device, Sst25FlashDevice) \
+                    and self.flashUtil._shadow is None
+
+    async def _waitReady(self, timing:Tuple[float, float]):
+        typical, maximum = timing
+        deadline = time.monotonic() + typical + maximum
+        flash = self.flashUtil._flash
+        await asyncio.sleep(typical)
+        while await self._run(flash.is_busy):
+            if time.monotonic() > deadline:
+                raise SerialFlashTimeout('Flash still busy after operation timeout')
+            await asyncio.sleep(typical / 4)
+
+    async def _holdInReset(self, setInReset:bool):
+        await self._run(self.flashUtil.caravelHoldInReset, setInReset)
+
+    async def erase(self, address:int, length:int):
+        '''
+            erase length bytes at address (on erase block boundaries)
+        '''
+        flash = self.flashUtil._flash
+        for blockAddr, command, timing in InterleavedFlashScheduler.erasePlan(flash, address, length):
+            await self._run(flash.start_erase_block, command, blockAddr)
+            await self._waitReady(timing)
+
+    async def upload(self, contents:bytes, startAddress:int=0, verify:bool=False,
+                     maxRetries:int=VerifyRetriesDefault, timeout:float=None):
+        '''
+            upload contents, as FlashUtil.upload
+            @param verify: (optional) read back each sector right after programming it
+            @param timeout: (optional) seconds after which to give up, raising asyncio.TimeoutError
+        '''
+        return await asyncio.wait_for(self._upload(contents, startAddress, verify, maxRetries),
+                                      timeout)
+
+    async def _upload(self, contents:bytes, startAddress:int, verify:bool, maxRetries:int):
+        await self.open()
+        if not self._canIssue:
+            # whole upload on the device thread, only cancellable up front
+            return await self._run(self.flashUtil.upload, contents, startAddress,
+                                   verify=verify, maxRetries=maxRetries)
+        flash = self.flashUtil._flash
+        sectorSize = flash.get_erase_size()
+        pageSize = flash.get_size('page')
+        pageTiming = flash.get_timings('page')
+        if len(contents) % sectorSize:
+            contents = bytes(contents) + bytes(sectorSize - len(contents) % sectorSize)
+        view = memoryview(contents)
+        blank = b'\xff' * pageSize
+        progress = self.flashUtil.progress
+        await self._holdInReset(True)
+        try:
+            with progress.phase('erase', len(contents)):
+                await self.erase(startAddress, len(contents))
+                progress.advance(len(contents))
+            with progress.phase('program', len(contents)):
+                for sector in range(0, len(contents), sectorSize):
+                    for offset in range(sector, sector + sectorSize, pageSize):
+                        page = view[offset:offset+pageSize]
+                        if page == blank:
+                            continue
+                        await self._run(flash.start_program_page, startAddress + offset, page)
+                        await self._waitReady(pageTiming)
+                    if verify:
+                        await self._verifySector(startAddress + sector, view[sector:sector+sectorSize],
+                                                 maxRetries)
+                    progress.advance(sectorSize)
+        finally:
+            await asyncio.shield(self._holdInReset(False))
+
+    async def _verifySector(self, address:int, expected:bytes, maxRetries:int):
+        flash = self.flashUtil._flash
+        if await self._run(flash.read, address, len(expected)) == expected:
+            return
+        await self._run(self.flashUtil._retrySector, address, bytes(expected), maxRetries)
+
+    async def read(self, size:int, startAddress:int=0, timeout:float=None) -> bytes:
+        '''
+            read size bytes of flash, a chunk at a time
+        '''
+        return await asyncio.wait_for(self._read(size, startAddress), timeout)
+
+    async def _read(self, size:int, startAddress:int) -> bytes:
+        await self.open()
+        flash = self.flashUtil._flash
+        contents = bytearray()
+        await self._holdInReset(True)
+        try:
+            for offset in range(0, size, AsyncReadChunkSize):
+                contents.extend(await self._run(flash.read, startAddress + offset,
+                                                min(AsyncReadChunkSize, size - offset)))
+        finally:
+            await asyncio.shield(self._holdInReset(False))
+        return bytes(contents)
+
+    async def verify(self, contents:bytes, startAddress:int=0, timeout:float=None) -> CompareResult:
+        '''
+            compare contents against flash
+        '''
+        return await asyncio.wait_for(self._verify(contents, startAddress), timeout)
+
+    async def _verify(self, contents:bytes, startAddress:int) -> CompareResult:
+        await self.open()
+        flash = self.flashUtil._flash
+        result = CompareResult()
+        view = memoryview(contents)
+        await self._holdInReset(True)
+        try:
+            for offset in range(0, len(contents), AsyncReadChunkSize):
+                expected = view[offset:offset+AsyncReadChunkSize]
+                actual = await self._run(flash.read, startAddress + offset, len(expected))
+                result.bytesCompared += len(expected)
+                if actual != expected:
+                    result.addDiffs(startAddress + offset, bytes(expected), actual)
+        finally:
+            await asyncio.shield(self._holdInReset(False))
+        return result
+
+
+async def uploadMany(uris:List[str], contents:bytes, verify:bool=False,
+                     timeout:float=None) -> List[Optional[BaseException]]:
+    '''
+        upload contents to every board at once
+        @return: None for each board that succeeded, else the exception raised
+    '''
+    async def job(uri:str):
+        async with AsyncFlashUtil(uri) as device:
+            await device.upload(contents, verify=verify, timeout=timeout)
+            if not verify:
+                result = await device.verify(contents, timeout=timeout)
+                if not result.ok:
+                    raise FlashVerifyError(result.report()[0])
+
+    return await asyncio.gather(*(job(uri) for uri in uris), return_exceptions=True)
+
+
+def getArgParser():
+    parser = argparse.ArgumentParser(description='Flash several boards from one event loop')
+    parser.add_argument("--uri", type=str, action='append', required=True,
+                    help="FTDI device URI, repeat for each board")
+    parser.add_argument("--write", type=str, required=True,
+                    help="image file to write to every board")
+    parser.add_argument("--inline-verify", action='store_true',
+                        required=False,
+                    help="read back each sector right after writing it, rather than verifying at the end")
+    parser.add_argument("--timeout", type=float,
+                        required=False,
+                    help="seconds after which to give up on a board")
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.WARN)
+    args = getArgParser().parse_args()
+    contents = ImageSource(args.write).read()
+    startTime = time.time()
+    results = asyncio.run(uploadMany(args.uri, contents, verify=args.inline_verify,
+                                     timeout=args.timeout))
+    for uri, error in zip(args.uri, results):
+        print(f'{uri}: {"OK" if error is None else f"FAILED: {type(error).__name__}: {error}"}')
+    print(f'{len(args.uri)} boards in {time.time() - startTime:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
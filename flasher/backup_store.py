@@ -0,0 +1,156 @@
+'''
+Deduplicated board backups.
+
+Flash dumps are split into sectors and every sector is stored once,
+named by its SHA-256, in a content-addressed store shared by all boards.
+Each backup is then just a per-board manifest listing the hash of each
+sector (null for erased ones), so storage grows with unique content
+rather than with the number of boards.  Layout:
+
+    STORE/objects/ab/abcdef...      sector data
+    STORE/boards/BOARDID/LABEL.json backup manifests
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import hashlib
+import json
+import os
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from board_id import boardFileName
+
+BackupObjectsDir = 'objects'
+BackupBoardsDir = 'boards'
+
+class BackupManifest:
+    def __init__(self, boardId:str, label:str, startAddress:int, size:int,
+                 sectorSize:int, sectors:List[Optional[str]], created:float=None):
+        self.boardId = boardId
+        self.label = label
+        self.startAddress = startAddress
+        self.size = size
+        self.sectorSize = sectorSize
+        # hash of each sector, None where erased
+        self.sectors = sectors
+        self.created = created if created is not None else time.time()
+
+    @classmethod
+    def load(cls, path:str):
+        with open(path, 'r') as f:
+            spec = json.load(f)
+        return cls(spec['board'], spec['label'], spec['start'], spec['size'],
+                   spec['sectorSize'], spec['sectors'], spec.get('created'))
+
+    def save(self, path:str):
+        tmpPath = f'{path}.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump({'board': self.boardId, 'label': self.label,
+                       'start': self.startAddress, 'size': self.size,
+                       'sectorSize': self.sectorSize, 'created': self.created,
+                       'sectors': self.sectors}, f)
+        os.replace(tmpPath, path)
+
+    @property
+    def uniqueSectors(self) -> int:
+        return len(set(h for h in self.sectors if h is not None))
+
+    def sectorLength(self, index:int) -> int:
+        return min(self.sectorSize, self.size - index * self.sectorSize)
+
+    def __str__(self):
+        blank = self.sectors.count(None)
+        return f'{self.boardId}/{self.label}: {self.size} bytes @ 0x{self.startAddress:06x}, ' \
+               f'{len(self.sectors)} sectors ({blank} blank, {self.uniqueSectors} unique)'
+
+
+class BackupStore:
+    def __init__(self, directory:str):
+        self.directory = directory
+        self.sectorsAdded = 0
+        self.sectorsDeduped = 0
+        os.makedirs(os.path.join(directory, BackupObjectsDir), exist_ok=True)
+        os.makedirs(os.path.join(directory, BackupBoardsDir), exist_ok=True)
+
+    @classmethod
+    def forManifest(cls, manifestPath:str):
+        '''
+            the store a manifest, at STORE/boards/BOARDID/LABEL.json, belongs to
+        '''
+        path = os.path.dirname(os.path.abspath(manifestPath))
+        while os.path.basename(path) != BackupBoardsDir:
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise ValueError(f'{manifestPath} is not in a backup store')
+            path = parent
+        return cls(os.path.dirname(path))
+
+    def _objectPath(self, digest:str) -> str:
+        return os.path.join(self.directory, BackupObjectsDir, digest[:2], digest)
+
+    def manifestPath(self, boardId:str, label:str) -> str:
+        return os.path.join(self.directory, BackupBoardsDir, boardFileName(boardId),
+                            f'{label}.json')
+
+    def putSector(self, data:bytes) -> Optional[str]:
+        '''
+            store a sector, unless already present
+            @return: its hash, or None if it is erased (nothing stored)
+        '''
+        if data.count(0xff) == len(data):
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._objectPath(digest)
+        if os.path.exists(path):
+            self.sectorsDeduped += 1
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = f'{path}.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(data)
+        os.replace(tmpPath, path)
+        self.sectorsAdded += 1
+        return digest
+
+    def getSector(self, digest:Optional[str], size:int) -> bytes:
+        if digest is None:
+            return b'\xff' * size
+        with open(self._objectPath(digest), 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f'Backup store object {digest} is corrupt')
+        return data
+
+    def saveManifest(self, manifest:BackupManifest) -> str:
+        path = self.manifestPath(manifest.boardId, manifest.label)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        manifest.save(path)
+        return path
+
+    def backups(self, boardId:str=None) -> List[str]:
+        '''
+            paths of all manifests in the store, or just those for boardId
+        '''
+        boardsDir = os.path.join(self.directory, BackupBoardsDir)
+        boards = [boardFileName(boardId)] if boardId else sorted(os.listdir(boardsDir))
+        paths = []
+        for board in boards:
+            boardDir = os.path.join(boardsDir, board)
+            if not os.path.isdir(boardDir):
+                continue
+            paths.extend(os.path.join(boardDir, name) for name in sorted(os.listdir(boardDir))
+                            if name.endswith('.json'))
+        return paths
+
+    def windows(self, manifest:BackupManifest, windowSize:int) -> Iterator[Tuple[int, bytes]]:
+        '''
+            rebuild the backed up image, windowSize (a multiple of the
+            sector size) bytes at a time
+            @return: iterator of (offset, data)
+        '''
+        perWindow = max(1, windowSize // manifest.sectorSize)
+        for first in range(0, len(manifest.sectors), perWindow):
+            indices = range(first, min(first + perWindow, len(manifest.sectors)))
+            data = b''.join(self.getSector(manifest.sectors[i], manifest.sectorLength(i))
+                                for i in indices)
+            yield (first * manifest.sectorSize, data)
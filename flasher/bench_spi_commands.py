@@ -0,0 +1,105 @@
+'''
+Micro-benchmark for SPI flash command encoding.
+
+Compares building each command as a fresh byte sequence, then copying it
+again to add the Caravel passthrough prefix (as was done before
+SpiCommandEncoder), with encoding into the per-device buffer.  No hardware
+is needed: commands go to a port that just discards them.
+
+Reported per command: CPU time, distinct buffers handed to the USB layer
+and peak transient memory.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import argparse
+import time
+import tracemalloc
+
+from spi_port import CaravelPassThroughSpiPort
+from spiflash.serialflash import SpiCommandEncoder
+
+BenchIterationsDefault = 100000
+
+class _NullRawPort:
+    '''
+        stands in for the pyftdi port, noting each buffer it is handed
+    '''
+    def __init__(self):
+        self.seen = set()
+        self.keep = []
+
+    def exchange(self, out, readlen=0, start=True, stop=True, duplex=False, droptail=0):
+        if id(out) not in self.seen:
+            self.seen.add(id(out))
+            # hold on to it, so ids are not recycled
+            self.keep.append(out)
+        return b''
+
+class _PassThrough(CaravelPassThroughSpiPort):
+    def __init__(self, raw):
+        # skip SpiPort set up, there is no controller
+        self.spi_port_raw = raw
+
+def _legacy(port, address, page):
+    # status poll, write enable, page program, as previously encoded
+    port.exchange(bytes((0x05,)), 1)
+    port.exchange(bytes((0x06,)))
+    wcmd = bytearray((0x02, (address >> 16) & 0xff, (address >> 8) & 0xff,
+                      address & 0xff))
+    wcmd.extend(page)
+    port.exchange(wcmd)
+    port.exchange(bytes((0x0B, (address >> 16) & 0xff, (address >> 8) & 0xff,
+                         address & 0xff, 0)), 256)
+
+def _encoded(encoder, address, page):
+    encoder.command(0x05, 1)
+    encoder.command(0x06)
+    encoder.command_address(0x02, address, data=page)
+    encoder.command_address(0x0B, address, 256, dummy=1)
+
+CommandsPerRound = 4
+
+def bench(name, func, target, iterations):
+    page = bytes(range(256))
+    raw = target[1]
+    # time
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(target[0], (i * 256) & 0xffffff, page)
+    elapsed = time.perf_counter() - start
+    raw.seen.clear()
+    raw.keep.clear()
+    # buffers, on a shorter run, since each is kept alive
+    rounds = min(iterations, 1000)
+    tracemalloc.start()
+    for i in range(rounds):
+        func(target[0], (i * 256) & 0xffffff, page)
+    buffers = len(raw.seen)
+    raw.keep.clear()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func(target[0], 0, page)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    numCommands = iterations * CommandsPerRound
+    print(f'{name:>8}: {elapsed*1e6/numCommands:6.2f} us/command, '
+          f'{buffers/(rounds*CommandsPerRound):4.2f} new buffers/command, '
+          f'{peak} bytes peak transient')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SPI flash command encoding')
+    parser.add_argument("--iterations", type=int, default=BenchIterationsDefault,
+                        required=False,
+                    help=f"rounds of status/wren/program/read commands [{BenchIterationsDefault}]")
+    args = parser.parse_args()
+
+    raw = _NullRawPort()
+    port = _PassThrough(raw)
+    bench('legacy', _legacy, (port, raw), args.iterations)
+    raw = _NullRawPort()
+    encoder = SpiCommandEncoder(_PassThrough(raw))
+    bench('encoder', _encoded, (encoder, raw), args.iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+'''
+Board identities as file names.
+
+Boards are identified by their flash (unique id or JEDEC id) and FTDI serial,
+which may include the channel as in TG110925/2.  Stores that keep per-board
+files all name them the same way, so one board maps to one name everywhere.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+
+def boardFileName(boardId:str) -> str:
+    '''
+        boardId made safe for use as a file or directory name
+    '''
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in boardId)
@@ -0,0 +1,63 @@
+'''
+Boot-to-ready probe.
+
+After flashing, confirms the new firmware actually starts, and measures
+how long it takes to.  The host arms the probe in the housekeeping
+mailbox register (see firmware_checksum) while the management core is
+held in reset, releases it, and polls the mailbox until the firmware
+reports it is ready, which the tt3p5-test firmware does once its IO is
+configured.  Resolution is one housekeeping SPI exchange, about a
+millisecond depending on the FTDI latency timer.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import logging
+import time
+from typing import Callable
+
+from firmware_checksum import FirmwareChecksum, MailboxReadyArmed, MailboxReady
+
+log = logging.getLogger(__name__)
+
+BootProbeTimeoutDefault = 5.0
+
+class BootProbeTimeout(RuntimeError):
+    pass
+
+
+class BootProbe:
+    def __init__(self, rawPort, holdInReset:Callable[[bool], None],
+                 timeout:float=BootProbeTimeoutDefault):
+        '''
+            @param rawPort: the housekeeping SPI port (not the pass-through)
+            @param holdInReset: callable to hold (True) or release the management core
+            @param timeout: (optional) seconds to wait for the firmware
+        '''
+        self.mailbox = FirmwareChecksum(rawPort, holdInReset)
+        self.holdInReset = holdInReset
+        self.timeout = timeout
+        self.polls = 0
+
+    def measure(self) -> float:
+        '''
+            reset the management core and time it to ready.  Leaves it running.
+            @return: seconds from reset release to the firmware reporting ready
+        '''
+        self.holdInReset(True)
+        original = self.mailbox.readMailbox()
+        self.mailbox.writeMailbox(MailboxReadyArmed)
+        self.polls = 0
+        try:
+            released = time.perf_counter()
+            self.holdInReset(False)
+            while True:
+                mailbox = self.mailbox.readMailbox()
+                elapsed = time.perf_counter() - released
+                self.polls += 1
+                if mailbox == MailboxReady:
+                    return elapsed
+                if elapsed > self.timeout:
+                    raise BootProbeTimeout(f'Firmware not ready {self.timeout}s after reset '
+                                           '(no ready probe built in, or it did not boot)')
+        finally:
+            self.mailbox.writeMailbox(original)
@@ -7,6 +7,7 @@ from pyftdi.spi import SpiController
 from array import array as Array
 import binascii
 from io import StringIO
+from flash_events import ProgressReporter, TTYProgressSink
 
 
 SR_WIP = 0b00000001  # Busy/Work-in-progress bit
@@ -207,6 +208,8 @@ addr = 0
 nbytes = 0
 total_bytes = 0
 
+progress = ProgressReporter(TTYProgressSink(sys.stdout))
+progress.startPhase('program')
 with open(file_path, mode='r') as f:
     x = f.readline()
     while x != '':
@@ -238,7 +241,7 @@ with open(file_path, mode='r') as f:
             while (is_busy(slave)):
                 time.sleep(0.1)
 
-            print("addr {}: flash page write successful".format(hex(addr)))
+            progress.advance(len(buf))
 
             if nbytes > 256:
                 buf = buf[255:]
@@ -264,8 +267,9 @@ with open(file_path, mode='r') as f:
         while (is_busy(slave)):
             time.sleep(0.1)
 
-        print("addr {}: flash page write successful".format(hex(addr)))
+        progress.advance(len(buf))
 
+progress.endPhase()
 print("\ntotal_bytes = {}".format(total_bytes))
 
 report_status(jedec)
@@ -287,6 +291,7 @@ while (is_busy(slave)):
 
 report_status(jedec)
 
+progress.startPhase('verify')
 with open(file_path, mode='r') as f:
     x = f.readline()
     while x != '':
@@ -313,9 +318,9 @@ with open(file_path, mode='r') as f:
             # print(binascii.hexlify(read_cmd))
             buf2 = slave.exchange(read_cmd, nbytes)
             if buf == buf2:
-                print("addr {}: read compare successful".format(hex(addr)))
+                progress.advance(nbytes)
             else:
-                print("addr {}: *** read compare FAILED ***".format(hex(addr)))
+                print("\naddr {}: *** read compare FAILED ***".format(hex(addr)))
                 print(binascii.hexlify(buf))
                 print("<----->")
                 print(binascii.hexlify(buf2))
@@ -340,13 +345,14 @@ with open(file_path, mode='r') as f:
         # print(binascii.hexlify(read_cmd))
         buf2 = slave.exchange(read_cmd, nbytes)
         if buf == buf2:
-            print("addr {}: read compare successful".format(hex(addr)))
+            progress.advance(nbytes)
         else:
-            print("addr {}: *** read compare FAILED ***".format(hex(addr)))
+            print("\naddr {}: *** read compare FAILED ***".format(hex(addr)))
             print(binascii.hexlify(buf))
             print("<----->")
             print(binascii.hexlify(buf2))
 
+progress.endPhase()
 print("\ntotal_bytes = {}".format(total_bytes))
 
 pll_trim = slave.exchange([CARAVEL_REG_READ, 0x04],1)
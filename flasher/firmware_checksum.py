@@ -0,0 +1,271 @@
+'''
+Firmware-assisted flash checksums.
+
+Rather than clocking every byte back over the housekeeping SPI
+pass-through, the host asks the Caravel management core to CRC32 a
+range of its own flash, which it reads directly, and compares that with
+the CRC of the image.  This needs firmware built with the checksum
+service (see tt3p5-test/tt3p5.c); with any other image the request is
+simply never answered.
+
+Host and firmware talk through the PLL trim housekeeping register,
+which nothing uses while the PLL is bypassed (the default).  Before
+releasing reset, the host writes a request:
+
+    [25:24] StateRequest  [23:12] first 4k sector  [11:0] sector count - 1
+
+the firmware answers with the CRC, 16 bits at a time:
+
+    [25:24] StateLow/StateHigh  [23:16] MailboxMarker  [15:0] CRC half
+
+and the host acknowledges each half by setting the state to StateAck.
+The register's original value is put back afterwards.  The same
+mailbox carries the boot_probe ready signal.
+
+EmulatedCaravel stands in for the housekeeping SPI and firmware, so the
+protocol can be exercised without hardware; run this module as a
+script to check a request of a given size against it.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import argparse
+import logging
+import threading
+import time
+import zlib
+from typing import Callable
+
+log = logging.getLogger(__name__)
+
+FirmwareCRCSectorSize = 4096
+FirmwareCRCMaxSectors = 4096
+# waited for an answer, on top of the time the firmware needs to get through the range
+FirmwareCRCTimeoutDefault = 5.0
+# how fast the management core CRCs its own flash, and the slack allowed on that
+FirmwareCRCBytesPerSecondEstimate = 256*1024
+FirmwareCRCTimeMargin = 4
+FirmwareCRCPollInterval = 0.002
+# housekeeping SPI register addresses (pll_trim, least significant byte first)
+HKRegReset = 0x0b
+HKRegPLLTrim = 0x0d
+HKCommandRead = 0x40
+HKCommandWrite = 0x80
+HKPLLTrimMask = 0x3ffffff
+HKPLLTrimReset = 0x3ffefff
+# boot_probe: set by the host before reset release, then by the firmware once up
+MailboxReadyArmed = 0x5A << 16
+MailboxReady = 0x5B << 16
+
+class FirmwareChecksumUnavailable(RuntimeError):
+    pass
+
+
+class FirmwareChecksum:
+    StateAck = 0
+    StateRequest = 1
+    StateLow = 2
+    StateHigh = 3
+    MailboxMarker = 0xA5
+
+    def __init__(self, rawPort, holdInReset:Callable[[bool], None],
+                 timeout:float=FirmwareCRCTimeoutDefault):
+        '''
+            @param rawPort: the housekeeping SPI port (not the pass-through)
+            @param holdInReset: callable to hold (True) or release the management core
+            @param timeout: (optional) seconds to wait for each half of the answer, 
+                            beyond the time expected for the firmware to work it out
+        '''
+        self.rawPort = rawPort
+        self.holdInReset = holdInReset
+        self.timeout = timeout
+
+    @classmethod
+    def request(cls, firstSector:int, numSectors:int) -> int:
+        return (cls.StateRequest << 24) | (firstSector << 12) | (numSectors - 1)
+
+    @classmethod
+    def state(cls, mailbox:int) -> int:
+        return (mailbox >> 24) & 0x3
+
+    def readMailbox(self) -> int:
+        value = self.rawPort.exchange([HKCommandRead, HKRegPLLTrim], 4)
+        return int.from_bytes(bytes(value), 'little') & HKPLLTrimMask
+
+    def writeMailbox(self, value:int):
+        self.rawPort.exchange([HKCommandWrite, HKRegPLLTrim] + list(value.to_bytes(4, 'little')))
+
+    @classmethod
+    def expectedSeconds(cls, length:int) -> float:
+        '''
+            roughly how long the firmware takes over length bytes
+        '''
+        return length / FirmwareCRCBytesPerSecondEstimate
+
+    def _awaitHalf(self, state:int, timeout:float) -> int:
+        deadline = time.monotonic() + timeout
+        while True:
+            mailbox = self.readMailbox()
+            if self.state(mailbox) == state and (mailbox >> 16) & 0xff == self.MailboxMarker:
+                return mailbox & 0xffff
+            if time.monotonic() > deadline:
+                raise FirmwareChecksumUnavailable(f'No checksum from firmware after {timeout:.1f}s: '
+                                                  'is the checksum service built in?')
+            time.sleep(FirmwareCRCPollInterval)
+
+    def crc32(self, address:int, length:int) -> int:
+        '''
+            have the firmware CRC32 flash from address, for length bytes
+            (both multiples of FirmwareCRCSectorSize).  Leaves the
+            management core running.
+        '''
+        if address % FirmwareCRCSectorSize or length % FirmwareCRCSectorSize or not length:
+            raise FirmwareChecksumUnavailable(f'Range 0x{address:06x}+{length} is not 4k sector aligned')
+        firstSector = address // FirmwareCRCSectorSize
+        numSectors = length // FirmwareCRCSectorSize
+        if firstSector + numSectors > FirmwareCRCMaxSectors:
+            raise FirmwareChecksumUnavailable(f'Range 0x{address:06x}+{length} beyond 16MB')
+
+        self.holdInReset(True)
+        original = self.readMailbox()
+        self.writeMailbox(self.request(firstSector, numSectors))
+        self.holdInReset(False)
+        try:
+            low = self._awaitHalf(self.StateLow, self.timeout + 
+                                  FirmwareCRCTimeMargin * self.expectedSeconds(length))
+            self.writeMailbox(self.StateAck << 24)
+            high = self._awaitHalf(self.StateHigh, self.timeout)
+            self.writeMailbox(self.StateAck << 24)
+        finally:
+            self.writeMailbox(original)
+        return (high << 16) | low
+
+
+class EmulatedCaravel:
+    '''
+        Emulates the housekeeping SPI registers the checksum and ready
+        probe protocols use, along with the firmware side, in front of a raw
+        SPI port (pass-through commands go on to it).  The firmware
+        "boots" in a thread whenever reset is released.
+    '''
+    def __init__(self, port, readFlash:Callable[[int, int], bytes], serviceBuiltIn:bool=True,
+                 bytesPerSecond:float=FirmwareCRCBytesPerSecondEstimate, ackTimeout:float=1.0,
+                 bootSeconds:float=None):
+        '''
+            @param port: the raw SPI port to pass flash commands on to
+            @param readFlash: callable(address, length) returning flash contents
+            @param serviceBuiltIn: (optional) whether the firmware answers checksum 
+                                   requests and ready probes
+            @param bytesPerSecond: (optional) how fast the firmware gets through flash, 
+                                   None for instantly [FirmwareCRCBytesPerSecondEstimate]
+            @param bootSeconds: (optional) time from reset to ready
+        '''
+        self.port = port
+        self.readFlash = readFlash
+        self.serviceBuiltIn = serviceBuiltIn
+        self.bytesPerSecond = bytesPerSecond
+        self.bootSeconds = bootSeconds
+        self.ackTimeout = ackTimeout
+        self.mailbox = HKPLLTrimReset
+        self.inReset = False
+        self.boots = 0
+        self._firmware = None
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def exchange(self, out=b'', readlen:int=0, start:bool=True, stop:bool=True,
+                 duplex:bool=False, droptail:int=0) -> bytes:
+        out = bytes(out)
+        if not out or out[0] not in (HKCommandRead, HKCommandWrite):
+            return self.port.exchange(out, readlen, start=start, stop=stop,
+                                      duplex=duplex, droptail=droptail)
+        address = out[1]
+        if out[0] == HKCommandWrite:
+            for i, value in enumerate(out[2:]):
+                self._writeReg(address + i, value)
+            return b''
+        return bytes(self._readReg(address + i) for i in range(readlen))
+
+    def _readReg(self, address:int) -> int:
+        if address == HKRegReset:
+            return int(self.inReset)
+        if HKRegPLLTrim <= address < HKRegPLLTrim + 4:
+            return (self.mailbox >> (8 * (address - HKRegPLLTrim))) & 0xff
+        return 0
+
+    def _writeReg(self, address:int, value:int):
+        if address == HKRegReset:
+            wasInReset = self.inReset
+            self.inReset = bool(value & 1)
+            if wasInReset and not self.inReset:
+                self._boot()
+        elif HKRegPLLTrim <= address < HKRegPLLTrim + 4:
+            shift = 8 * (address - HKRegPLLTrim)
+            self.mailbox = ((self.mailbox & ~(0xff << shift)) | (value << shift)) & HKPLLTrimMask
+
+    def _boot(self):
+        self.boots += 1
+        if self.serviceBuiltIn:
+            self._firmware = threading.Thread(target=self._firmwareMain, daemon=True,
+                                              name='emulated-caravel')
+            self._firmware.start()
+
+    def _publish(self, state:int, half:int) -> bool:
+        self.mailbox = (state << 24) | (FirmwareChecksum.MailboxMarker << 16) | (half & 0xffff)
+        deadline = time.monotonic() + self.ackTimeout
+        while time.monotonic() < deadline:
+            if self.inReset:
+                return False
+            if FirmwareChecksum.state(self.mailbox) == FirmwareChecksum.StateAck:
+                return True
+            time.sleep(FirmwareCRCPollInterval / 4)
+        return False
+
+    def _firmwareMain(self):
+        readyProbe = self.mailbox == MailboxReadyArmed
+        self._checksumService()
+        if self.bootSeconds:
+            time.sleep(self.bootSeconds)
+        if readyProbe and not self.inReset:
+            self.mailbox = MailboxReady
+
+    def _checksumService(self):
+        request = self.mailbox
+        if FirmwareChecksum.state(request) != FirmwareChecksum.StateRequest:
+            return
+        first = (request >> 12) & 0xfff
+        count = (request & 0xfff) + 1
+        length = count * FirmwareCRCSectorSize
+        crc = zlib.crc32(self.readFlash(first * FirmwareCRCSectorSize, length))
+        if self.bytesPerSecond:
+            time.sleep(length / self.bytesPerSecond)
+        if self._publish(FirmwareChecksum.StateLow, crc):
+            self._publish(FirmwareChecksum.StateHigh, crc >> 16)
+
+
+def main():
+    logging.basicConfig(level=logging.WARN)
+    parser = argparse.ArgumentParser(description='Check the firmware checksum protocol against an emulated Caravel')
+    parser.add_argument("--size", type=int, default=2*1024*1024,
+                        required=False,
+                    help="bytes to checksum in a single request [2097152]")
+    parser.add_argument("--rate", type=float, default=FirmwareCRCBytesPerSecondEstimate,
+                        required=False,
+                    help=f"emulated firmware bytes/second [{FirmwareCRCBytesPerSecondEstimate}]")
+    args = parser.parse_args()
+    length = -(-args.size // FirmwareCRCSectorSize) * FirmwareCRCSectorSize
+    flash = bytes(i & 0xff for i in range(length))
+    caravel = EmulatedCaravel(None, lambda address, size: flash[address:address+size],
+                              bytesPerSecond=args.rate)
+    holdInReset = lambda inReset: caravel.exchange([HKCommandWrite, HKRegReset, int(inReset)])
+    checker = FirmwareChecksum(caravel, holdInReset)
+    start = time.monotonic()
+    crc = checker.crc32(0, length)
+    elapsed = time.monotonic() - start
+    status = 'OK' if crc == zlib.crc32(flash) else 'MISMATCH'
+    print(f'{length} bytes: CRC32 {crc:08x} {status} in {elapsed:.2f}s '
+          f'(expected ~{FirmwareChecksum.expectedSeconds(length):.2f}s)')
+
+
+if __name__ == '__main__':
+    main()
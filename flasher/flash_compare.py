@@ -0,0 +1,178 @@
+'''
+Streaming comparison of an image file against flash.
+
+Flash is read ahead on a worker thread, a bounded number of chunks at a
+time, while the main thread decompresses the file and compares, so
+memory use does not depend on the image size and USB reads overlap the
+comparison.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import logging
+import queue
+import threading
+from typing import List
+
+from spiflash.serialflash import SerialFlash
+from image_source import ImageSource
+from flash_events import ProgressReporter
+
+log = logging.getLogger(__name__)
+
+CompareChunkSizeDefault = 64*1024
+ComparePrefetchDepth = 4
+CompareMaxDiffsReported = 16
+CompareDiffGranularity = 256
+
+class FlashPrefetcher(threading.Thread):
+    '''
+        Reads consecutive chunks of flash, from startAddress up to (but
+        not including) endAddress, a few chunks ahead of the consumer.
+    '''
+    _Done = object()
+
+    def __init__(self, flash:SerialFlash, startAddress:int, endAddress:int,
+                 chunkSize:int=CompareChunkSizeDefault, depth:int=ComparePrefetchDepth):
+        super().__init__(name='flash-prefetch', daemon=True)
+        self.flash = flash
+        self.startAddress = startAddress
+        self.endAddress = endAddress
+        self.chunkSize = chunkSize
+        self._queue = queue.Queue(maxsize=depth)
+        self._cancelled = False
+
+    def run(self):
+        try:
+            for address in range(self.startAddress, self.endAddress, self.chunkSize):
+                if self._cancelled:
+                    return
+                size = min(self.chunkSize, self.endAddress - address)
+                self._queue.put(self.flash.read(address, size))
+            self._queue.put(self._Done)
+        except Exception as e:
+            self._queue.put(e)
+
+    def next(self) -> bytes:
+        '''
+            the next chunk of flash, or b'' once past endAddress
+        '''
+        item = self._queue.get()
+        if item is self._Done:
+            # keep answering, in case we are asked again
+            self._queue.put(item)
+            return b''
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def cancel(self):
+        '''
+            stop reading, and wait for any read in progress to finish so
+            the flash is free to use again
+        '''
+        self._cancelled = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.join()
+
+
+class CompareResult:
+    def __init__(self):
+        self.bytesCompared = 0
+        # (start, end) flash address ranges that differ
+        self.mismatches = []
+        # (address, expected, actual) for the first few differing bytes
+        self.firstDiffs = []
+        self.stoppedEarly = False
+
+    @property
+    def ok(self) -> bool:
+        return not self.mismatches
+
+    @property
+    def bytesMismatched(self) -> int:
+        return sum(end - start for start, end in self.mismatches)
+
+    def addDiffs(self, address:int, expected:bytes, actual:bytes):
+        '''
+            record where expected and actual, found at address, differ
+        '''
+        for pos in range(0, len(expected), CompareDiffGranularity):
+            exp = expected[pos:pos+CompareDiffGranularity]
+            act = actual[pos:pos+CompareDiffGranularity]
+            if exp == act:
+                continue
+            diffs = [i for i in range(len(exp)) if i >= len(act) or exp[i] != act[i]]
+            first = address + pos + diffs[0]
+            last = address + pos + diffs[-1] + 1
+            if self.mismatches and self.mismatches[-1][1] >= address + pos:
+                self.mismatches[-1] = (self.mismatches[-1][0], last)
+            else:
+                self.mismatches.append((first, last))
+            for i in diffs:
+                if len(self.firstDiffs) >= CompareMaxDiffsReported:
+                    break
+                self.firstDiffs.append((address + pos + i, exp[i],
+                                        act[i] if i < len(act) else None))
+
+    def report(self) -> List[str]:
+        lines = []
+        if self.ok:
+            lines.append(f'Flash matches ({self.bytesCompared} bytes compared)')
+            return lines
+        lines.append(f'MISMATCH: {self.bytesMismatched} bytes in {len(self.mismatches)} ranges '
+                     f'({self.bytesCompared} bytes compared{", stopped early" if self.stoppedEarly else ""})')
+        for start, end in self.mismatches[:CompareMaxDiffsReported]:
+            lines.append(f'  0x{start:06x}-0x{end:06x}')
+        if len(self.mismatches) > CompareMaxDiffsReported:
+            lines.append(f'  ... and {len(self.mismatches) - CompareMaxDiffsReported} more ranges')
+        for address, expected, actual in self.firstDiffs:
+            actualStr = 'missing' if actual is None else f'0x{actual:02x}'
+            lines.append(f'  @ 0x{address:06x}: expected 0x{expected:02x}, flash has {actualStr}')
+        return lines
+
+
+def compareStream(flash:SerialFlash, source:ImageSource, startAddress:int=0,
+                  chunkSize:int=CompareChunkSizeDefault, stopAtFirst:bool=False,
+                  progress:ProgressReporter=None) -> CompareResult:
+    '''
+        compare an image against flash, chunk by chunk
+        @param stopAtFirst: (optional) return as soon as a mismatching chunk is found
+        @param progress: (optional) ProgressReporter to advance as chunks are compared
+    '''
+    result = CompareResult()
+    sizeHint = source.sizeHint
+    endAddress = len(flash)
+    if sizeHint is not None:
+        endAddress = min(endAddress, startAddress + sizeHint)
+    prefetcher = FlashPrefetcher(flash, startAddress, endAddress, chunkSize)
+    prefetcher.start()
+    try:
+        chunks = source.chunks(chunkSize)
+        pending = next(chunks, None)
+        while pending is not None:
+            offset, data = pending
+            # one chunk ahead: only once the source is exhausted is its extent
+            # known, and with it the length of a blank final chunk
+            pending = next(chunks, None)
+            actual = prefetcher.next()
+            expected = data
+            if expected is None:
+                length = chunkSize if pending is not None else source.extent - offset
+                expected = b'\xff' * length
+            result.bytesCompared += len(expected)
+            if progress is not None:
+                progress.advance(len(expected))
+            actual = actual[:len(expected)]
+            if actual == expected:
+                continue
+            result.addDiffs(startAddress + offset, expected, actual)
+            if stopAtFirst:
+                result.stoppedEarly = True
+                break
+    finally:
+        prefetcher.cancel()
+    return result
@@ -0,0 +1,192 @@
+'''
+Progress and events from flashing operations.
+
+The flashing engine reports phase starts and ends, bytes done (with rate
+and ETA) and errors as FlashEvents to a sink, which is any callable
+taking a FlashEvent: a TTY progress bar, a JSON-lines log, nothing at
+all, or a GUI or station software hook.  Progress updates are rate
+limited, so reporting costs next to nothing however small the steps.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import json
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional, TextIO
+
+ProgressIntervalDefault = 0.2
+ProgressBarWidth = 30
+
+class FlashEvent:
+    PhaseStart = 'phase_start'
+    Progress = 'progress'
+    PhaseEnd = 'phase_end'
+    Error = 'error'
+
+    def __init__(self, kind:str, phase:str, done:int=0, total:Optional[int]=None,
+                 elapsed:float=0.0, message:str=None):
+        self.kind = kind
+        self.phase = phase
+        self.done = done
+        self.total = total
+        self.elapsed = elapsed
+        self.message = message
+        self.timestamp = time.time()
+
+    @property
+    def rate(self) -> float:
+        '''
+            bytes per second so far in the phase
+        '''
+        return self.done / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        '''
+            seconds left in the phase, if that can be told
+        '''
+        if self.total is None or not self.done:
+            return None
+        return (self.total - self.done) / self.rate if self.rate else None
+
+    def asDict(self) -> dict:
+        return {'ts': round(self.timestamp, 3), 'event': self.kind, 'phase': self.phase,
+                'done': self.done, 'total': self.total, 'elapsed': round(self.elapsed, 3),
+                'rate': round(self.rate), 'eta': None if self.eta is None else round(self.eta, 1),
+                'message': self.message}
+
+
+class ProgressReporter:
+    '''
+        Tracks the current phase and sends FlashEvents to the sink, with
+        progress events at most every minInterval seconds.  With no sink,
+        nothing is built or sent at all.
+    '''
+    def __init__(self, sink:Callable[[FlashEvent], None]=None,
+                 minInterval:float=ProgressIntervalDefault):
+        self.sink = sink
+        self.minInterval = minInterval
+        self.phaseName = None
+        self.done = 0
+        self.total = None
+        self._start = 0.0
+        self._nextEmit = 0.0
+        self._suspended = False
+
+    def _emit(self, kind:str, message:str=None):
+        self.sink(FlashEvent(kind, self.phaseName, self.done, self.total,
+                             time.monotonic() - self._start, message))
+
+    def startPhase(self, name:str, total:Optional[int]=None):
+        self.phaseName = name
+        self.done = 0
+        self.total = total
+        self._start = time.monotonic()
+        self._nextEmit = self._start + self.minInterval
+        if self.sink is not None:
+            self._emit(FlashEvent.PhaseStart)
+
+    def advance(self, numBytes:int):
+        if self._suspended:
+            return
+        self.done += numBytes
+        if self.sink is None:
+            return
+        now = time.monotonic()
+        if now >= self._nextEmit:
+            self._nextEmit = now + self.minInterval
+            self._emit(FlashEvent.Progress)
+
+    def endPhase(self):
+        if self.sink is not None:
+            self._emit(FlashEvent.PhaseEnd)
+        self.phaseName = None
+
+    def error(self, exc:BaseException):
+        if self.sink is not None:
+            self._emit(FlashEvent.Error, f'{type(exc).__name__}: {exc}')
+
+    @contextmanager
+    def suspended(self):
+        '''
+            ignore progress from the steps of a block, for when the 
+            caller accounts for it as a whole
+        '''
+        wasSuspended = self._suspended
+        self._suspended = True
+        try:
+            yield self
+        finally:
+            self._suspended = wasSuspended
+
+    @contextmanager
+    def phase(self, name:str, total:Optional[int]=None):
+        '''
+            run a block as a phase: start and end events around it, and an
+            error event if it raises
+        '''
+        self.startPhase(name, total)
+        try:
+            yield self
+        except Exception as e:
+            self.error(e)
+            self.phaseName = None
+            raise
+        self.endPhase()
+
+
+class TTYProgressSink:
+    '''
+        a progress bar, redrawn in place on a terminal
+    '''
+    def __init__(self, stream:TextIO=None):
+        self.stream = stream or sys.stderr
+
+    def __call__(self, event:FlashEvent):
+        if event.kind == FlashEvent.Error:
+            self.stream.write(f'\n{event.phase}: {event.message}\n')
+        elif event.kind == FlashEvent.PhaseStart:
+            return
+        else:
+            self.stream.write(f'\r{self._line(event)}')
+            if event.kind == FlashEvent.PhaseEnd:
+                self.stream.write('\n')
+        self.stream.flush()
+
+    @classmethod
+    def _line(cls, event:FlashEvent) -> str:
+        rate = f'{event.rate/1024:7.1f} KiB/s'
+        if event.total:
+            filled = int(ProgressBarWidth * min(event.done, event.total) / event.total)
+            bar = '#' * filled + '-' * (ProgressBarWidth - filled)
+            eta = event.eta
+            etaStr = f'ETA {eta:5.0f}s' if eta is not None and event.kind != FlashEvent.PhaseEnd \
+                        else f'{event.elapsed:5.1f}s   '
+            return f'{event.phase:>8} [{bar}] {100*event.done/event.total:5.1f}% {rate} {etaStr}'
+        return f'{event.phase:>8} {event.done:>10} bytes {rate} {event.elapsed:5.1f}s'
+
+
+class JSONLinesSink:
+    '''
+        one JSON object per event, per line
+    '''
+    def __init__(self, stream:TextIO=None):
+        self.stream = stream or sys.stderr
+
+    def __call__(self, event:FlashEvent):
+        self.stream.write(json.dumps(event.asDict()) + '\n')
+        self.stream.flush()
+
+
+def progressSink(kind:str) -> Optional[Callable[[FlashEvent], None]]:
+    '''
+        a sink by name: 'bar', 'json' or 'silent'
+    '''
+    if kind == 'bar':
+        return TTYProgressSink()
+    if kind == 'json':
+        return JSONLinesSink()
+    if kind == 'silent':
+        return None
+    raise ValueError(f'Unknown progress output {kind}')
@@ -0,0 +1,213 @@
+'''
+Interleaved multi-chip flash scheduler.
+
+Erase and program time is dominated by the flash chip being busy, not
+by the SPI bus.  With several flash devices on separate chip selects of
+one controller, this scheduler issues an operation to one chip and,
+while that chip reports work-in-progress, feeds the next one, round
+robin, so N chips program in roughly the time it takes to do one.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import argparse
+import collections
+import logging
+import time
+from typing import List, Tuple
+
+from pyftdi.spi import SpiController
+from spi_port import CaravelPassThroughSpiPort
+from spiflash.serialflash import SerialFlash, SerialFlashManager, Sst25FlashDevice, \
+                                SerialFlashNotSupported, SerialFlashTimeout
+from image_source import ImageSource
+from flash_util import SPIFrequencyDefault
+
+log = logging.getLogger(__name__)
+
+SchedulerIdleSleep = 0.0002
+
+class _FlashQueue:
+    '''
+        pending operations for one flash device, and the one in flight
+    '''
+    def __init__(self, name:str, flash:SerialFlash):
+        self.name = name
+        self.flash = flash
+        self.ops = collections.deque()
+        self.inFlight = None
+        self.deadline = 0
+        self.numBytes = 0
+        self.startTime = None
+        self.endTime = None
+
+    def issueNext(self):
+        op = self.ops.popleft()
+        kind, address, payload = op
+        if kind == 'erase':
+            command, timing = payload
+            self.flash.start_erase_block(command, address)
+        else:
+            timing = self.flash.get_timings('page')
+            self.flash.start_program_page(address, payload)
+        typical, maximum = timing
+        self.inFlight = op
+        self.deadline = time.time() + typical + maximum
+
+
+class InterleavedFlashScheduler:
+    '''
+        Add (flash, address, data) jobs with add(), then run() them all,
+        interleaved.
+    '''
+    def __init__(self):
+        self._queues = []
+        self.busyPolls = 0
+
+    def add(self, flash:SerialFlash, address:int, data:bytes, name:str=None):
+        '''
+            queue the erase and program of data at address on flash.
+            Blank (0xFF) pages are erased but not programmed.
+            @param address: start address, on an erase sector boundary
+        '''
+        # SST25 parts only program through AAI, their page program raises
+        if not hasattr(flash, 'start_program_page') or isinstance(flash, Sst25FlashDevice):
+            raise SerialFlashNotSupported(f'{flash} cannot be scheduled')
+        queue = _FlashQueue(name or f'flash{len(self._queues)}', flash)
+        eraseSize = flash.get_erase_size()
+        eraseLen = ((len(data) + eraseSize - 1) // eraseSize) * eraseSize
+        flash.can_erase(address, eraseLen)
+        for blockAddr, command, timing in self.erasePlan(flash, address, eraseLen):
+            queue.ops.append(('erase', blockAddr, (command, timing)))
+
+        view = memoryview(data)
+        pageSize = flash.get_size('page')
+        blank = b'\xff' * pageSize
+        for offset in range(0, len(data), pageSize):
+            page = view[offset:offset+pageSize]
+            if page == blank[:len(page)]:
+                continue
+            queue.ops.append(('page', address + offset, bytes(page)))
+        queue.numBytes = len(data)
+        self._queues.append(queue)
+
+    @classmethod
+    def erasePlan(cls, flash:SerialFlash, address:int, length:int) -> List[Tuple[int, int, Tuple[float, float]]]:
+        '''
+            split an erase range into (address, command, timings) blocks,
+            using large sectors wherever they fit
+        '''
+        eraseSize = flash.get_erase_size()
+        sectorSize = None
+        if flash.has_feature(SerialFlash.FEAT_SECTERASE):
+            sectorSize = flash.get_size('sector')
+        smallKind = 'subsector' if flash.has_feature(SerialFlash.FEAT_SUBSECTERASE) else \
+                        ('hsector' if flash.has_feature(SerialFlash.FEAT_HSECTERASE) else 'sector')
+        plan = []
+        pos = address
+        end = address + length
+        while pos < end:
+            if sectorSize and (pos % sectorSize) == 0 and pos + sectorSize <= end:
+                plan.append((pos, flash.get_erase_command('sector'), flash.get_timings('sector')))
+                pos += sectorSize
+            else:
+                plan.append((pos, flash.get_erase_command(smallKind), flash.get_timings(smallKind)))
+                pos += eraseSize
+        return plan
+
+    def run(self) -> dict:
+        '''
+            run all queued jobs to completion, round robin
+            @return: stats, with per-device and aggregate timings
+        '''
+        startTime = time.time()
+        active = [q for q in self._queues if q.ops]
+        for q in active:
+            q.startTime = startTime
+        while active:
+            issued = False
+            for q in active:
+                if q.inFlight is not None:
+                    self.busyPolls += 1
+                    if q.flash.is_busy():
+                        if time.time() > q.deadline:
+                            raise SerialFlashTimeout(f'{q.name}: {q.inFlight[0]} @ 0x{q.inFlight[1]:06x} timed out')
+                        continue
+                    q.inFlight = None
+                if q.ops:
+                    q.issueNext()
+                    issued = True
+                else:
+                    q.endTime = time.time()
+            active = [q for q in active if q.ops or q.inFlight is not None]
+            if not issued:
+                time.sleep(SchedulerIdleSleep)
+
+        elapsed = time.time() - startTime
+        totalBytes = sum(q.numBytes for q in self._queues)
+        return {
+            'elapsed': elapsed,
+            'bytes': totalBytes,
+            'bytesPerSecond': totalBytes / elapsed if elapsed else 0,
+            'busyPolls': self.busyPolls,
+            'devices': {q.name: {'bytes': q.numBytes,
+                                 'elapsed': (q.endTime or startTime) - startTime}
+                            for q in self._queues}
+        }
+
+
+def openCaravelFlashes(uri:str, csList:List[int], freq:float=SPIFrequencyDefault) -> Tuple[SpiController, list]:
+    '''
+        open the flash behind the Caravel housekeeping passthrough of each
+        chip select in csList, on a single controller
+        @return: (controller, [(raw port, flash), ...])
+    '''
+    ctrl = SpiController(cs_count=max(csList)+1)
+    ctrl.configure(uri)
+    devices = []
+    for cs in csList:
+        rawPort = ctrl.get_port(cs=cs, freq=freq, mode=0)
+        flash = SerialFlashManager.get_from_spi_port(CaravelPassThroughSpiPort.newFromSpiPort(rawPort))
+        devices.append((rawPort, flash))
+    return (ctrl, devices)
+
+
+def getArgParser():
+    parser = argparse.ArgumentParser(description='Program several flash chips, on one SPI controller, interleaved')
+    parser.add_argument("--uri", type=str, required=True,
+                    help="FTDI device URI")
+    parser.add_argument("--cs", type=str, default='0,1',
+                        required=False,
+                    help="comma separated chip selects, one Caravel board each [0,1]")
+    parser.add_argument("--write", type=str, required=True,
+                    help="image file to write to every chip")
+    parser.add_argument("--address", type=int, default=0,
+                        required=False,
+                    help="start address [0]")
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.WARN)
+    args = getArgParser().parse_args()
+    contents = ImageSource(args.write).read()
+    csList = [int(cs) for cs in args.cs.split(',')]
+    ctrl, devices = openCaravelFlashes(args.uri, csList)
+    scheduler = InterleavedFlashScheduler()
+    try:
+        for cs, (rawPort, flash) in zip(csList, devices):
+            # hold each management core in reset while we use its flash
+            rawPort.exchange([0x80, 0xb, 1])
+            scheduler.add(flash, args.address, contents, name=f'cs{cs}')
+        stats = scheduler.run()
+    finally:
+        for rawPort, _flash in devices:
+            rawPort.exchange([0x80, 0xb, 0])
+        ctrl.terminate()
+    for name, devStats in stats['devices'].items():
+        print(f"{name}: {devStats['bytes']} bytes done after {devStats['elapsed']:.2f}s")
+    print(f"Aggregate: {stats['bytes']} bytes in {stats['elapsed']:.2f}s "
+          f"({stats['bytesPerSecond']/1024:.1f} KiB/s), {stats['busyPolls']} busy polls")
+
+
+if __name__ == '__main__':
+    main()
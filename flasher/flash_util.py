@@ -4,24 +4,95 @@ Created on Oct 3, 2023
 @author: Pat Deegan
 @copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
 '''
+import hashlib
 import logging
+import os
+import sys
 import time
 import argparse
+import random
+import zlib
+from typing import Iterable, List, Set, Tuple
 from spi_port import CaravelPassThroughSpiPort
-from spiflash.serialflash import SerialFlash, SerialFlashManager
+from spiflash.serialflash import SerialFlash, SerialFlashManager, SerialFlashError
+from sector_journal import SectorJournal, JournalFileDefault
+from shadow_store import ShadowStore, ShadowedFlash
+from read_cache import SectorReadCache, CachedFlash, ReadCacheBudgetDefault
+from image_meta import ImageMetadata
+from image_source import ImageSource, ImagePreparer
+from sector_manifest import SectorManifest
+from write_manifest import WriteManifest
+from sparse_dump import SparseDumpWriter, sparseMapPath
+from backup_store import BackupStore, BackupManifest
+from flash_compare import CompareResult, compareStream, CompareChunkSizeDefault
+from flash_events import ProgressReporter, progressSink
+from firmware_checksum import FirmwareChecksum, FirmwareChecksumUnavailable, \
+                                FirmwareCRCSectorSize, FirmwareCRCTimeoutDefault
+from boot_probe import BootProbe, BootProbeTimeout, BootProbeTimeoutDefault
+from verify_tiers import VerifyPlanner, VerifyTiers, VerifyTierSampled, VerifyTierHash, \
+                                VerifyTierFull, VerifyTierNone, VerifyConfidenceDefault, \
+                                VerifySegmentSizeDefault
+from transport_tuning import TransportProfile, TransportProfileStore, TransportTuner, \
+                                TransportProfileFileDefault
 from pyftdi.spi import SpiController
 import pyftdi.ftdi
 
 log = logging.getLogger(__name__)
 
 FTDIDeviceURIDefault = 'ftdi://ftdi:2232:TG110925/2'
+# pass-through SPI clock to the housekeeping SPI
+SPIFrequencyDefault = 1E6
+VerifyRetriesDefault = 2
+MetadataSampleCountDefault = 8
+StreamEraseWindowDefault = 64*1024
+ReadCoalesceGapDefault = 4096
+SparseReadChunkSize = 64*1024
+BackupWindowSize = 64*1024
+
+class FlashVerifyError(RuntimeError):
+    '''
+        Raised when a programmed unit still reads back wrong 
+        after all retries have been exhausted.
+    '''
+
+class OperationStats:
+    '''
+        timings and counts of the flash operations done through 
+        a FlashUtil, for metrics
+    '''
+    def __init__(self):
+        # (seconds, sector count) of each erase run
+        self.eraseTimes = []
+        # seconds taken by each sector programmed
+        self.programTimes = []
+        self.verifyRetries = 0
+        # seconds from reset release to firmware ready, if probed
+        self.bootLatency = None 
+        # post-write verification: tier used, its VerifyEstimate, actual seconds,
+        # outcome, and the sampling seed (to reproduce a sampled run)
+        self.verifyTier = None 
+        self.verifyEstimate = None 
+        self.verifySeconds = None 
+        self.verifyOk = None 
+        self.verifySeed = None 
+        
+
 class FlashUtil:
     def __init__(self):
         self._ctrl = SpiController()
         self._spi_port = None 
         self._flash = None 
+        self._flash_port = None 
+        self._shadow = None 
+        self._readCache = None 
         self._ctrl_configured = False 
         self.deviceURI = FTDIDeviceURIDefault 
+        self.tagAddress = None 
+        self.opStats = OperationStats()
+        # phase/progress events, silent unless given a sink
+        self.progress = ProgressReporter()
+        # FTDI latency/chunk/CS hold settings to use, pyftdi defaults if None
+        self.transportProfile = None 
         
         
     @classmethod
@@ -38,6 +109,19 @@ class FlashUtil:
         return num
         
         
+    def close(self):
+        '''
+            release the FTDI device, so the board may be unplugged
+        '''
+        if self._ctrl_configured:
+            self._ctrl.terminate()
+        self._ctrl_configured = False 
+        self._spi_port = None 
+        self._flash = None 
+        self._flash_port = None 
+        self._shadow = None 
+        self._readCache = None 
+        
     @property
     def spi_controller(self) -> SpiController:
         
@@ -60,7 +144,9 @@ class FlashUtil:
         if self._spi_port is not None:
             return self._spi_port
         
-        self._spi_port = self.spi_controller.get_port(cs=0, freq=1E6, mode=0)
+        self._spi_port = self.spi_controller.get_port(cs=0, freq=SPIFrequencyDefault, mode=0)
+        if self.transportProfile is not None:
+            self.transportProfile.apply(self.spi_controller.ftdi, self._spi_port)
         return self._spi_port
     
     
@@ -77,6 +163,7 @@ class FlashUtil:
         
         try:
             self._flash = SerialFlashManager.get_from_spi_port(caravelSPIPortWrapper)
+            self._flash_port = caravelSPIPortWrapper
         except Exception as e:
             raise RuntimeError(f"Issue connecting to flash!\n\n{str(e)}")
         
@@ -94,10 +181,11 @@ class FlashUtil:
             time.sleep(0.01) # give it a sec
         
     def getFileContents(self, filepath:str):
-        with open(filepath, 'rb') as file:
-            contents = file.read()
-            file.close()
-            return contents
+        '''
+            full contents of an image file, which may be raw binary or 
+            .hex, and gzip/xz/zstd compressed
+        '''
+        return ImageSource(filepath).read()
         
     def uploadFile(self, filepath:str, startAddress:int=0):
         '''
@@ -108,36 +196,793 @@ class FlashUtil:
         contents = self.getFileContents(filepath)
         return self.upload(contents, startAddress)
     
-    def upload(self, contents:bytes, startAddress:int=0):
+    def upload(self, contents:bytes, startAddress:int=0, verify:bool=False, 
+               maxRetries:int=VerifyRetriesDefault, verifyBatch:int=1, 
+               journal:SectorJournal=None, tagVersion:str=None, 
+               sectorManifest:SectorManifest=None, differential:bool=False):
         '''
             upload bytes to flash
             @param contents: the iterable array of bytes
             @param startAddress: (optional) start address (must be on sector bounds)  
+            @param verify: (optional) read back each sector right after programming it
+            @param maxRetries: (optional) number of re-erase/re-program attempts for a bad sector
+            @param verifyBatch: (optional) number of sectors to program before each read back
+            @param journal: (optional) SectorJournal used to record progress and resume
+            @param tagVersion: (optional) once programmed, write an ImageMetadata tag carrying this version
+            @param sectorManifest: (optional) SectorManifest of contents, to only program non-blank pages
+            @param differential: (optional) with a sectorManifest, skip sectors that already match
         '''
         flash = self.flash
         flashSectorSize = flash.get_erase_size()
         contLen = len(contents)
+        sectorManifest = self._checkSectorManifest(sectorManifest, flashSectorSize, contents)
+        metadata = None 
+        if tagVersion is not None:
+            metadata = ImageMetadata.forContents(contents, startAddress, tagVersion)
+            self._checkMetadataClear(startAddress, contLen)
         sectorExtraCount = contLen % flashSectorSize
         if sectorExtraCount:
             log.info(f"Contents need to be multiples of sector size {flashSectorSize}, padding")
             paddingBytes = bytearray(flashSectorSize - sectorExtraCount)
-            contents = bytearray(list(contents))
+            if sectorManifest is not None:
+                # left erased, as the manifest's page spans do not cover it
+                paddingBytes = bytearray(b'\xff' * len(paddingBytes))
+            contents = bytearray(contents)
             contents.extend(paddingBytes)
             contLen = len(contents)
             
         self.caravelHoldInReset(True)
-        flash.erase(startAddress, contLen)
-        flash.write(startAddress, contents)
+        if metadata is not None:
+            # drop any stale tag first, so an interrupted upload never looks current
+            flash.erase(self.metadataAddress, flashSectorSize)
+            
+        resumeOffset = 0
+        if journal is not None:
+            committed = journal.begin(self.boardIdentity(), contents, startAddress, flashSectorSize)
+            resumeOffset = self._checkResumePoint(contents, startAddress, committed, flashSectorSize)
+            if resumeOffset:
+                log.warning(f'Resuming upload at offset 0x{resumeOffset:06x} of 0x{contLen:06x}')
+        
+        if self._shadow is not None:
+            self._uploadDifferential(contents, startAddress, resumeOffset, flashSectorSize, 
+                                     verify, maxRetries, max(1, verifyBatch), journal)
+        else:
+            sectorOffsets = range(resumeOffset, contLen, flashSectorSize)
+            eraseOffsets = sectorOffsets
+            programOffsets = sectorOffsets
+            pageRuns = None 
+            if sectorManifest is not None:
+                pageRuns = sectorManifest.programRuns()
+                if differential:
+                    with self.progress.phase('compare', contLen - resumeOffset):
+                        matching, erased = self._manifestDiff(sectorManifest, startAddress, 
+                                                              sectorOffsets)
+                    log.info(f'{len(matching)} sectors already match, {len(erased)} need no erase')
+                    sectorOffsets = [offset for offset in sectorOffsets if offset not in matching]
+                    eraseOffsets = [offset for offset in sectorOffsets if offset not in erased]
+                    programOffsets = sectorOffsets
+                if not verify:
+                    programOffsets = [offset for offset in sectorOffsets 
+                                        if not sectorManifest.isBlank(offset)]
+            with self.progress.phase('erase', len(eraseOffsets) * flashSectorSize):
+                self._eraseSectors(startAddress, eraseOffsets, flashSectorSize)
+            with self.progress.phase('program', len(programOffsets) * flashSectorSize):
+                self._programSectors(contents, startAddress, programOffsets, flashSectorSize, 
+                                     verify, maxRetries, max(1, verifyBatch), journal, pageRuns)
+        
+        if journal is not None:
+            journal.complete()
+        if metadata is not None:
+            flash.write(self.metadataAddress, metadata.pack())
+        self.caravelHoldInReset(False)
+        
+    def _checkSectorManifest(self, sectorManifest:SectorManifest, sectorSize:int, 
+                             contents:bytes=None) -> SectorManifest:
+        '''
+            @param contents: (optional) the image, checked against the manifest's hash
+            @return: sectorManifest, or None if it does not fit the image or flash
+        '''
+        if sectorManifest is None:
+            return None 
+        if not sectorManifest.usableFor(sectorSize):
+            log.warning(f'Sector manifest is for {sectorManifest.sectorSize} byte sectors, '
+                        f'flash has {sectorSize}: not using it')
+            return None 
+        if contents is None:
+            return sectorManifest
+        if sectorManifest.size != len(contents):
+            log.warning(f'Sector manifest is for a {sectorManifest.size} byte image, '
+                        f'not {len(contents)}: not using it')
+            return None 
+        if hashlib.sha256(contents).hexdigest() != sectorManifest.imageHash:
+            # a stale sidecar left next to a rebuilt image
+            log.warning('Sector manifest does not match the image contents: not using it')
+            return None 
+        return sectorManifest
+    
+    def _manifestDiff(self, sectorManifest:SectorManifest, startAddress:int, 
+                      sectorOffsets:Iterable[int]) -> Tuple[Set[int], Set[int]]:
+        '''
+            hash flash sectors against the manifest
+            @return: (offsets of sectors that already match, offsets of sectors erased on flash)
+        '''
+        flash = self.flash
+        sectorSize = sectorManifest.sectorSize
+        matching = set()
+        erased = set()
+        for runStart, runEnd in self._sectorRuns(sectorOffsets, sectorSize):
+            for chunkStart in range(runStart, runEnd, CompareChunkSizeDefault):
+                chunkEnd = min(runEnd, chunkStart + CompareChunkSizeDefault)
+                data = flash.read(startAddress + chunkStart, chunkEnd - chunkStart)
+                for offset in range(chunkStart, chunkEnd, sectorSize):
+                    sector = data[offset - chunkStart:offset - chunkStart + sectorSize]
+                    if sector.count(0xff) == len(sector):
+                        erased.add(offset)
+                    if sectorManifest.sectorMatches(offset, sector[:sectorManifest.sectorLength(offset)]):
+                        matching.add(offset)
+                self.progress.advance(chunkEnd - chunkStart)
+        return (matching, erased)
+    
+    @property 
+    def metadataAddress(self) -> int:
+        '''
+            location of the image metadata tag: tagAddress if set, 
+            otherwise the last erase sector of the flash
+        '''
+        if self.tagAddress is not None:
+            return self.tagAddress
+        flash = self.flash
+        return len(flash) - flash.get_erase_size()
+    
+    def _checkMetadataClear(self, startAddress:int, length:int):
+        tagStart = self.metadataAddress
+        tagEnd = tagStart + self.flash.get_erase_size()
+        if startAddress < tagEnd and tagStart < startAddress + length:
+            raise ValueError(f'Image overlaps metadata tag sector @ 0x{tagStart:06x}')
+        
+    def readImageMetadata(self) -> ImageMetadata:
+        '''
+            read the image metadata tag 
+            @return: the ImageMetadata found, or None
+        '''
+        self.caravelHoldInReset(True)
+        raw = self.flash.read(self.metadataAddress, ImageMetadata.Size)
+        self.caravelHoldInReset(False)
+        return ImageMetadata.unpack(raw)
+    
+    def isUpToDate(self, contents:bytes, startAddress:int=0, 
+                   samples:int=MetadataSampleCountDefault) -> bool:
+        '''
+            check whether contents are already on flash, according to the 
+            metadata tag, confirmed by a quick sampled verify.
+            @param contents: the image that would be uploaded
+            @param startAddress: (optional) where it would be uploaded
+            @param samples: (optional) number of random pages to compare
+        '''
+        metadata = self.readImageMetadata()
+        if metadata is None or not metadata.matches(contents, startAddress):
+            return False 
+        log.info(f'Metadata tag matches: {metadata}')
+        self.caravelHoldInReset(True)
+        sampledOk = self.sampledVerify(contents, startAddress, samples)
+        self.caravelHoldInReset(False)
+        return sampledOk
+    
+    def sampledVerify(self, contents:bytes, startAddress:int=0, 
+                      samples:int=MetadataSampleCountDefault, seed:int=None, 
+                      pageSize:int=256) -> bool:
+        '''
+            compare a few randomly chosen pages of contents against flash
+            @param seed: (optional) PRNG seed, for reproducible sampling
+            @return: True if all sampled pages match
+        '''
+        flash = self.flash
+        contLen = len(contents)
+        if not contLen:
+            return True 
+        view = memoryview(contents)
+        rng = random.Random(seed)
+        numPages = (contLen + pageSize - 1) // pageSize
+        for page in rng.sample(range(numPages), min(samples, numPages)):
+            offset = page * pageSize 
+            expected = view[offset:offset+pageSize]
+            if flash.read(startAddress + offset, len(expected)) != expected:
+                log.info(f'Sampled verify mismatch @ 0x{startAddress + offset:06x}')
+                return False 
+        return True
+        
+    def attachShadowStore(self, store:ShadowStore):
+        '''
+            keep a host-side mirror of this board's flash in store, updated
+            on every write and erase, and use it to only re-program sectors 
+            that changed.
+        '''
+        flash = self.flash
+        shadow = store.imageFor(self.boardIdentity(), len(flash), flash.get_erase_size())
+        self._flash = ShadowedFlash(flash, shadow)
+        self._shadow = shadow 
+        
+    def attachReadCache(self, budget:int=ReadCacheBudgetDefault) -> SectorReadCache:
+        '''
+            serve repeated reads of a sector from host memory, up to budget 
+            bytes of it, so multi-pass operations only read each sector over 
+            the wire once.  Writes and erases invalidate what they touch.
+            @return: the SectorReadCache, for its hit/miss counters
+        '''
+        if self._readCache is not None:
+            return self._readCache
+        flash = self.flash
+        self._readCache = SectorReadCache(budget, flash.get_erase_size())
+        if self._shadow is not None:
+            # under the shadow, so the shadow's own sample checks are cached too
+            flash._flash = CachedFlash(flash._flash, self._readCache)
+        else:
+            self._flash = CachedFlash(flash, self._readCache)
+        return self._readCache
+    
+    @property 
+    def readCache(self) -> SectorReadCache:
+        return self._readCache 
+        
+    @property 
+    def ftdiSerial(self) -> str:
+        '''
+            serial number and channel of the FTDI device from deviceURI, 
+            e.g. 'TG110925/2'
+        '''
+        uri = self.deviceURI.split('://', 1)[-1]
+        device, _sep, channel = uri.partition('/')
+        serial = device.split(':')[-1]
+        return f'{serial}/{channel}' if channel else serial 
+        
+    def tuneTransport(self, store:TransportProfileStore=None) -> TransportProfile:
+        '''
+            benchmark FTDI transport settings on this adapter and switch to 
+            the best ones
+            @param store: (optional) where to keep the result, under ftdiSerial
+            @return: the chosen TransportProfile
+        '''
+        self.caravelHoldInReset(True)
+        try:
+            self.transportProfile = TransportTuner(self).tune()
+        finally:
+            self.caravelHoldInReset(False)
+        if store is not None:
+            store.put(self.ftdiSerial, self.transportProfile)
+        return self.transportProfile
+    
+    def uploadManifest(self, manifest:WriteManifest, verify:bool=False, 
+               maxRetries:int=VerifyRetriesDefault, verifyBatch:int=1):
+        '''
+            write every image of a manifest in one session: a single merged 
+            erase pass, then programming in address order.  Blank sectors
+            between or around images are erased but not programmed, and 
+            sectors images only partly cover keep the rest of their contents.
+            @param manifest: the WriteManifest to write
+            @param verify: (optional) read back each sector right after programming it
+            @param maxRetries: (optional) number of re-erase/re-program attempts for a bad sector
+            @param verifyBatch: (optional) number of sectors to program before each read back
+        '''
+        flash = self.flash
+        sectorSize = flash.get_erase_size()
+        erasePlan = manifest.erasePlan(sectorSize)
+        planBytes = sum(end - start for start, end in erasePlan)
+        self.caravelHoldInReset(True)
+        preserved = {address: flash.read(address, sectorSize) 
+                        for address in manifest.partialSectors(sectorSize)}
+        with self.progress.phase('erase', planBytes):
+            for start, end in erasePlan:
+                flash.erase(start, end - start)
+                self.progress.advance(end - start)
+        blank = b'\xff' * sectorSize
+        with self.progress.phase('program', planBytes):
+            for start, end in erasePlan:
+                contents = manifest.rangeContents(start, end, preserved)
+                sectorOffsets = [offset for offset in range(0, end - start, sectorSize) 
+                                    if contents[offset:offset+sectorSize] != blank]
+                self._programSectors(contents, start, sectorOffsets, sectorSize, 
+                                     verify, maxRetries, max(1, verifyBatch))
+                # count the blank sectors skipped as done too
+                self.progress.advance((end - start) - len(sectorOffsets) * sectorSize)
         self.caravelHoldInReset(False)
         
+    def uploadStream(self, source:ImageSource, startAddress:int=0, verify:bool=False, 
+               maxRetries:int=VerifyRetriesDefault, eraseWindow:int=StreamEraseWindowDefault, 
+               sectorManifest:SectorManifest=None, differential:bool=False):
+        '''
+            upload an image to flash as it is read (and decompressed).
+            Reading, decompression, hashing and blank page analysis happen on 
+            a worker thread while the device is busy erasing: if the image 
+            size can be known up front, the whole range is erased right away, 
+            otherwise erasing proceeds eraseWindow bytes at a time as the 
+            image comes in.  Only a bounded amount of the image is held in 
+            memory, and blank pages are never programmed.
+            @param source: the ImageSource to stream from
+            @param startAddress: (optional) start address (must be on sector bounds)  
+            @param verify: (optional) read back each window right after programming it
+            @param maxRetries: (optional) number of re-erase/re-program attempts for a bad sector
+            @param eraseWindow: (optional) bytes programmed (and verified) at a time
+            @param sectorManifest: (optional) SectorManifest of the image, giving its size 
+                                    and non-blank pages without scanning it
+            @param differential: (optional) with a sectorManifest, skip sectors that already match
+            @return: number of bytes of flash covered
+        '''
+        flash = self.flash
+        sectorSize = flash.get_erase_size()
+        eraseWindow = max(sectorSize, eraseWindow - eraseWindow % sectorSize)
+        sectorManifest = self._checkSectorManifest(sectorManifest, sectorSize)
+        preparer = ImagePreparer(source, sectorSize, flash.get_size('page'), 
+                                 sectorRuns=sectorManifest.programRuns() if sectorManifest else None)
+        preparer.start()
+        try:
+            self.caravelHoldInReset(True)
+            erasedEnd = 0
+            matching = set()
+            sizeHint = sectorManifest.size if sectorManifest is not None else source.sizeHint
+            if sizeHint:
+                erasedEnd = ((sizeHint + sectorSize - 1) // sectorSize) * sectorSize
+                if sectorManifest is not None and differential:
+                    sectorOffsets = range(0, erasedEnd, sectorSize)
+                    with self.progress.phase('compare', erasedEnd):
+                        matching, erased = self._manifestDiff(sectorManifest, startAddress, 
+                                                              sectorOffsets)
+                    log.info(f'{len(matching)} sectors already match, {len(erased)} need no erase')
+                    eraseOffsets = [offset for offset in sectorOffsets 
+                                        if offset not in matching and offset not in erased]
+                    with self.progress.phase('erase', len(eraseOffsets) * sectorSize):
+                        self._eraseSectors(startAddress, eraseOffsets, sectorSize)
+                else:
+                    with self.progress.phase('erase', erasedEnd):
+                        flash.erase(startAddress, erasedEnd)
+                        self.progress.advance(erasedEnd)
+            with self.progress.phase('write', sizeHint):
+                window = []
+                for prepared in preparer:
+                    if window and prepared[0] % eraseWindow == 0:
+                        erasedEnd = self._flushStreamWindow(window, startAddress, sectorSize, 
+                                                            erasedEnd, verify, maxRetries, matching)
+                        window = []
+                    window.append(prepared)
+                if window:
+                    self._flushStreamWindow(window, startAddress, sectorSize, erasedEnd, 
+                                            verify, maxRetries, matching)
+            self.caravelHoldInReset(False)
+        finally:
+            preparer.cancel()
+        log.info(f'Streamed {source.extent} bytes, sha256 {source.sha256}')
+        if sectorManifest is not None and source.sha256 != sectorManifest.imageHash:
+            raise ValueError(f'{source.filepath} does not match its sector manifest, '
+                             'flash may be incomplete: write it again without the manifest')
+        return source.extent
+    
+    def _flushStreamWindow(self, window:list, startAddress:int, sectorSize:int, 
+                           erasedEnd:int, verify:bool, maxRetries:int, 
+                           skipSectors:Set[int]=frozenset()) -> int:
+        flash = self.flash
+        windowStart = window[0][0]
+        windowEnd = window[-1][0] + sectorSize
+        if windowEnd > erasedEnd:
+            eraseStart = max(windowStart, erasedEnd)
+            flash.erase(startAddress + eraseStart, windowEnd - eraseStart)
+            erasedEnd = windowEnd
+        for offset, data, programRuns in window:
+            self.progress.advance(sectorSize)
+            if data is None or offset in skipSectors:
+                continue
+            for runStart, runEnd in programRuns:
+                flash.write(startAddress + offset + runStart, data[runStart:runEnd])
+        if not verify:
+            return erasedEnd
+        readBack = flash.read(startAddress + windowStart, windowEnd - windowStart)
+        for offset, data, _runs in window:
+            rel = offset - windowStart
+            expected = data if data is not None else b'\xff' * sectorSize
+            if readBack[rel:rel+len(expected)] != expected:
+                self._retrySector(startAddress + offset, expected, maxRetries)
+        return erasedEnd
+        
+    def boardIdentity(self) -> str:
+        '''
+            string identifying the board currently attached: the flash 
+            unique id where the part supports it, otherwise the flash 
+            JEDEC id along with the FTDI serial and channel.
+        '''
+        flash = self.flash
+        if flash.has_feature(SerialFlash.FEAT_UNIQUEID):
+            try:
+                return f'uid-{flash.unique_id:016x}'
+            except (NotImplementedError, SerialFlashError):
+                pass 
+        jedec = SerialFlashManager.read_jedec_id(self._flash_port)
+        return f'{bytes(jedec).hex()}-{self.ftdiSerial}'
+    
+    def _checkResumePoint(self, contents:bytes, startAddress:int, committed:int, sectorSize:int):
+        '''
+            confirm the last sector the journal claims is done actually 
+            is, backing up one sector at a time until one checks out.
+        '''
+        flash = self.flash
+        view = memoryview(contents)
+        while committed > 0:
+            lastSector = committed - sectorSize
+            if flash.read(startAddress + lastSector, sectorSize) == view[lastSector:committed]:
+                return committed
+            log.warning(f'Journaled sector @ 0x{startAddress + lastSector:06x} does not match, redoing')
+            committed = lastSector 
+        return 0
+    
+    def _uploadDifferential(self, contents:bytes, startAddress:int, fromOffset:int, 
+                            sectorSize:int, verify:bool, maxRetries:int, verifyBatch:int, 
+                            journal:SectorJournal=None):
+        '''
+            use the shadow image to only erase and program sectors that differ
+        '''
+        shadow = self._shadow 
+        if not shadow.sampleCheck(self._flash._flash):
+            log.warning('Shadow image is stale, discarding it')
+            shadow.invalidate()
+            
+        dirty = shadow.dirtySectors(contents, startAddress, fromOffset)
+        log.info(f'{len(dirty)} of {(len(contents) - fromOffset) // sectorSize} sectors need programming')
+        needErase = [offset for offset in dirty 
+                        if not shadow.isErased(startAddress + offset, sectorSize)]
+        shadow.beginUpdate(startAddress + offset for offset in dirty)
+        with self.progress.phase('erase', len(needErase) * sectorSize):
+            self._eraseSectors(startAddress, needErase, sectorSize)
+        with self.progress.phase('program', len(dirty) * sectorSize):
+            self._programSectors(contents, startAddress, dirty, sectorSize, 
+                                 verify, maxRetries, verifyBatch, journal)
+        shadow.save()
+        
+    def _eraseSectors(self, startAddress:int, sectorOffsets:Iterable[int], sectorSize:int):
+        '''
+            erase the listed sectors, coalescing contiguous runs so the 
+            device can use its larger erase blocks
+        '''
+        for runStart, runEnd in self._sectorRuns(sectorOffsets, sectorSize):
+            opStart = time.time()
+            self.flash.erase(startAddress + runStart, runEnd - runStart)
+            self.opStats.eraseTimes.append((time.time() - opStart, 
+                                            (runEnd - runStart) // sectorSize))
+            self.progress.advance(runEnd - runStart)
+            
+    @classmethod 
+    def _sectorRuns(cls, sectorOffsets:Iterable[int], sectorSize:int):
+        runStart = None 
+        runEnd = None 
+        for offset in sectorOffsets:
+            if runEnd == offset:
+                runEnd += sectorSize
+                continue
+            if runStart is not None:
+                yield (runStart, runEnd)
+            runStart = offset 
+            runEnd = offset + sectorSize
+        if runStart is not None:
+            yield (runStart, runEnd)
+        
+    def _programSectors(self, contents:bytes, startAddress:int, sectorOffsets:Iterable[int], 
+                        sectorSize:int, verify:bool, maxRetries:int, verifyBatch:int, 
+                        journal:SectorJournal=None, pageRuns:dict=None):
+        '''
+            program the listed sectors of contents one at a time, or only 
+            their non-blank page spans if pageRuns (by sector offset) are given.
+            When verifying, reads back up to verifyBatch contiguous sectors 
+            in a single transfer, and any sector that does not match is 
+            re-erased and re-programmed on its own.  Progress is committed 
+            to the journal and shadow, if any, once a batch is known good.
+        '''
+        flash = self.flash
+        view = memoryview(contents)
+        batchSize = sectorSize * verifyBatch
+        for runStart, runEnd in self._sectorRuns(sectorOffsets, sectorSize):
+            for batchStart in range(runStart, runEnd, batchSize):
+                batchEnd = min(runEnd, batchStart + batchSize)
+                for offset in range(batchStart, batchEnd, sectorSize):
+                    opStart = time.time()
+                    if pageRuns is None:
+                        flash.write(startAddress + offset, view[offset:offset+sectorSize])
+                    else:
+                        for pageStart, pageEnd in pageRuns[offset]:
+                            flash.write(startAddress + offset + pageStart, 
+                                        view[offset+pageStart:offset+pageEnd])
+                    self.opStats.programTimes.append(time.time() - opStart)
+                    self.progress.advance(sectorSize)
+                    if journal is not None and not verify:
+                        journal.commit(offset + sectorSize)
+                    if self._shadow is not None and not verify:
+                        self._shadow.commit(startAddress + offset, sectorSize)
+                    
+                if not verify:
+                    continue
+                
+                readBack = flash.read(startAddress + batchStart, batchEnd - batchStart)
+                for offset in range(batchStart, batchEnd, sectorSize):
+                    rel = offset - batchStart
+                    if readBack[rel:rel+sectorSize] != view[offset:offset+sectorSize]:
+                        self._retrySector(startAddress + offset, 
+                                          view[offset:offset+sectorSize], maxRetries)
+                if journal is not None:
+                    journal.commit(batchEnd)
+                if self._shadow is not None:
+                    self._shadow.commit(startAddress + batchStart, batchEnd - batchStart)
+                    
+    def _retrySector(self, address:int, sectorData:bytes, maxRetries:int):
+        flash = self.flash
+        sectorLen = len(sectorData)
+        eraseSize = flash.get_erase_size()
+        eraseLen = ((sectorLen + eraseSize - 1) // eraseSize) * eraseSize
+        for attempt in range(1, maxRetries + 1):
+            self.opStats.verifyRetries += 1
+            log.warning(f'Verify failed for sector @ 0x{address:06x}, retry {attempt}/{maxRetries}')
+            flash.erase(address, eraseLen)
+            flash.write(address, sectorData)
+            if flash.read(address, sectorLen) == sectorData:
+                return 
+            
+        raise FlashVerifyError(f'Sector @ 0x{address:06x} failed verify after {maxRetries} retries')
+        
     def read(self, size:int, startAddress:int=0):
         self.caravelHoldInReset(True)
-        contents = self.flash.read(startAddress, size)
+        if self.progress.sink is None:
+            contents = self.flash.read(startAddress, size)
+        else:
+            # in pieces, to report on the way
+            contents = bytearray()
+            with self.progress.phase('read', size):
+                for offset in range(0, size, SparseReadChunkSize):
+                    contents.extend(self.flash.read(startAddress + offset, 
+                                                    min(SparseReadChunkSize, size - offset)))
+                    self.progress.advance(min(SparseReadChunkSize, size - offset))
+            contents = bytes(contents)
         self.caravelHoldInReset(False)
         return contents 
     
+    def readRanges(self, ranges:List[Tuple[int, int]], 
+                   coalesceGap:int=ReadCoalesceGapDefault) -> List[bytes]:
+        '''
+            read several ranges of flash in one session, in address order.  
+            Ranges closer than coalesceGap bytes are fetched in a single read.
+            @param ranges: (address, size) pairs
+            @param coalesceGap: (optional) largest gap to read through to merge ranges
+            @return: the contents of each range, in the order given
+        '''
+        results = [None] * len(ranges)
+        order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+        merged = [] # [start, end, [indices]]
+        for idx in order:
+            address, size = ranges[idx]
+            if merged and address <= merged[-1][1] + coalesceGap:
+                merged[-1][1] = max(merged[-1][1], address + size)
+                merged[-1][2].append(idx)
+            else:
+                merged.append([address, address + size, [idx]])
+                
+        self.caravelHoldInReset(True)
+        for start, end, indices in merged:
+            data = self.flash.read(start, end - start)
+            for idx in indices:
+                address, size = ranges[idx]
+                results[idx] = data[address - start:address - start + size]
+        self.caravelHoldInReset(False)
+        return results 
+    
+    def readToSparseFile(self, filepath:str, size:int, startAddress:int=0):
+        '''
+            dump flash to a sparse file, erased blocks left as holes
+            @return: number of non-blank bytes stored
+        '''
+        writer = SparseDumpWriter(filepath, startAddress=startAddress)
+        self.caravelHoldInReset(True)
+        with self.progress.phase('read', size):
+            for offset in range(0, size, SparseReadChunkSize):
+                chunkLen = min(SparseReadChunkSize, size - offset)
+                writer.write(offset, self.flash.read(startAddress + offset, chunkLen))
+                self.progress.advance(chunkLen)
+        self.caravelHoldInReset(False)
+        writer.close(size)
+        log.info(f'Sparse dump {filepath} of {size} bytes holds {writer.dataBytes} bytes of data')
+        return writer.dataBytes
+    
+    def readRangesToSparseFile(self, filepath:str, ranges:List[Tuple[int, int]]):
+        '''
+            read ranges in a single session and store them at their 
+            addresses in a sparse dump, everything else left as holes
+            @return: number of non-blank bytes stored
+        '''
+        ranges = sorted(ranges)
+        writer = SparseDumpWriter(filepath)
+        for (address, _size), data in zip(ranges, self.readRanges(ranges)):
+            writer.write(address, data)
+        writer.close(max(address + size for address, size in ranges))
+        return writer.dataBytes
+    
+    def backup(self, store:BackupStore, size:int, startAddress:int=0, label:str=None) -> str:
+        '''
+            back up flash to a deduplicated store, sector by sector, 
+            under this board's identity
+            @param label: (optional) name for this backup [timestamp]
+            @return: path to the backup manifest
+        '''
+        self.caravelHoldInReset(True)
+        flash = self.flash 
+        sectorSize = flash.get_erase_size()
+        boardId = self.boardIdentity()
+        sectors = []
+        with self.progress.phase('backup', size):
+            for offset in range(0, size, BackupWindowSize):
+                data = flash.read(startAddress + offset, min(BackupWindowSize, size - offset))
+                view = memoryview(data)
+                for pos in range(0, len(data), sectorSize):
+                    sectors.append(store.putSector(bytes(view[pos:pos+sectorSize])))
+                self.progress.advance(len(data))
+        self.caravelHoldInReset(False)
+        
+        manifest = BackupManifest(boardId, label or time.strftime('%Y%m%d-%H%M%S'), 
+                                  startAddress, size, sectorSize, sectors)
+        log.info(f'Backup {manifest}, {store.sectorsAdded} new sectors stored')
+        return store.saveManifest(manifest)
+    
+    def restore(self, store:BackupStore, manifest:BackupManifest, verify:bool=False, 
+                maxRetries:int=VerifyRetriesDefault) -> Tuple[int, int]:
+        '''
+            write a backup back to flash, a window at a time, only erasing 
+            and programming sectors that differ from what the device holds
+            @return: (sectors written, sectors skipped)
+        '''
+        self.caravelHoldInReset(True)
+        flash = self.flash 
+        sectorSize = manifest.sectorSize
+        if sectorSize % flash.get_erase_size():
+            raise ValueError(f'Backup sector size {sectorSize} does not suit this flash')
+        startAddress = manifest.startAddress
+        numWritten = 0
+        numSkipped = 0
+        windowSize = max(BackupWindowSize, sectorSize)
+        with self.progress.phase('restore', manifest.size):
+            for offset, expected in store.windows(manifest, windowSize):
+                current = flash.read(startAddress + offset, len(expected))
+                needErase = []
+                needProgram = []
+                for pos in range(0, len(expected), sectorSize):
+                    want = expected[pos:pos+sectorSize]
+                    have = current[pos:pos+sectorSize]
+                    if want == have:
+                        numSkipped += 1
+                        continue
+                    numWritten += 1
+                    if have.count(0xff) != len(have):
+                        needErase.append(pos)
+                    if want.count(0xff) != len(want):
+                        # blank sectors only needed the erase
+                        needProgram.append(pos)
+                with self.progress.suspended():
+                    self._eraseSectors(startAddress + offset, needErase, sectorSize)
+                    self._programSectors(expected, startAddress + offset, needProgram, sectorSize, 
+                                         verify, maxRetries, 1)
+                self.progress.advance(len(expected))
+        self.caravelHoldInReset(False)
+        return (numWritten, numSkipped)
+        
+    def probeBoot(self, timeout:float=BootProbeTimeoutDefault) -> float:
+        '''
+            reset the board and time its firmware to ready, which also 
+            confirms it boots at all.  Raises BootProbeTimeout if it never is.
+            @return: seconds from reset release to ready (also in opStats.bootLatency)
+        '''
+        probe = BootProbe(self.spi_port, self.caravelHoldInReset, timeout)
+        self.opStats.bootLatency = probe.measure()
+        log.info(f'Firmware ready after {self.opStats.bootLatency*1000:.1f}ms ({probe.polls} polls)')
+        return self.opStats.bootLatency
+    
+    def fastVerify(self, contents:bytes, startAddress:int=0, 
+                   timeout:float=FirmwareCRCTimeoutDefault, segmentSize:int=None) -> bool:
+        '''
+            check contents against flash using a CRC32 worked out by the 
+            management core firmware, instead of reading it all back.
+            Raises FirmwareChecksumUnavailable if the firmware does not answer.
+            @param startAddress: (optional) where contents are, on a 4k boundary
+            @param segmentSize: (optional) check in segments of this size, 
+                                stopping at the first bad one [all in one]
+            @return: True if flash matches
+        '''
+        length = len(contents)
+        padded = -(-length // FirmwareCRCSectorSize) * FirmwareCRCSectorSize
+        image = contents 
+        if padded > length:
+            # the rest of the last sector is not part of the image, take it as is
+            image = bytes(contents) + self.read(padded - length, startAddress + length)
+        if not segmentSize:
+            segmentSize = padded 
+        segmentSize = -(-segmentSize // FirmwareCRCSectorSize) * FirmwareCRCSectorSize
+        view = memoryview(image)
+        checker = FirmwareChecksum(self.spi_port, self.caravelHoldInReset, timeout)
+        with self.progress.phase('verify', padded):
+            for offset in range(0, padded, segmentSize):
+                segment = view[offset:offset+segmentSize]
+                actual = checker.crc32(startAddress + offset, len(segment))
+                expected = zlib.crc32(segment)
+                self.progress.advance(len(segment))
+                log.info(f'Flash CRC32 @ 0x{startAddress + offset:06x} {actual:08x}, expected {expected:08x}')
+                if actual != expected:
+                    return False 
+        return True
+    
+    def verifyPlanner(self) -> VerifyPlanner:
+        '''
+            time and confidence estimates for the verify tiers on this board
+        '''
+        return VerifyPlanner(self.spi_port.frequency, self.transportProfile)
+    
+    def verifyImage(self, contents:bytes, startAddress:int=0, mode:str='full', 
+                    samples:int=None, seed:int=None, 
+                    segmentSize:int=VerifySegmentSizeDefault) -> bool:
+        '''
+            check contents against flash, recording the tier used, its estimate 
+            and how long it actually took in opStats
+            @param mode: (optional) a verify tier, 'none', 'sampled', 'hash' or 'full' 
+                          (see verify_tiers), or 'fast' for a single firmware checksum.
+                          Firmware checksums fall back to full if unavailable.
+            @param samples: (optional) pages to compare, for sampled [enough for VerifyConfidenceDefault]
+            @param seed: (optional) sampling PRNG seed [random, kept in opStats.verifySeed]
+            @param segmentSize: (optional) bytes per checksum, for hash
+            @return: True if flash matches (always, for none)
+        '''
+        stats = self.opStats 
+        tier = VerifyTierHash if mode == 'fast' else mode
+        if tier not in VerifyTiers:
+            raise ValueError(f'Unknown verify mode {mode}')
+        if mode == 'fast':
+            segmentSize = None 
+        planner = self.verifyPlanner()
+        startTime = time.time()
+        ok = True 
+        stats.verifySeed = None 
+        if samples is None:
+            samples = VerifyPlanner.samplesFor(len(contents), VerifyConfidenceDefault)
+        if tier == VerifyTierSampled:
+            if seed is None:
+                seed = random.randrange(1 << 32)
+            stats.verifySeed = seed 
+            self.caravelHoldInReset(True)
+            ok = self.sampledVerify(contents, startAddress, samples, seed)
+            self.caravelHoldInReset(False)
+        elif tier == VerifyTierHash:
+            try:
+                ok = self.fastVerify(contents, startAddress, segmentSize=segmentSize)
+            except FirmwareChecksumUnavailable as e:
+                log.warning(f'{e}, falling back to full verify')
+                tier = VerifyTierFull 
+        if tier == VerifyTierFull:
+            ok = self.read(len(contents), startAddress) == contents
+        stats.verifyTier = tier 
+        stats.verifyEstimate = planner.estimate(tier, len(contents), samples, 
+                                                segmentSize or len(contents))
+        stats.verifySeconds = time.time() - startTime 
+        stats.verifyOk = ok 
+        return ok 
+    
+    def compare(self, source:ImageSource, startAddress:int=0, 
+                chunkSize:int=CompareChunkSizeDefault, stopAtFirst:bool=False) -> CompareResult:
+        '''
+            compare an image against flash without writing anything, 
+            streaming both side by side so memory use stays bounded.
+            @param stopAtFirst: (optional) stop at the first mismatching chunk
+            @return: CompareResult with the mismatching ranges and first differing bytes
+        '''
+        self.caravelHoldInReset(True)
+        try:
+            with self.progress.phase('compare', source.sizeHint):
+                return compareStream(self.flash, source, startAddress, chunkSize, stopAtFirst, 
+                                     self.progress)
+        finally:
+            self.caravelHoldInReset(False)
+    
     def readToFile(self, filepath:str, size:int, startAddress:int=0):
         contents = self.read(size, startAddress)
+        if os.path.exists(sparseMapPath(filepath)):
+            # plain dump now, drop the stale sparse map
+            os.remove(sparseMapPath(filepath))
         with open(filepath, 'wb') as file:
             file.write(contents)
             log.info(f'File {filepath} written with {len(contents)} bytes.')
@@ -158,15 +1003,93 @@ def getArgParser():
     parser.add_argument("--read", type=str,
                         required=False,
                     help="read and dump flash to this file")
+    parser.add_argument("--sparse", action='store_true',
+                        required=False,
+                    help="make the --read dump a sparse file, erased blocks left as holes (see .map sidecar)")
+    parser.add_argument("--ranges", type=str,
+                        required=False,
+                    help="comma separated ADDRESS:SIZE ranges to --read, in one pass, into a sparse dump")
     parser.add_argument("--size", type=int,
                         required=False,
                     help="size of flash to fetch for read (defaults to --write file size if doing that)")
     parser.add_argument("--write", type=str,
                         required=False,
-                    help="write this file to flash")
+                    help="write this file (raw binary or .hex, optionally .gz/.xz/.zst compressed) to flash")
+    parser.add_argument("--manifest", type=str,
+                        required=False,
+                    help="write all the images listed in this JSON manifest, in one session")
+    parser.add_argument("--backup", type=str,
+                        required=False,
+                    help="back up flash (--size bytes, whole flash by default) into this deduplicated store directory")
+    parser.add_argument("--backup-label", type=str,
+                        required=False,
+                    help="name for the --backup [timestamp]")
+    parser.add_argument("--restore", type=str,
+                        required=False,
+                    help="restore this backup manifest (STORE/boards/BOARD/LABEL.json), writing only sectors that differ")
+    parser.add_argument("--compare", type=str,
+                        required=False,
+                    help="compare flash against this file (after any write), reporting mismatching ranges; exits 1 on any mismatch")
+    parser.add_argument("--stop-on-mismatch", action='store_true',
+                        required=False,
+                    help="stop --compare at the first mismatch")
+    parser.add_argument("--inline-verify", action='store_true',
+                        required=False,
+                    help="read back each sector right after writing it, re-programming bad sectors")
+    parser.add_argument("--verify", type=str, choices=list(VerifyTiers) + ['fast'],
+                        required=False,
+                    help="after writing, check flash: not at all (none), on random pages (sampled), with firmware CRCs per segment (hash) or of the whole image (fast), or by reading it all back (full)")
+    parser.add_argument("--verify-samples", type=int,
+                        required=False,
+                    help="pages compared by a sampled verify [enough for --verify-confidence]")
+    parser.add_argument("--verify-confidence", type=float, default=VerifyConfidenceDefault,
+                        required=False,
+                    help=f"unless --verify-samples is given, sample enough pages to catch a damaged sector with this probability (0-1) [{VerifyConfidenceDefault}]")
+    parser.add_argument("--verify-seed", type=int,
+                        required=False,
+                    help="seed for the pages a sampled verify picks, to reproduce a run [random]")
+    parser.add_argument("--verify-plan", action='store_true',
+                        required=False,
+                    help="print the estimated time and confidence of each verify tier for the image")
+    parser.add_argument("--boot-probe", action='store_true',
+                        required=False,
+                    help="once done, reset the board and time its firmware to ready")
+    parser.add_argument("--retries", type=int, default=VerifyRetriesDefault,
+                        required=False,
+                    help=f"number of retries for a sector failing inline verify [{VerifyRetriesDefault}]")
+    parser.add_argument("--verify-batch", type=int, default=1,
+                        required=False,
+                    help="number of sectors to program between inline verify reads [1]")
+    parser.add_argument("--journal", type=str, nargs='?', const=JournalFileDefault,
+                        required=False,
+                    help=f"record write progress in this journal file, resuming interrupted writes [{JournalFileDefault}]")
+    parser.add_argument("--differential", action='store_true',
+                        required=False,
+                    help="only erase and program sectors that differ on flash, going by the image's sector manifest")
+    parser.add_argument("--shadow", type=str,
+                        required=False,
+                    help="keep a per-board mirror of flash in this directory and only write changed sectors")
+    parser.add_argument("--read-cache", type=int, nargs='?', const=ReadCacheBudgetDefault//1024,
+                        required=False,
+                    help=f"cache sectors read from flash in up to this many KiB of memory, so each is read once [{ReadCacheBudgetDefault//1024}]")
+    parser.add_argument("--tag", type=str, nargs='?', const='',
+                        required=False,
+                    help="tag the written image (with optional version string) and skip writing if the tag says it is already there")
+    parser.add_argument("--tag-address", type=int,
+                        required=False,
+                    help="location of the image tag [last flash sector]")
+    parser.add_argument("--transport", type=str, nargs='?', const=TransportProfileFileDefault,
+                        required=False,
+                    help=f"use the FTDI transport settings tuned for this adapter, from this file [{TransportProfileFileDefault}]")
+    parser.add_argument("--tune-transport", action='store_true',
+                        required=False,
+                    help="benchmark FTDI latency timer, chunk sizes and /CS hold on this adapter and save the best to the --transport file")
     parser.add_argument("--address", type=int, default=0,
                         required=False,
                     help="start address [0]")
+    parser.add_argument("--progress", type=str, choices=['bar', 'json', 'silent'],
+                        required=False,
+                    help="progress output on stderr: a progress bar, JSON lines events or nothing [bar on a terminal, else silent]")
     parser.add_argument("--uri", type=str, default=FTDIDeviceURIDefault,
                         required=False,
                     help=f"FTDI device URI [{FTDIDeviceURIDefault}]")
@@ -183,13 +1106,15 @@ def getArguments(parser=None):
 
 def argumentsValid(args):
     if args.read:
-        if not args.write:
+        if not args.write and not args.ranges:
             if not args.size:
                 log.error('Must provide --size for reads')
                 return False
             
             
-    if args.read or args.write or args.capacity or args.list:
+    if args.read or args.write or args.manifest or args.compare \
+        or args.backup or args.restore or args.capacity or args.list \
+        or args.tune_transport:
         return True 
 
     
@@ -216,11 +1141,28 @@ def main():
     
     flashUtil = FlashUtil()
     flashUtil.deviceURI = args.uri
+    transportStore = None 
+    if args.transport or args.tune_transport:
+        transportStore = TransportProfileStore(args.transport or TransportProfileFileDefault)
+        flashUtil.transportProfile = transportStore.get(flashUtil.ftdiSerial)
+        if flashUtil.transportProfile is not None:
+            log.info(f'Transport settings for {flashUtil.ftdiSerial}: {flashUtil.transportProfile}')
     
     if flashUtil.flash is None:
         print(f"\n\nCould not access FTDI device {flashUtil.deviceURI}\n\n")
         return
     
+    flashUtil.progress.sink = progressSink(args.progress or ('bar' if sys.stderr.isatty() else 'silent'))
+    if args.shadow:
+        flashUtil.attachShadowStore(ShadowStore(args.shadow))
+    if args.read_cache:
+        flashUtil.attachReadCache(args.read_cache*1024)
+        
+    if args.tune_transport:
+        print(f"Tuning FTDI transport for {flashUtil.ftdiSerial}")
+        profile = flashUtil.tuneTransport(transportStore)
+        print(f"Using {profile}, saved to {transportStore.filepath}")
+        
     if args.capacity:
         flashUtil.caravelHoldInReset(True)
         capacity = flashUtil.flash.get_capacity()
@@ -228,22 +1170,128 @@ def main():
         print(capacity)
         flashUtil.caravelHoldInReset(False)
         
+    writeContents = None 
+    streamWrite = False 
+    sectorManifest = None 
     if args.write:
-        writeContents = flashUtil.getFileContents(args.write)
+        writeSource = ImageSource(args.write)
+        sectorManifest = SectorManifest.forImage(args.write)
+        if sectorManifest is not None:
+            log.info(f'Sector manifest: {sectorManifest}')
+        elif args.differential:
+            print(f"No sector manifest for {args.write}, building one")
+            sectorManifest = SectorManifest.build(ImageSource(args.write), 
+                                                  flashUtil.flash.get_erase_size())
+        streamWrite = not (args.read and not args.size and not args.ranges) \
+                        and args.journal is None and args.tag is None and not args.shadow
+        if not streamWrite:
+            writeContents = flashUtil.getFileContents(args.write)
         
-    if args.read:
+    if args.read and args.ranges:
+        ranges = [tuple(int(v, 0) for v in spec.split(':')) for spec in args.ranges.split(',')]
+        print(f"Reading {len(ranges)} ranges from flash, dump to {args.read}")
+        flashUtil.readRangesToSparseFile(args.read, ranges)
+    elif args.read:
         if args.size:
             size = args.size 
         else:
             size = len(writeContents) 
         
         print(f"Reading {size} bytes from flash starting at {args.address}, dump to {args.read}")
-        flashUtil.readToFile(args.read, size, args.address)
+        if args.sparse:
+            flashUtil.readToSparseFile(args.read, size, args.address)
+        else:
+            flashUtil.readToFile(args.read, size, args.address)
         
-    if args.write:
-        print(f"Writing {len(writeContents)} to flash starting at {args.address}")
-        flashUtil.upload(writeContents, args.address)
+    if args.backup:
+        size = args.size or len(flashUtil.flash)
+        print(f"Backing up {size} bytes of flash starting at {args.address} to {args.backup}")
+        store = BackupStore(args.backup)
+        manifestPath = flashUtil.backup(store, size, args.address, args.backup_label)
+        print(f"Backup {manifestPath}: {store.sectorsAdded} new sectors, {store.sectorsDeduped} already stored")
+        
+    if args.restore:
+        backup = BackupManifest.load(args.restore)
+        print(f"Restoring {backup}")
+        written, skipped = flashUtil.restore(BackupStore.forManifest(args.restore), backup, 
+                                             verify=args.inline_verify, maxRetries=args.retries)
+        print(f"Restored {written} sectors, {skipped} already matched")
+        
+    if args.manifest:
+        manifest = WriteManifest.load(args.manifest)
+        for entry in manifest.entries:
+            print(f"Writing {entry}")
+        flashUtil.uploadManifest(manifest, verify=args.inline_verify, 
+                                 maxRetries=args.retries, verifyBatch=args.verify_batch)
+        
+    if streamWrite:
+        print(f"Writing {args.write} to flash starting at {args.address}")
+        numBytes = flashUtil.uploadStream(writeSource, args.address, verify=args.inline_verify, 
+                                          maxRetries=args.retries, sectorManifest=sectorManifest, 
+                                          differential=args.differential)
+        print(f"Wrote {numBytes} bytes")
+        
+    if writeContents is not None:
+        flashUtil.tagAddress = args.tag_address
+        if args.tag is not None and flashUtil.isUpToDate(writeContents, args.address):
+            print("Flash already up to date, skipping write")
+        else:
+            print(f"Writing {len(writeContents)} to flash starting at {args.address}")
+            journal = None 
+            if args.journal:
+                journal = SectorJournal(args.journal)
+            flashUtil.upload(writeContents, args.address, verify=args.inline_verify, 
+                             maxRetries=args.retries, verifyBatch=args.verify_batch, 
+                             journal=journal, tagVersion=args.tag, 
+                             sectorManifest=sectorManifest, differential=args.differential)
+        
+    verifySamples = args.verify_samples
+    if args.write and (args.verify or args.verify_plan):
+        contents = writeContents if writeContents is not None else writeSource.read()
+        if verifySamples is None:
+            verifySamples = VerifyPlanner.samplesFor(len(contents), args.verify_confidence)
+        if args.verify_plan:
+            for estimate in flashUtil.verifyPlanner().estimates(len(contents), verifySamples):
+                print(estimate)
+        
+    exitStatus = 0
+    if args.verify == VerifyTierNone and args.write:
+        print(f"{args.write} written, not verified")
+    elif args.verify and args.write:
+        print(f"Verifying {args.write} ({args.verify})")
+        ok = flashUtil.verifyImage(contents, args.address, args.verify, 
+                                   samples=verifySamples, seed=args.verify_seed)
+        stats = flashUtil.opStats
+        if stats.verifyTier == VerifyTierSampled:
+            print(f"Sampled with seed {stats.verifySeed}")
+        print(f"{stats.verifyTier} verify took {stats.verifySeconds:.2f}s "
+              f"(estimated {stats.verifyEstimate.seconds:.2f}s)")
+        if ok:
+            print("Verify OK")
+        else:
+            print("Verify FAILED: flash does not match")
+            exitStatus = 1
+        
+    if args.compare:
+        print(f"Comparing {args.compare} to flash starting at {args.address}")
+        result = flashUtil.compare(ImageSource(args.compare), args.address, 
+                                   stopAtFirst=args.stop_on_mismatch)
+        for line in result.report():
+            print(line)
+        if not result.ok:
+            exitStatus = 1
+            
+    if flashUtil.readCache is not None:
+        print(f"Read cache: {flashUtil.readCache}")
+            
+    if args.boot_probe:
+        try:
+            latency = flashUtil.probeBoot()
+            print(f"Firmware ready {latency*1000:.1f}ms after reset release")
+        except BootProbeTimeout as e:
+            print(f"Boot probe FAILED: {e}")
+    return exitStatus
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
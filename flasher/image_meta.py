@@ -0,0 +1,72 @@
+'''
+On-flash image metadata record.
+
+A small tag stored at a reserved flash location describing the image
+last programmed: its hash, location, size, a version string and when
+it was written.  Reading it back lets a station skip boards that are
+already up to date.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import binascii
+import hashlib
+import struct
+import time
+
+class ImageMetadata:
+    Magic = b'TTIM'
+    FormatVersion = 1
+    # magic, format version, reserved, sha256, start, size, timestamp, version, crc32
+    Layout = struct.Struct('<4sHH32sIIQ16sI')
+    Size = Layout.size
+
+    def __init__(self, imageHash:bytes, startAddress:int, size:int,
+                 version:str='', timestamp:int=None):
+        self.imageHash = imageHash
+        self.startAddress = startAddress
+        self.size = size
+        self.version = version
+        self.timestamp = int(time.time()) if timestamp is None else timestamp
+
+    @classmethod
+    def hashContents(cls, contents:bytes) -> bytes:
+        return hashlib.sha256(contents).digest()
+
+    @classmethod
+    def forContents(cls, contents:bytes, startAddress:int, version:str=''):
+        return cls(cls.hashContents(contents), startAddress, len(contents), version)
+
+    def matches(self, contents:bytes, startAddress:int) -> bool:
+        return self.startAddress == startAddress and \
+                self.size == len(contents) and \
+                self.imageHash == self.hashContents(contents)
+
+    def pack(self) -> bytes:
+        version = self.version.encode('utf-8')[:16]
+        body = self.Layout.pack(self.Magic, self.FormatVersion, 0, self.imageHash,
+                                self.startAddress, self.size, self.timestamp,
+                                version, 0)
+        crc = binascii.crc32(body[:-4])
+        return body[:-4] + struct.pack('<I', crc)
+
+    @classmethod
+    def unpack(cls, raw:bytes):
+        '''
+            @return: an ImageMetadata, or None if raw does not hold a valid record
+        '''
+        if len(raw) < cls.Size:
+            return None
+        raw = bytes(raw[:cls.Size])
+        (magic, fmtVersion, _reserved, imageHash, startAddress, size,
+            timestamp, version, crc) = cls.Layout.unpack(raw)
+        if magic != cls.Magic or fmtVersion != cls.FormatVersion:
+            return None
+        if binascii.crc32(raw[:-4]) != crc:
+            return None
+        return cls(imageHash, startAddress, size,
+                   version.rstrip(b'\x00').decode('utf-8', 'replace'), timestamp)
+
+    def __str__(self):
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.timestamp))
+        return f'{self.version or "(no version)"} {self.size} bytes @ 0x{self.startAddress:06x} ' \
+               f'sha256 {self.imageHash.hex()[:16]} written {stamp}'
@@ -0,0 +1,312 @@
+'''
+Firmware image sources.
+
+Reads raw binary or verilog-style .hex images, optionally gzip, xz or
+zstd compressed, as well as sparse flash dumps, as a stream of fixed size chunks so that large or
+sparse images never need to be fully expanded in memory.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import gzip
+import hashlib
+import lzma
+import logging
+import os
+import queue
+import threading
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from sparse_dump import readSparseMap
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+GzipMagic = b'\x1f\x8b'
+XzMagic = b'\xfd7zXZ\x00'
+ZstdMagic = b'\x28\xb5\x2f\xfd'
+CompressedExtensions = ('.gz', '.xz', '.zst')
+ReadBlockSize = 64*1024
+PrepareQueueDepth = 64
+
+class ImageSource:
+    '''
+        A firmware image on disk.  Use chunks() to stream it, or read()
+        to get it all in memory.
+    '''
+    def __init__(self, filepath:str):
+        self.filepath = filepath
+        # both known once fully streamed
+        self.extent = None
+        self.sha256 = None
+
+    @property
+    def isCompressed(self) -> bool:
+        with open(self.filepath, 'rb') as f:
+            magic = f.read(len(XzMagic))
+        return magic.startswith(GzipMagic) or magic.startswith(XzMagic) or \
+                magic.startswith(ZstdMagic)
+
+    @property
+    def isVerilogHex(self) -> bool:
+        name = self.filepath.lower()
+        for ext in CompressedExtensions:
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        return name.endswith('.hex')
+
+    @property
+    def sizeHint(self) -> Optional[int]:
+        '''
+            expanded size of the image, if it can be had without reading
+            through it, otherwise None
+        '''
+        if self.isVerilogHex:
+            return None
+        with open(self.filepath, 'rb') as f:
+            magic = f.read(len(XzMagic))
+            if magic.startswith(GzipMagic):
+                # ISIZE trailer, size of the (last) member mod 2^32
+                f.seek(-4, os.SEEK_END)
+                return int.from_bytes(f.read(4), 'little')
+            if magic.startswith(ZstdMagic):
+                if zstandard is None:
+                    return None
+                f.seek(0)
+                size = zstandard.frame_content_size(f.read(18))
+                return size if size >= 0 else None
+            if magic.startswith(XzMagic):
+                return None
+        return os.path.getsize(self.filepath)
+
+    def open(self) -> BinaryIO:
+        '''
+            open the image, transparently decompressing it
+        '''
+        f = open(self.filepath, 'rb')
+        magic = f.read(len(XzMagic))
+        f.seek(0)
+        if magic.startswith(GzipMagic):
+            return gzip.GzipFile(fileobj=f, mode='rb')
+        if magic.startswith(XzMagic):
+            return lzma.LZMAFile(f, mode='rb')
+        if magic.startswith(ZstdMagic):
+            if zstandard is None:
+                f.close()
+                raise RuntimeError('zstd compressed images need the zstandard package (pip install zstandard)')
+            return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        return f
+
+    def segments(self) -> Iterator[Tuple[int, bytes]]:
+        '''
+            iterate over (offset, data) pieces of the image, in address order
+        '''
+        if self.isVerilogHex:
+            yield from self._hexSegments()
+            return
+        sparseMap = readSparseMap(self.filepath)
+        if sparseMap is not None and not self.isCompressed:
+            yield from self._sparseSegments(*sparseMap)
+            return
+        offset = 0
+        with self.open() as f:
+            while True:
+                data = f.read(ReadBlockSize)
+                if not data:
+                    break
+                yield (offset, data)
+                offset += len(data)
+
+    def _sparseSegments(self, size:int, extents:list) -> Iterator[Tuple[int, bytes]]:
+        with open(self.filepath, 'rb') as f:
+            for offset, length in extents:
+                f.seek(offset)
+                yield (offset, f.read(length))
+        # empty trailing piece, so the image spans the whole dump
+        yield (size, b'')
+
+    def _hexSegments(self) -> Iterator[Tuple[int, bytes]]:
+        address = 0
+        buf = bytearray()
+        with self.open() as f:
+            for line in self._readLines(f):
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith(b'@'):
+                    if buf:
+                        yield (address, bytes(buf))
+                        address += len(buf)
+                        buf = bytearray()
+                    address = int(line[1:], 16)
+                    continue
+                buf.extend(bytes.fromhex(line.decode('ascii')))
+                if len(buf) >= ReadBlockSize:
+                    yield (address, bytes(buf))
+                    address += len(buf)
+                    buf = bytearray()
+        if buf:
+            yield (address, bytes(buf))
+
+    @classmethod
+    def _readLines(cls, f:BinaryIO) -> Iterator[bytes]:
+        '''
+            split lines out of fixed size reads: decompressing readers, like
+            zstandard's, do not all support readline() or iteration
+        '''
+        pending = b''
+        while True:
+            data = f.read(ReadBlockSize)
+            if not data:
+                break
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+    def chunks(self, chunkSize:int) -> Iterator[Tuple[int, Optional[bytes]]]:
+        '''
+            iterate over consecutive chunkSize aligned pieces of the image,
+            starting at offset 0.  Pieces that are entirely blank (0xFF),
+            including gaps in sparse images, are yielded as (offset, None)
+            without being built in memory.  The final piece may be short.
+        '''
+        for offset, data in self._chunks(chunkSize):
+            self._hash.update(data if data is not None else self._blank)
+            yield (offset, data)
+        self.sha256 = self._hash.hexdigest()
+
+    def _chunks(self, chunkSize:int) -> Iterator[Tuple[int, Optional[bytes]]]:
+        blank = b'\xff' * chunkSize
+        self._blank = blank
+        self._hash = hashlib.sha256()
+        buf = bytearray()
+        bufStart = 0
+        for offset, data in self.segments():
+            bufEnd = bufStart + len(buf)
+            if offset < bufEnd:
+                raise ValueError(f'{self.filepath}: data at 0x{offset:06x} overlaps or is out of order')
+            gap = offset - bufEnd
+            if gap and buf:
+                # finish off the partial chunk as blank
+                fill = min(gap, chunkSize - len(buf))
+                buf.extend(blank[:fill])
+                gap -= fill
+                if len(buf) == chunkSize:
+                    yield (bufStart, self._chunkOrBlank(buf, blank))
+                    bufStart += chunkSize
+                    buf.clear()
+            while gap >= chunkSize:
+                yield (bufStart, None)
+                bufStart += chunkSize
+                gap -= chunkSize
+            buf.extend(blank[:gap])
+            buf.extend(data)
+            
+            numFull = len(buf) // chunkSize
+            for pos in range(0, numFull * chunkSize, chunkSize):
+                yield (bufStart + pos, self._chunkOrBlank(buf[pos:pos+chunkSize], blank))
+            del buf[:numFull * chunkSize]
+            bufStart += numFull * chunkSize
+        if buf:
+            self._blank = blank[:len(buf)]
+            yield (bufStart, self._chunkOrBlank(buf, self._blank))
+        self.extent = bufStart + len(buf)
+
+    @classmethod
+    def _chunkOrBlank(cls, chunk:bytearray, blank:bytes) -> Optional[bytes]:
+        if chunk == blank:
+            return None
+        return bytes(chunk)
+
+    def read(self) -> bytes:
+        '''
+            the whole image, with any gaps filled as blank (0xFF)
+        '''
+        contents = bytearray()
+        for offset, data in self.segments():
+            if offset < len(contents):
+                raise ValueError(f'{self.filepath}: data at 0x{offset:06x} overlaps or is out of order')
+            contents.extend(b'\xff' * (offset - len(contents)))
+            contents.extend(data)
+        self.extent = len(contents)
+        return bytes(contents)
+
+
+class ImagePreparer(threading.Thread):
+    '''
+        Worker thread that reads, decompresses, hashes and analyses an image
+        ahead of the programming loop, handing over prepared sectors through
+        a bounded queue.  Iterate over it to get (offset, data, programRuns)
+        tuples, where programRuns lists the (start, end) spans of data that 
+        hold non-blank pages.  data and programRuns are None for blank 
+        sectors.  Given sectorRuns (from a SectorManifest), pages are 
+        not scanned.
+    '''
+    _Done = object()
+
+    def __init__(self, source:ImageSource, sectorSize:int, pageSize:int,
+                 depth:int=PrepareQueueDepth, sectorRuns:Dict[int, List[Tuple[int, int]]]=None):
+        super().__init__(name=f'prepare-{os.path.basename(source.filepath)}', daemon=True)
+        self.source = source
+        self.sectorSize = sectorSize
+        self.pageSize = pageSize
+        self._queue = queue.Queue(maxsize=depth)
+        self._cancelled = False
+        self.sectorRuns = sectorRuns
+
+    def run(self):
+        try:
+            for offset, data in self.source.chunks(self.sectorSize):
+                if self._cancelled:
+                    return
+                if data is None:
+                    runs = None
+                elif self.sectorRuns is not None:
+                    runs = self.sectorRuns[offset]
+                else:
+                    runs = self.programRuns(data, self.pageSize)
+                self._queue.put((offset, data, runs))
+            self._queue.put(self._Done)
+        except Exception as e:
+            self._queue.put(e)
+
+    def cancel(self):
+        self._cancelled = True
+        # unblock the worker, if it is waiting on a full queue
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._Done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    @classmethod
+    def programRuns(cls, data:bytes, pageSize:int) -> List[Tuple[int, int]]:
+        '''
+            spans of consecutive non-blank pages in data
+        '''
+        blank = b'\xff' * pageSize
+        view = memoryview(data)
+        runs = []
+        for start in range(0, len(data), pageSize):
+            end = min(len(data), start + pageSize)
+            if view[start:end] == blank[:end-start]:
+                continue
+            if runs and runs[-1][1] == start:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((start, end))
+        return runs
@@ -0,0 +1,178 @@
+'''
+Concurrent flash jobs.
+
+Runs one flash job per FTDI channel, each with its own SpiController
+on its own worker thread, so both MPSSE channels of an FT2232H can
+program a board at the same time.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import argparse
+import logging
+import threading
+import time
+from typing import List, Tuple
+
+from flash_util import FlashUtil, FlashVerifyError, VerifyRetriesDefault
+from verify_tiers import VerifyTiers, VerifyTierNone, VerifyConfidenceDefault
+from image_source import ImageSource
+
+log = logging.getLogger(__name__)
+
+class FlashJobResult:
+    def __init__(self, uri:str):
+        self.uri = uri
+        self.ok = False
+        self.upToDate = False
+        self.error = None
+        self.numBytes = 0
+        self.elapsed = 0.0
+        self.busyPolls = 0
+        # the FlashUtil OperationStats of the job
+        self.opStats = None
+
+    @property
+    def bytesPerSecond(self) -> float:
+        if not self.elapsed:
+            return 0.0
+        return self.numBytes / self.elapsed
+
+    def __str__(self):
+        if not self.ok:
+            return f'{self.uri}: FAILED after {self.elapsed:.2f}s: {type(self.error).__name__}: {self.error}'
+        if self.upToDate:
+            return f'{self.uri}: already up to date ({self.elapsed:.2f}s)'
+        desc = f'{self.uri}: OK, {self.numBytes} bytes in {self.elapsed:.2f}s ' \
+               f'({self.bytesPerSecond/1024:.1f} KiB/s)'
+        if self.opStats is not None and self.opStats.verifyTier is not None:
+            desc += f', {self.opStats.verifyTier} verify {self.opStats.verifySeconds:.2f}s'
+        if self.opStats is not None and self.opStats.bootLatency is not None:
+            desc += f', ready {self.opStats.bootLatency*1000:.1f}ms after reset'
+        return desc
+
+
+def runFlashJob(uri:str, contents:bytes, startAddress:int=0, verify:bool=False,
+                maxRetries:int=VerifyRetriesDefault, tagVersion:str=None,
+                probeBoot:bool=False, verifyTier:str=VerifyTierNone,
+                verifySamples:int=None) -> FlashJobResult:
+    '''
+        flash contents to the board on FTDI device uri, then release it
+        @param tagVersion: (optional) tag the image and skip boards already up to date
+        @param verifyTier: (optional) check the written image with this verify tier, 
+                           failing the job if it does not match
+        @param verifySamples: (optional) pages compared by the sampled tier [enough for VerifyConfidenceDefault]
+        @param probeBoot: (optional) time the firmware to ready after flashing, failing 
+                          the job if it never is
+        @return: the FlashJobResult; exceptions are captured in it, not raised
+    '''
+    result = FlashJobResult(uri)
+    flashUtil = FlashUtil()
+    flashUtil.deviceURI = uri
+    startTime = time.time()
+    try:
+        if flashUtil.flash is None:
+            raise RuntimeError(f'Could not access FTDI device {uri}')
+        if tagVersion is not None and flashUtil.isUpToDate(contents, startAddress):
+            result.upToDate = True
+        else:
+            flashUtil.upload(contents, startAddress, verify=verify,
+                             maxRetries=maxRetries, tagVersion=tagVersion)
+            result.numBytes = len(contents)
+            if verifyTier != VerifyTierNone and \
+                    not flashUtil.verifyImage(contents, startAddress, verifyTier, verifySamples):
+                raise FlashVerifyError(f'{flashUtil.opStats.verifyTier} verify failed')
+        if probeBoot:
+            flashUtil.probeBoot()
+        result.ok = True
+    except Exception as e:
+        log.debug(f'{uri}: flash job failed', exc_info=True)
+        result.error = e
+    finally:
+        result.elapsed = time.time() - startTime
+        result.opStats = flashUtil.opStats
+        if flashUtil._flash is not None:
+            result.busyPolls = getattr(flashUtil._flash, 'busy_polls', 0)
+        try:
+            flashUtil.close()
+        except Exception as e:
+            log.warning(f'{uri}: issue releasing adapter: {e}')
+    return result
+
+
+def runConcurrentFlashJobs(uris:List[str], contents:bytes, **jobOptions) -> Tuple[List[FlashJobResult], float]:
+    '''
+        run runFlashJob for every uri, each on its own thread
+        @param jobOptions: passed through to runFlashJob
+        @return: (results, in uris order, wall clock time taken)
+    '''
+    results = [None] * len(uris)
+
+    def worker(idx:int, uri:str):
+        results[idx] = runFlashJob(uri, contents, **jobOptions)
+
+    startTime = time.time()
+    threads = [threading.Thread(target=worker, args=(idx, uri), name=f'flash-{uri}')
+                    for idx, uri in enumerate(uris)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (results, time.time() - startTime)
+
+
+def reportFlashJobs(results:List[FlashJobResult], wallTime:float):
+    '''
+        print each job's outcome and throughput, and the aggregate over the
+        shared USB link
+    '''
+    for result in results:
+        print(result)
+    totalBytes = sum(r.numBytes for r in results)
+    if len(results) > 1 and wallTime:
+        print(f'Aggregate: {totalBytes} bytes in {wallTime:.2f}s ({totalBytes/wallTime/1024:.1f} KiB/s over shared USB)')
+
+
+def getArgParser():
+    parser = argparse.ArgumentParser(description='Flash the boards on both channels of an FT2232H at once')
+    parser.add_argument("--serial", type=str, required=True,
+                    help="FT2232H serial number")
+    parser.add_argument("--channels", type=str, default='1,2',
+                        required=False,
+                    help="comma separated channels to drive [1,2]")
+    parser.add_argument("--write", type=str, required=True,
+                    help="image file to write to every board")
+    parser.add_argument("--address", type=int, default=0,
+                        required=False,
+                    help="start address [0]")
+    parser.add_argument("--inline-verify", action='store_true',
+                        required=False,
+                    help="read back each sector right after writing it, re-programming bad sectors")
+    parser.add_argument("--tag", type=str, nargs='?', const='',
+                        required=False,
+                    help="tag the written image (with optional version string) and skip boards already tagged with it")
+    parser.add_argument("--boot-probe", action='store_true',
+                        required=False,
+                    help="time each board's firmware to ready after flashing, failing boards that do not boot")
+    parser.add_argument("--verify", type=str, choices=VerifyTiers, default=VerifyTierNone,
+                        required=False,
+                    help=f"check each written image: not at all, on random pages, with firmware CRCs or by reading it all back [{VerifyTierNone}]")
+    parser.add_argument("--verify-samples", type=int,
+                        required=False,
+                    help=f"pages compared by a sampled verify [enough to catch a damaged sector with probability {VerifyConfidenceDefault}]")
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.WARN)
+    args = getArgParser().parse_args()
+    contents = ImageSource(args.write).read()
+    uris = [f'ftdi://ftdi:2232:{args.serial}/{int(ch)}' for ch in args.channels.split(',')]
+    results, wallTime = runConcurrentFlashJobs(uris, contents, startAddress=args.address,
+                                               verify=args.inline_verify, tagVersion=args.tag,
+                                               probeBoot=args.boot_probe, verifyTier=args.verify,
+                                               verifySamples=args.verify_samples)
+    reportFlashJobs(results, wallTime)
+
+
+if __name__ == '__main__':
+    main()
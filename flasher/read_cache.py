@@ -0,0 +1,183 @@
+'''
+Sector read cache.
+
+Header probes, metadata checks, compares and differential planning tend
+to read the same sectors several times in a session, each time over the
+slow pass-through.  CachedFlash wraps a flash device and keeps whole
+sectors it has read in an LRU bounded by a memory budget, so repeated
+reads touch the wire once per sector.  Writes and erases through it drop
+exactly the sectors they touch.
+
+Contents are assumed to change only through the wrapper: the firmware
+does not write its own flash.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+from collections import OrderedDict
+from typing import Iterable, Union
+
+from spiflash.serialflash import SerialFlash, SerialFlashNotSupported
+
+ReadCacheBudgetDefault = 4*1024*1024
+
+class SectorReadCache:
+    def __init__(self, budget:int, sectorSize:int):
+        '''
+            @param budget: bytes of sector data to hold at most
+            @param sectorSize: size of the cached units
+        '''
+        self.sectorSize = sectorSize
+        self.maxSectors = max(1, budget // sectorSize)
+        self._sectors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._sectors)
+
+    def get(self, sector:int) -> bytes:
+        data = self._sectors.get(sector)
+        if data is None:
+            self.misses += 1
+            return None
+        self._sectors.move_to_end(sector)
+        self.hits += 1
+        return data
+
+    def put(self, sector:int, data:bytes):
+        self._sectors[sector] = data
+        self._sectors.move_to_end(sector)
+        while len(self._sectors) > self.maxSectors:
+            self._sectors.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, address:int, length:int):
+        '''
+            forget the sectors overlapping address..address+length
+        '''
+        if length <= 0:
+            return
+        first = address // self.sectorSize
+        last = (address + length - 1) // self.sectorSize
+        if last - first + 1 >= len(self._sectors):
+            stale = [s for s in self._sectors if first <= s <= last]
+        else:
+            stale = [s for s in range(first, last + 1) if s in self._sectors]
+        for sector in stale:
+            del self._sectors[sector]
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self.invalidations += len(self._sectors)
+        self._sectors.clear()
+
+    @property
+    def hitRate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return f'{self.hits} hits, {self.misses} misses ({100*self.hitRate:.0f}%), ' \
+               f'{len(self._sectors)}/{self.maxSectors} sectors held, {self.evictions} evicted'
+
+
+class CachedFlash:
+    '''
+        Flash device wrapper serving reads from a SectorReadCache,
+        fetching missing sectors (contiguous ones in a single read), and
+        invalidating on write and erase.  Anything else is delegated to
+        the wrapped device.
+    '''
+    def __init__(self, flash:SerialFlash, cache:SectorReadCache):
+        self._flash = flash
+        self.cache = cache
+        # only offered when the device has them, as callers probe with hasattr()
+        if hasattr(flash, 'start_program_page'):
+            self.start_program_page = self._startProgramPage
+            self.start_erase_block = self._startEraseBlock
+
+    def __getattr__(self, name):
+        return getattr(self._flash, name)
+
+    def __len__(self):
+        return len(self._flash)
+
+    def __str__(self):
+        return str(self._flash)
+
+    @property
+    def uncached(self) -> SerialFlash:
+        '''
+            the wrapped device, for reads that must go over the wire
+        '''
+        return self._flash
+
+    def read(self, address:int, length:int) -> bytes:
+        if length <= 0:
+            return self._flash.read(address, length)
+        sectorSize = self.cache.sectorSize
+        first = address // sectorSize
+        last = (address + length - 1) // sectorSize
+        sectors = {}
+        missing = []
+        for sector in range(first, last + 1):
+            data = self.cache.get(sector)
+            if data is None:
+                missing.append(sector)
+            else:
+                sectors[sector] = data
+        runStart = None
+        for idx, sector in enumerate(missing):
+            if runStart is None:
+                runStart = sector
+            if idx + 1 == len(missing) or missing[idx + 1] != sector + 1:
+                self._fetch(runStart, sector + 1, sectors)
+                runStart = None
+        data = b''.join(sectors[sector] for sector in range(first, last + 1))
+        offset = address - first * sectorSize
+        return data[offset:offset+length]
+
+    def _fetch(self, firstSector:int, endSector:int, sectors:dict):
+        sectorSize = self.cache.sectorSize
+        start = firstSector * sectorSize
+        end = min(endSector * sectorSize, len(self._flash))
+        data = self._flash.read(start, end - start)
+        for sector in range(firstSector, endSector):
+            pos = (sector - firstSector) * sectorSize
+            sectors[sector] = data[pos:pos+sectorSize]
+            self.cache.put(sector, sectors[sector])
+
+    def write(self, address:int, data:Union[bytes, bytearray, Iterable[int]]) -> None:
+        try:
+            self._flash.write(address, data)
+        finally:
+            self.cache.invalidate(address, len(data))
+
+    def erase(self, address:int, length:int, verify:bool=False) -> None:
+        try:
+            self._flash.erase(address, length, verify)
+        finally:
+            if address == 0 and length == -1:
+                self.cache.clear()
+            else:
+                self.cache.invalidate(address, length)
+
+    def _startProgramPage(self, address:int, data:bytes) -> None:
+        self.cache.invalidate(address, len(data))
+        self._flash.start_program_page(address, data)
+
+    def _startEraseBlock(self, command:int, address:int) -> None:
+        self.cache.invalidate(address, self._eraseCommandSize(command))
+        self._flash.start_erase_block(command, address)
+
+    def _eraseCommandSize(self, command:int) -> int:
+        for kind in ('subsector', 'hsector', 'sector', 'block'):
+            try:
+                if self._flash.get_erase_command(kind) == command:
+                    return self._flash.get_size(kind)
+            except (AttributeError, NotImplementedError, SerialFlashNotSupported):
+                continue
+        # not a command we know the extent of
+        return len(self._flash)
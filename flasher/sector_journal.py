@@ -0,0 +1,106 @@
+'''
+Sector journal for resumable flashing.
+
+Records, per (board, image) pair, how many bytes of an upload have been
+programmed (and verified, if requested) so that an interrupted upload
+may pick up where it left off.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import hashlib
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+JournalFileDefault = '.flash_journal.json'
+
+class SectorJournal:
+    '''
+        Small JSON state file holding one entry per in-progress upload,
+        keyed by board identity and image hash.  Entries are removed
+        once the upload completes.
+    '''
+    Version = 1
+
+    def __init__(self, filepath:str=JournalFileDefault):
+        self.filepath = filepath
+        self._entries = self._load()
+        self._key = None
+
+    @classmethod
+    def imageHash(cls, contents:bytes, startAddress:int=0) -> str:
+        h = hashlib.sha256(contents)
+        h.update(startAddress.to_bytes(4, 'big'))
+        return h.hexdigest()
+
+    def begin(self, boardId:str, contents:bytes, startAddress:int, sectorSize:int) -> int:
+        '''
+            start (or resume) tracking an upload
+            @param boardId: identity of the target board
+            @param contents: the (padded) image to upload
+            @param startAddress: address the image is written to
+            @param sectorSize: the unit of commitment
+            @return: offset, within contents, of the first uncommitted byte
+        '''
+        imageHash = self.imageHash(contents, startAddress)
+        self._key = f'{boardId}:{imageHash}'
+        entry = self._entries.get(self._key)
+        if entry is not None and entry['size'] == len(contents) and \
+                entry['sectorSize'] == sectorSize:
+            log.info(f"Journal has {entry['committed']} bytes committed for this board and image")
+            return entry['committed']
+
+        self._entries[self._key] = {
+            'board': boardId,
+            'image': imageHash,
+            'start': startAddress,
+            'size': len(contents),
+            'sectorSize': sectorSize,
+            'committed': 0,
+            'updated': time.time()
+        }
+        self._save()
+        return 0
+
+    def commit(self, committedBytes:int):
+        '''
+            record that everything up to committedBytes (relative to
+            the image start) is safely on flash
+        '''
+        entry = self._entries[self._key]
+        entry['committed'] = committedBytes
+        entry['updated'] = time.time()
+        self._save()
+
+    def complete(self):
+        '''
+            upload finished, forget about it
+        '''
+        if self._key in self._entries:
+            del self._entries[self._key]
+            self._save()
+        self._key = None
+
+    def _load(self):
+        if not os.path.exists(self.filepath):
+            return {}
+        try:
+            with open(self.filepath, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f'Ignoring unreadable journal {self.filepath}: {e}')
+            return {}
+        if state.get('version') != self.Version:
+            return {}
+        return state.get('entries', {})
+
+    def _save(self):
+        # write to the side and swap, so a yanked board or killed process
+        # never leaves a half-written journal
+        tmpPath = f'{self.filepath}.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump({'version': self.Version, 'entries': self._entries}, f)
+        os.replace(tmpPath, self.filepath)
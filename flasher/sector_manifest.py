@@ -0,0 +1,174 @@
+'''
+Build-time sector manifests.
+
+A sidecar written next to each firmware image when it is built (see the
+%.bin and %.hex Makefile rules), so the flashing station need not hash
+and scan images itself.  IMAGE.sectors.json holds:
+
+    image       sha256 of the whole (expanded) image
+    size        image length, in bytes
+    used        end of the last non-blank page: beyond it the image is all 0xFF
+    sectors     per sector, its sha256, or null where the sector is blank
+    runs        per sector, the [start, end] spans of non-blank pages
+
+FlashUtil uses it to size the erase up front, to program only the
+non-blank pages and, for differential writes, to find the sectors that
+already match on flash by hashing them against the manifest.
+
+Run as a script to build one:  sector_manifest.py IMAGE
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import argparse
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from image_source import ImageSource, ImagePreparer
+
+log = logging.getLogger(__name__)
+
+SectorManifestSuffix = '.sectors.json'
+SectorManifestSectorSize = 4096
+SectorManifestPageSize = 256
+
+def sectorManifestPath(imagePath:str) -> str:
+    return f'{imagePath}{SectorManifestSuffix}'
+
+
+class SectorManifest:
+    Version = 1
+
+    def __init__(self, imageHash:str, size:int, used:int, sectorSize:int, pageSize:int,
+                 sectors:List[Optional[str]], runs:List[List[Tuple[int, int]]], fileSize:int=None):
+        self.imageHash = imageHash
+        self.size = size
+        self.used = used
+        self.sectorSize = sectorSize
+        self.pageSize = pageSize
+        self.sectors = sectors
+        self.runs = runs
+        # size of the image file it was built from, to spot stale manifests
+        self.fileSize = fileSize
+
+    @classmethod
+    def build(cls, source:ImageSource, sectorSize:int=SectorManifestSectorSize,
+              pageSize:int=SectorManifestPageSize):
+        sectors = []
+        runs = []
+        used = 0
+        for offset, data in source.chunks(sectorSize):
+            if data is None:
+                sectors.append(None)
+                runs.append([])
+                continue
+            sectorRuns = ImagePreparer.programRuns(data, pageSize)
+            sectors.append(hashlib.sha256(data).hexdigest())
+            runs.append(sectorRuns)
+            if sectorRuns:
+                used = offset + sectorRuns[-1][1]
+        fileSize = None
+        if os.path.exists(source.filepath):
+            fileSize = os.path.getsize(source.filepath)
+        return cls(source.sha256, source.extent, used, sectorSize, pageSize, sectors, runs,
+                   fileSize)
+
+    @classmethod
+    def load(cls, path:str):
+        with open(path, 'r') as f:
+            spec = json.load(f)
+        if spec.get('version') != cls.Version:
+            raise ValueError(f'{path}: unsupported sector manifest version {spec.get("version")}')
+        return cls(spec['image'], spec['size'], spec['used'], spec['sectorSize'],
+                   spec['pageSize'], spec['sectors'],
+                   [[tuple(run) for run in sectorRuns] for sectorRuns in spec['runs']],
+                   spec.get('fileSize'))
+
+    @classmethod
+    def forImage(cls, imagePath:str):
+        '''
+            the sidecar manifest of an image, if there is an up to date one
+            @return: a SectorManifest, or None
+        '''
+        path = sectorManifestPath(imagePath)
+        if not os.path.exists(path):
+            return None
+        if os.path.getmtime(path) < os.path.getmtime(imagePath):
+            log.warning(f'Ignoring {path}: older than the image')
+            return None
+        try:
+            manifest = cls.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f'Ignoring unreadable sector manifest {path}: {e}')
+            return None
+        if manifest.fileSize is not None and manifest.fileSize != os.path.getsize(imagePath):
+            log.warning(f'Ignoring {path}: built from a different image')
+            return None
+        return manifest
+
+    def save(self, path:str):
+        tmpPath = f'{path}.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump({'version': self.Version, 'image': self.imageHash, 'size': self.size,
+                       'used': self.used, 'sectorSize': self.sectorSize,
+                       'pageSize': self.pageSize, 'fileSize': self.fileSize,
+                       'sectors': self.sectors, 'runs': self.runs}, f)
+        os.replace(tmpPath, path)
+
+    def usableFor(self, sectorSize:int) -> bool:
+        '''
+            whether the manifest's sectors are the flash's erase sectors.
+            Page spans work with any flash page size.
+        '''
+        return self.sectorSize == sectorSize
+
+    def isBlank(self, offset:int) -> bool:
+        return self.sectors[offset // self.sectorSize] is None
+
+    def sectorLength(self, offset:int) -> int:
+        return min(self.sectorSize, self.size - offset)
+
+    def sectorMatches(self, offset:int, data:bytes) -> bool:
+        '''
+            whether data (as read from flash) is what the image has in the
+            sector at offset
+        '''
+        digest = self.sectors[offset // self.sectorSize]
+        if digest is None:
+            return data.count(0xff) == len(data)
+        return hashlib.sha256(data).hexdigest() == digest
+
+    def programRuns(self) -> Dict[int, List[Tuple[int, int]]]:
+        '''
+            non-blank page spans, by sector offset
+        '''
+        return {idx * self.sectorSize: runs for idx, runs in enumerate(self.runs)}
+
+    def __str__(self):
+        blank = self.sectors.count(None)
+        return f'{self.size} bytes ({self.used} used), {len(self.sectors)} sectors ' \
+               f'({blank} blank), sha256 {self.imageHash}'
+
+
+def main():
+    logging.basicConfig(level=logging.WARN)
+    parser = argparse.ArgumentParser(description='Build the sector manifest sidecar for a firmware image')
+    parser.add_argument("image", type=str,
+                    help="image file (.bin or .hex, optionally compressed)")
+    parser.add_argument("--sector-size", type=int, default=SectorManifestSectorSize,
+                        required=False,
+                    help=f"flash erase sector size [{SectorManifestSectorSize}]")
+    parser.add_argument("--page-size", type=int, default=SectorManifestPageSize,
+                        required=False,
+                    help=f"flash program page size [{SectorManifestPageSize}]")
+    args = parser.parse_args()
+    manifest = SectorManifest.build(ImageSource(args.image), args.sector_size, args.page_size)
+    path = sectorManifestPath(args.image)
+    manifest.save(path)
+    print(f'{path}: {manifest}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+'''
+Host-side shadow of board flash contents.
+
+Keeps a per-board mirror of what was last written to (or read from) the
+flash, so deciding which sectors need re-programming does not require
+reading the whole device back over the passthrough.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import json
+import logging
+import os
+import random
+from typing import Iterable, List, Union
+
+from spiflash.serialflash import SerialFlash
+
+from board_id import boardFileName
+
+log = logging.getLogger(__name__)
+
+ShadowSampleCountDefault = 8
+ShadowSamplePageSize = 256
+
+class ShadowImage:
+    '''
+        Mirror of a single board's flash.  Only sectors flagged as known
+        are trusted; anything else is treated as dirty.
+    '''
+    def __init__(self, dataPath:str, metaPath:str, size:int, sectorSize:int):
+        self.dataPath = dataPath
+        self.metaPath = metaPath
+        self.size = size
+        self.sectorSize = sectorSize
+        numSectors = size // sectorSize
+        self.data = bytearray(b'\xff' * size)
+        self.known = bytearray(numSectors)
+        # sectors being rewritten: saved as unknown until committed
+        self.pending = set()
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self.dataPath) and os.path.exists(self.metaPath)):
+            return
+        try:
+            with open(self.metaPath, 'r') as f:
+                meta = json.load(f)
+            if meta['size'] != self.size or meta['sectorSize'] != self.sectorSize:
+                log.warning(f'Shadow {self.metaPath} geometry mismatch, ignoring')
+                return
+            with open(self.dataPath, 'rb') as f:
+                data = f.read()
+            if len(data) != self.size:
+                return
+            self.data[:] = data
+            self.known[:] = bytes.fromhex(meta['known'])
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f'Ignoring unreadable shadow {self.metaPath}: {e}')
+
+    def save(self):
+        with open(self.dataPath, 'wb') as f:
+            f.write(self.data)
+        self._saveMeta()
+
+    def _saveMeta(self):
+        known = bytearray(self.known)
+        for sector in self.pending:
+            known[sector] = 0
+        tmpPath = f'{self.metaPath}.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump({'size': self.size, 'sectorSize': self.sectorSize,
+                       'known': known.hex()}, f)
+        os.replace(tmpPath, self.metaPath)
+
+    def beginUpdate(self, addresses:Iterable[int]):
+        '''
+            about to erase/program the sectors at addresses: save them as
+            unknown first, so an interrupted update is never trusted later
+        '''
+        self.pending.update(address // self.sectorSize for address in addresses)
+        if os.path.exists(self.dataPath):
+            self._saveMeta()
+        else:
+            self.save()
+
+    def commit(self, address:int, length:int):
+        '''
+            the sectors in address..address+length now hold what the mirror
+            says: save them
+        '''
+        first = address // self.sectorSize
+        last = (address + length - 1) // self.sectorSize
+        self.pending.difference_update(range(first, last + 1))
+        if not os.path.exists(self.dataPath):
+            self.save()
+            return
+        start = first * self.sectorSize
+        end = (last + 1) * self.sectorSize
+        with open(self.dataPath, 'r+b') as f:
+            f.seek(start)
+            f.write(self.data[start:end])
+        self._saveMeta()
+
+    def invalidate(self):
+        self.known[:] = bytes(len(self.known))
+
+    def isKnown(self, address:int, length:int) -> bool:
+        first = address // self.sectorSize
+        last = (address + length - 1) // self.sectorSize
+        return all(self.known[first:last+1])
+
+    def isErased(self, address:int, length:int) -> bool:
+        if not self.isKnown(address, length):
+            return False
+        return self.data[address:address+length].count(0xff) == length
+
+    def recordErase(self, address:int, length:int):
+        if address == 0 and length == -1:
+            length = self.size
+        self.data[address:address+length] = b'\xff' * length
+        for sector in range(address // self.sectorSize,
+                            (address + length) // self.sectorSize):
+            self.known[sector] = 1
+
+    def recordWrite(self, address:int, data:Union[bytes, bytearray, Iterable[int]]):
+        # programming can only clear bits, so the new cell value is old & data
+        data = bytes(data)
+        length = len(data)
+        old = int.from_bytes(self.data[address:address+length], 'big')
+        new = old & int.from_bytes(data, 'big')
+        self.data[address:address+length] = new.to_bytes(length, 'big')
+
+    def recordRead(self, address:int, data:bytes):
+        self.data[address:address+len(data)] = data
+        # only sectors entirely covered by the read become known
+        firstFull = (address + self.sectorSize - 1) // self.sectorSize
+        endFull = (address + len(data)) // self.sectorSize
+        for sector in range(firstFull, endFull):
+            self.known[sector] = 1
+
+    def dirtySectors(self, contents:bytes, startAddress:int, fromOffset:int=0) -> List[int]:
+        '''
+            offsets (relative to startAddress) of the sectors of contents
+            that differ from, or are not known in, the mirror
+        '''
+        view = memoryview(contents)
+        dirty = []
+        for offset in range(fromOffset, len(contents), self.sectorSize):
+            address = startAddress + offset
+            if not self.known[address // self.sectorSize] or \
+                    self.data[address:address+self.sectorSize] != view[offset:offset+self.sectorSize]:
+                dirty.append(offset)
+        return dirty
+
+    def sampleCheck(self, flash:SerialFlash, samples:int=ShadowSampleCountDefault,
+                    seed:int=None) -> bool:
+        '''
+            read a few random pages from known sectors and make sure the
+            mirror agrees with the device.
+            @return: True if the mirror looks current
+        '''
+        knownSectors = [i for i, k in enumerate(self.known) if k]
+        if not knownSectors:
+            return True
+        rng = random.Random(seed)
+        pagesPerSector = self.sectorSize // ShadowSamplePageSize
+        for _i in range(min(samples, len(knownSectors) * pagesPerSector)):
+            sector = rng.choice(knownSectors)
+            address = sector * self.sectorSize + \
+                        rng.randrange(pagesPerSector) * ShadowSamplePageSize
+            onFlash = flash.read(address, ShadowSamplePageSize)
+            if onFlash != self.data[address:address+ShadowSamplePageSize]:
+                log.warning(f'Shadow stale at 0x{address:06x}')
+                return False
+        return True
+
+
+class ShadowStore:
+    '''
+        Directory of ShadowImages, one per board identity.
+    '''
+    def __init__(self, directory:str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def imageFor(self, boardId:str, size:int, sectorSize:int) -> ShadowImage:
+        base = os.path.join(self.directory, boardFileName(boardId))
+        return ShadowImage(f'{base}.bin', f'{base}.json', size, sectorSize)
+
+
+class ShadowedFlash:
+    '''
+        Flash device wrapper that keeps a ShadowImage in sync with every
+        read, write and erase going through it.  Anything else is
+        delegated to the wrapped device.
+    '''
+    def __init__(self, flash:SerialFlash, shadow:ShadowImage):
+        self._flash = flash
+        self.shadow = shadow
+
+    def __getattr__(self, name):
+        return getattr(self._flash, name)
+
+    def __len__(self):
+        return len(self._flash)
+
+    def __str__(self):
+        return str(self._flash)
+
+    def read(self, address:int, length:int) -> bytes:
+        data = self._flash.read(address, length)
+        self.shadow.recordRead(address, data)
+        return data
+
+    def write(self, address:int, data:Union[bytes, bytearray, Iterable[int]]) -> None:
+        self._flash.write(address, data)
+        self.shadow.recordWrite(address, data)
+
+    def erase(self, address:int, length:int, verify:bool=False) -> None:
+        self._flash.erase(address, length, verify)
+        self.shadow.recordErase(address, length)
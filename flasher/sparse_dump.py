@@ -0,0 +1,84 @@
+'''
+Sparse flash dump files.
+
+Erased (0xFF) blocks are not written to the dump: they are left as holes
+in the file.  Since holes read back as 0x00, a JSON sidecar (the dump
+filename plus SparseMapSuffix) lists the extents that actually hold
+data; everything else in the dump is erased flash.  ImageSource knows
+how to read these back.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import json
+import os
+from typing import List, Tuple
+
+SparseMapSuffix = '.map'
+SparseBlockSizeDefault = 4096
+
+def sparseMapPath(filepath:str) -> str:
+    return f'{filepath}{SparseMapSuffix}'
+
+def readSparseMap(filepath:str):
+    '''
+        @return: (size, [(offset, length), ...]) for a sparse dump, or
+                 None if filepath has no sparse map
+    '''
+    mapPath = sparseMapPath(filepath)
+    if not os.path.exists(mapPath):
+        return None
+    with open(mapPath, 'r') as f:
+        spec = json.load(f)
+    return (spec['size'], [tuple(extent) for extent in spec['extents']])
+
+
+class SparseDumpWriter:
+    '''
+        Write flash contents to a sparse dump, at arbitrary offsets, in
+        increasing order.
+    '''
+    def __init__(self, filepath:str, blockSize:int=SparseBlockSizeDefault,
+                 startAddress:int=0):
+        self.filepath = filepath
+        self.blockSize = blockSize
+        self.startAddress = startAddress
+        self.extents = []
+        self.dataBytes = 0
+        self._blank = b'\xff' * blockSize
+        self._file = open(filepath, 'wb')
+
+    def write(self, offset:int, data:bytes):
+        '''
+            write data found at offset (relative to the dump start),
+            leaving erased blocks as holes
+        '''
+        view = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            # stick to block boundaries of the dump, so holes line up
+            blockEnd = min(len(data), pos + self.blockSize - ((offset + pos) % self.blockSize))
+            block = view[pos:blockEnd]
+            if block != self._blank[:len(block)]:
+                self._file.seek(offset + pos)
+                self._file.write(block)
+                self._addExtent(offset + pos, len(block))
+            pos = blockEnd
+
+    def _addExtent(self, offset:int, length:int):
+        self.dataBytes += length
+        if self.extents and self.extents[-1][0] + self.extents[-1][1] == offset:
+            self.extents[-1] = (self.extents[-1][0], self.extents[-1][1] + length)
+        else:
+            self.extents.append((offset, length))
+
+    def close(self, size:int) -> List[Tuple[int, int]]:
+        '''
+            finish the dump, which covers size bytes in all
+            @return: the data extents
+        '''
+        self._file.truncate(size)
+        self._file.close()
+        with open(sparseMapPath(self.filepath), 'w') as f:
+            json.dump({'size': size, 'start': self.startAddress,
+                       'extents': self.extents}, f)
+        return self.extents
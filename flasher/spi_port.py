@@ -15,6 +15,9 @@ log = logging.getLogger(__name__)
 
 class CaravelPassThroughSpiPort(SpiPort):
     CaravelPassthroughByte = 0xC4 
+    # bytes flash command encoders leave free for us, at the start of 
+    # their buffers, see exchange_with_headroom()
+    COMMAND_HEADROOM = 1
     
     @classmethod 
     def newFromSpiPort(cls, port:SpiPort):
@@ -39,4 +42,12 @@ class CaravelPassThroughSpiPort(SpiPort):
         # perform the exchange with through the pass-through
         v = self.spi_port_raw.exchange(bts, readlen, start=start, stop=stop, duplex=duplex, droptail=droptail)
         return v
-        
\ No newline at end of file
+        
+    
+    def exchange_with_headroom(self, out:Union[bytearray, memoryview], 
+                 readlen:int=0, start:bool=True, stop:bool=True, 
+                 duplex:bool=False, droptail:int=0)->bytes:
+        # out has COMMAND_HEADROOM bytes free up front, for the 
+        # pass-through byte, so no copy is needed
+        out[0] = self.CaravelPassthroughByte
+        return self.spi_port_raw.exchange(out, readlen, start=start, stop=stop, duplex=duplex, droptail=droptail)
@@ -22,7 +22,9 @@
 import sys
 import time
 from binascii import hexlify
+from struct import pack_into
 from typing import Iterable, Optional, Tuple, Union
+from pyftdi.ftdi import Ftdi
 from pyftdi.misc import pretty_size
 from pyftdi.spi import SpiController, SpiPort
 
@@ -292,6 +294,167 @@ class SerialFlashManager:
         raise SerialFlashError('No serial flash detected')
 
 
+class SpiCommandEncoder:
+    """Encode flash commands into a buffer preallocated for one device, so
+       that issuing a command does not build a new byte sequence each time.
+
+       SPI ports that need to prepend bytes of their own to every command
+       (such as a passthrough prefix) may declare how many with a
+       ``COMMAND_HEADROOM`` attribute and provide an
+       ``exchange_with_headroom()`` method. Commands are then encoded after
+       that many free bytes and handed to the port as is, for it to fill in
+       its prefix in place.
+
+       :param spi: the port commands are sent through
+       :param payload_size: the largest data payload expected, the buffer
+                            grows if a larger one is ever needed
+    """
+
+    ADDRESS_CMD_LEN = 4  # opcode + 24-bit address
+
+    def __init__(self, spi: SpiPort, payload_size: int = 256):
+        self._spi = spi
+        if hasattr(spi, 'exchange_with_headroom'):
+            self._headroom = getattr(spi, 'COMMAND_HEADROOM', 0)
+            self._exchange = spi.exchange_with_headroom
+        else:
+            self._headroom = 0
+            self._exchange = spi.exchange
+        self._allocate(payload_size)
+
+    def _allocate(self, payload_size: int) -> None:
+        self._buf = bytearray(self._headroom + self.ADDRESS_CMD_LEN +
+                              4 + payload_size)
+        self._mv = memoryview(self._buf)
+        # views over the buffer, by command length, reused across commands
+        self._views = {}
+
+    def _send(self, length: int, readlen: int) -> bytes:
+        view = self._views.get(length)
+        if view is None:
+            view = self._mv[:self._headroom+length]
+            self._views[length] = view
+        return self._exchange(view, readlen)
+
+    def command(self, opcode: int, readlen: int = 0) -> bytes:
+        """Send a single byte command.
+
+           :param opcode: the command
+           :param readlen: count of bytes to read back
+           :return: the bytes read back
+        """
+        self._buf[self._headroom] = opcode
+        return self._send(1, readlen)
+
+    def command_args(self, opcode: int, *args: int, readlen: int = 0) \
+            -> bytes:
+        """Send a command followed by a few argument bytes.
+
+           :param opcode: the command
+           :param args: the argument byte values
+           :param readlen: count of bytes to read back
+           :return: the bytes read back
+        """
+        buf = self._buf
+        pos = self._headroom
+        buf[pos] = opcode
+        for arg in args:
+            pos += 1
+            buf[pos] = arg
+        return self._send(1+len(args), readlen)
+
+    def command_address(self, opcode: int, address: int, readlen: int = 0,
+                        dummy: int = 0, data: Optional[bytes] = None,
+                        extra: Optional[int] = None) -> bytes:
+        """Send a command with a 24-bit address, optionally followed by
+           dummy bytes, a trailing byte or a data payload.
+
+           :param opcode: the command
+           :param address: the address
+           :param readlen: count of bytes to read back
+           :param dummy: count of zero bytes to send after the address
+           :param data: payload to send after the address (and dummy bytes)
+           :param extra: a single byte value to send after the address
+           :return: the bytes read back
+        """
+        length = self.ADDRESS_CMD_LEN + dummy
+        if data is not None:
+            size = len(data)
+            if self._headroom + length + size > len(self._buf):
+                self._allocate(size)
+        pos = self._headroom
+        buf = self._buf
+        pack_into('>I', buf, pos, (opcode << 24) | (address & 0xffffff))
+        pos += self.ADDRESS_CMD_LEN
+        for _ in range(dummy):
+            buf[pos] = 0
+            pos += 1
+        if extra is not None:
+            buf[pos] = extra
+            length += 1
+        elif data is not None:
+            buf[pos:pos+size] = data
+            length += size
+        return self._send(length, readlen)
+
+
+class _BatchedWrites:
+    """Context manager gathering the write-only commands sent through a
+       pyftdi SPI port into a few large USB transfers, rather than one
+       transfer per command.
+
+       Nothing may be read from the device while batching: leave the
+       context (which sends everything gathered) first. For ports not
+       backed by a pyftdi controller this does nothing, and commands are
+       sent as they are issued.
+
+       :param spi: the port commands are sent through
+       :param gap: minimum time, in seconds, to leave between commands
+    """
+
+    MAX_SIZE = 16 << 10
+
+    def __init__(self, spi: SpiPort, gap: float = 0.0):
+        controller = getattr(spi, '_controller', None)
+        self._ftdi = getattr(controller, '_ftdi', None)
+        self._buf = bytearray()
+        self._gap = b''
+        if self._ftdi is not None and gap:
+            # idle the clock, with /CS released, for long enough
+            count = max(1, int(gap * controller.frequency / 8) + 1)
+            self._gap = bytes((Ftdi.CLK_BYTES_NO_DATA,
+                               (count-1) & 0xff, (count-1) >> 8))
+
+    @property
+    def active(self) -> bool:
+        """Tell whether commands are actually being batched"""
+        return self._ftdi is not None
+
+    def __enter__(self) -> '_BatchedWrites':
+        if self._ftdi is not None:
+            self._write_data = self._ftdi.write_data
+            self._ftdi.write_data = self._gather
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self._ftdi is not None:
+            del self._ftdi.write_data
+            if exc_type is None:
+                self._flush()
+
+    def _gather(self, data: Union[bytes, bytearray]) -> int:
+        self._buf.extend(data)
+        self._buf.extend(self._gap)
+        if len(self._buf) >= self.MAX_SIZE:
+            self._flush()
+        return len(data)
+
+    def _flush(self) -> None:
+        if self._buf:
+            self._write_data(self._buf)
+            self._buf = bytearray()
+
+
 class _SpiFlashDevice(SerialFlash):
     """Generic flash device implementation.
 
@@ -310,6 +473,9 @@ class _SpiFlashDevice(SerialFlash):
 
     def __init__(self, spiport: SpiPort):
         self._spi = spiport
+        self._cmd = SpiCommandEncoder(spiport)
+        # count of status polls that found the device busy, for metrics
+        self.busy_polls = 0
 
     @property
     def spi_frequency(self) -> float:
@@ -473,16 +639,12 @@ class _SpiFlashDevice(SerialFlash):
         raise NotImplementedError()
 
     def _read_lo_speed(self, address: int, length: int) -> bytes:
-        read_cmd = bytes((self.CMD_READ_LO_SPEED,
-                          (address >> 16) & 0xff, (address >> 8) & 0xff,
-                          address & 0xff))
-        return self._spi.exchange(read_cmd, length)
+        return self._cmd.command_address(self.CMD_READ_LO_SPEED, address,
+                                         length)
 
     def _read_hi_speed(self, address: int, length: int) -> bytes:
-        read_cmd = bytes((self.CMD_READ_HI_SPEED,
-                          (address >> 16) & 0xff, (address >> 8) & 0xff,
-                          address & 0xff, 0))
-        return self._spi.exchange(read_cmd, length)
+        return self._cmd.command_address(self.CMD_READ_HI_SPEED, address,
+                                         length, dummy=1)
 
     def _verify_content(self, address: int, length: int, refbyte: int) -> None:
         data = self.read(address, length)
@@ -496,6 +658,7 @@ class _SpiFlashDevice(SerialFlash):
         timeout += typical_time+max_time
         cycle = 0
         while self.is_busy():
+            self.busy_polls += 1
             # need to wait at least once
             if cycle and time.time() > timeout:
                 raise SerialFlashTimeout('Command timeout (%d cycles)' % cycle)
@@ -619,11 +782,10 @@ class _Gen25FlashDevice(_SpiFlashDevice):
 
     def unlock(self) -> None:
         self._enable_write()
-        wrsr_cmd = bytes((_Gen25FlashDevice.CMD_WRSR,
-                          _Gen25FlashDevice.SR_WEL |
-                          _Gen25FlashDevice.SR_PROTECT_NONE |
-                          _Gen25FlashDevice.SR_UNLOCK_PROTECT))
-        self._spi.exchange(wrsr_cmd)
+        self._cmd.command_args(_Gen25FlashDevice.CMD_WRSR,
+                               _Gen25FlashDevice.SR_WEL |
+                               _Gen25FlashDevice.SR_PROTECT_NONE |
+                               _Gen25FlashDevice.SR_UNLOCK_PROTECT)
         duration = self.get_timings('lock')
         if any(duration):
             self._wait_for_completion(duration)
@@ -651,19 +813,16 @@ class _Gen25FlashDevice(_SpiFlashDevice):
             pos += size
 
     def _read_status(self) -> int:
-        read_cmd = bytes((self.CMD_READ_STATUS,))
-        data = self._spi.exchange(read_cmd, 1)
+        data = self._cmd.command(self.CMD_READ_STATUS, 1)
         if len(data) != 1:
             raise SerialFlashTimeout("Unable to retrieve flash status")
         return data[0]
 
     def _enable_write(self) -> None:
-        wren_cmd = bytes((self.CMD_WRITE_ENABLE,))
-        self._spi.exchange(wren_cmd)
+        self._cmd.command(self.CMD_WRITE_ENABLE)
 
     def _disable_write(self) -> None:
-        wrdi_cmd = bytes((self.CMD_WRITE_DISABLE,))
-        self._spi.exchange(wrdi_cmd)
+        self._cmd.command(self.CMD_WRITE_DISABLE)
 
     def _write(self, address: int, data: bytes) -> None:
         # take care not to roll over the end of the flash page
@@ -675,22 +834,34 @@ class _Gen25FlashDevice(_SpiFlashDevice):
         else:
             sequences = [(address, data)]
         for addr, chunk in sequences:
-            self._enable_write()
-            wcmd = bytearray((self.CMD_PROGRAM_PAGE,
-                              (addr >> 16) & 0xff, (addr >> 8) & 0xff,
-                              addr & 0xff))
-            wcmd.extend(chunk)
-            self._spi.exchange(wcmd)
+            self.start_program_page(addr, chunk)
             self._wait_for_completion(self.get_timings('page'))
 
+    def start_program_page(self, address: int, data: bytes) -> None:
+        """Issue a page program command and return immediately, without
+           waiting for the device to complete it: poll :py:meth:`is_busy`.
+
+           :param address: the position of the first byte to write
+           :param data: bytes to write, which should not cross a page boundary
+        """
+        self._enable_write()
+        self._cmd.command_address(self.CMD_PROGRAM_PAGE, address, data=data)
+
+    def start_erase_block(self, command: int, address: int) -> None:
+        """Issue a block erase command and return immediately, without
+           waiting for the device to complete it: poll :py:meth:`is_busy`.
+
+           :param command: the erase command, see :py:meth:`get_erase_command`
+           :param address: the position of the block to erase
+        """
+        self._enable_write()
+        self._cmd.command_address(command, address)
+
     def _erase_blocks(self, command: int, times: Tuple[float, float],
                       start: int, end: int, size: int) -> None:
         """Erase one or more blocks."""
         while start < end:
-            self._enable_write()
-            cmd = bytes((command, (start >> 16) & 0xff,
-                         (start >> 8) & 0xff, start & 0xff))
-            self._spi.exchange(cmd)
+            self.start_erase_block(command, start)
             self._wait_for_completion(times)
             start += size
 
@@ -714,13 +885,15 @@ class Sst25FlashDevice(_Gen25FlashDevice):
     SST25_AAI = 0b01000000  # AAI mode activation flag
     SIZES = {0x41: 2 << 20, 0x4A: 4 << 20}
     SPI_FREQ_MAX = 66  # MHz
-    TIMINGS = {'subsector': (0.025, 0.025),  # 25 ms
+    TIMINGS = {'word': (0.00001, 0.00001),  # 10 us
+               'subsector': (0.025, 0.025),  # 25 ms
                'hsector': (0.025, 0.025),  # 25 ms
                'sector': (0.025, 0.025),  # 25 ms
                'lock': (0.0, 0.0)}  # immediate
     FEATURES = (SerialFlash.FEAT_SECTERASE |
                 SerialFlash.FEAT_SUBSECTERASE |
                 SerialFlash.FEAT_HSECTERASE)
+    AAI_BATCH_WORDS = 512  # AAI words sent per batch of USB transfers
 
     def __init__(self, spi, jedec):
         super(Sst25FlashDevice, self).__init__(spi)
@@ -740,7 +913,12 @@ class Sst25FlashDevice(_Gen25FlashDevice):
            which translates into an ultra-heavy load on SPI bus. However, the
            device offers lightning-speed flash erasure.
            Although the device supports byte-aligned write requests, the
-           current implementation only support half-word write requests."""
+           current implementation only support half-word write requests.
+
+           AAI word commands are sent in batches, with enough idle time
+           between them for each word to be programmed, and the status is
+           only polled once per batch. When batching is not available, the
+           status is polled after each word, without sleeping."""
         if address+len(data) > len(self):
             raise SerialFlashValueError('Cannot fit in flash area')
         if not isinstance(data, (bytes, bytearray)):
@@ -748,30 +926,33 @@ class Sst25FlashDevice(_Gen25FlashDevice):
         length = len(data)
         if (address & 0x1) or (length & 0x1) or (length == 0):
             raise SerialFlashNotSupported("Alignement/size not supported")
+        view = memoryview(data)
+        word_time = self.get_timings('word')
         self._unprotect()
         self._enable_write()
-        aai_cmd = bytes((Sst25FlashDevice.CMD_PROGRAM_WORD,
-                         (address >> 16) & 0xff,
-                         (address >> 8) & 0xff,
-                         address & 0xff,
-                         data.pop(0), data.pop(0)))
-        offset = 0
-        while True:
-            offset += 2
-            self._spi.exchange(aai_cmd)
-            while self.is_busy():
-                time.sleep(0.01)  # 10 ms
-            if not data:
-                break
-            aai_cmd = bytes((Sst25FlashDevice.CMD_PROGRAM_WORD,
-                             data.pop(0), data.pop(0)))
+        self._cmd.command_address(Sst25FlashDevice.CMD_PROGRAM_WORD, address,
+                                  data=view[0:2])
+        self._wait_for_completion(word_time)
+        pos = 2
+        while pos < length:
+            end = min(length, pos + 2*self.AAI_BATCH_WORDS)
+            with _BatchedWrites(self._spi, word_time[1]) as batch:
+                for pos in range(pos, end, 2):
+                    self._cmd.command_args(Sst25FlashDevice.CMD_PROGRAM_WORD,
+                                           view[pos], view[pos+1])
+                    if not batch.active:
+                        self._wait_for_completion(word_time)
+            self._wait_for_completion(word_time)
+            pos = end
         self._disable_write()
 
+    def start_program_page(self, address: int, data: bytes) -> None:
+        raise SerialFlashNotSupported("SST25 only supports AAI word programming")
+
     def _unprotect(self):
         """Disable default protection for all sectors"""
-        unprotect = bytes((Sst25FlashDevice.CMD_WRITE_STATUS_REGISTER, 0x00))
         self._enable_write()
-        self._spi.exchange(unprotect)
+        self._cmd.command_args(Sst25FlashDevice.CMD_WRITE_STATUS_REGISTER, 0x00)
         while self.is_busy():
             time.sleep(0.01)  # 10 ms
 
@@ -813,8 +994,7 @@ class S25FlFlashDevice(_Gen25FlashDevice):
     def can_erase(self, address: int, length: int):
         # we first need to check the current configuration register, as a
         # previous configuration may prevent from altering some of the bits
-        readcfg_cmd = bytes((S25FlFlashDevice.CMD_READ_CONFIG,))
-        config = self._spi.exchange(readcfg_cmd, 1)[0]
+        config = self._cmd.command(S25FlFlashDevice.CMD_READ_CONFIG, 1)[0]
         if config & S25FlFlashDevice.CR_TBPARM:
             # "parameter zone" is defined in the high sectors
             border = len(self)-2*self.get_size('sector')
@@ -904,7 +1084,8 @@ class W25xFlashDevice(_Gen25FlashDevice):
                'chip': (4, 11)}
     FEATURES = (SerialFlash.FEAT_SECTERASE |
                 SerialFlash.FEAT_SUBSECTERASE |
-                SerialFlash.FEAT_CHIPERASE)
+                SerialFlash.FEAT_CHIPERASE |
+                SerialFlash.FEAT_UNIQUEID)
 
     def __init__(self, spi, jedec):
         super(W25xFlashDevice, self).__init__(spi)
@@ -919,11 +1100,20 @@ class W25xFlashDevice(_Gen25FlashDevice):
             (self._device, len(self) >> 17,
              pretty_size(self._size, lim_m=1 << 20))
 
+    @property
+    def unique_id(self) -> int:
+        """Read the 64-bit factory unique ID of the device"""
+        # the dummy bytes stand in for an address
+        data = self._cmd.command_address(self.CMD_READ_UID, 0, self.UID_LEN,
+                                         dummy=self.READ_UID_WIDTH-3)
+        if len(data) != self.UID_LEN:
+            raise SerialFlashTimeout("Unable to retrieve unique ID")
+        return int.from_bytes(data, byteorder='big')
+
     def _erase_chip(self, command: int, times: Tuple[float, float]):
         """Erase an entire chip"""
         self._enable_write()
-        cmd = bytes((command,))
-        self._spi.exchange(cmd)
+        self._cmd.command(command)
         self._wait_for_completion(times)
 
 
@@ -971,8 +1161,7 @@ class Mx25lFlashDevice(_Gen25FlashDevice):
         else:
             unlock = self.CMD_GBULK
         self._enable_write()
-        wcmd = bytes((unlock,))
-        self._spi.exchange(wcmd)
+        self._cmd.command(unlock)
         self._wait_for_completion(self.get_timings('page'))
 
 
@@ -1046,8 +1235,7 @@ class At25FlashDevice(_Gen25FlashDevice):
     def _erase_chipDUPLICATE(self, command: int, times: Tuple[float, float]):
         """Erase an entire chip"""
         self._enable_write()
-        cmd = bytes((command,))
-        self._spi.exchange(cmd)
+        self._cmd.command(command)
         self._wait_for_completion(times)
 
     @classmethod
@@ -1067,8 +1255,7 @@ class At25FlashDevice(_Gen25FlashDevice):
 
     def _erase_chip(self, command, times):
         self._enable_write()
-        cmd = bytes((command,))
-        self._spi.exchange(cmd)
+        self._cmd.command(command)
         self._wait_for_completion(times)
         time.sleep(times[1])
 
@@ -1080,12 +1267,11 @@ class At25FlashDevice(_Gen25FlashDevice):
         end = (address+length) & sector_mask
         for addr in range(start, end, sector_size):
             self._enable_write()
-            wcmd = bytearray((command,
-                              (addr >> 16) & 0xff, (addr >> 8) & 0xff,
-                              addr & 0xff))
             if self.CMD_PROTECT_LOCK_WRITE == command:
-                wcmd.append(self.ASSERT_LOCK_PROTECT)
-            self._spi.exchange(wcmd)
+                self._cmd.command_address(command, addr,
+                                          extra=self.ASSERT_LOCK_PROTECT)
+            else:
+                self._cmd.command_address(command, addr)
             self._wait_for_completion(self.get_timings('page'))
 
 
@@ -1138,7 +1324,15 @@ class At45FlashDevice(_SpiFlashDevice):
                         (1.0, 2.0),
                         (1.0, 2.0),
                         (1.0, 2.0),
-                        (1.0, 2.0)]}
+                        (1.0, 2.0)],
+               # main memory page to buffer transfer or compare
+               'transfer': [(0.0002, 0.0004),
+                            (0.0002, 0.0004),
+                            (0.0002, 0.0004),
+                            (0.0002, 0.0004),
+                            (0.0002, 0.0004),
+                            (0.0002, 0.0004),
+                            (0.0002, 0.0004)]}
     FEATURES = SerialFlash.FEAT_SECTERASE | SerialFlash.FEAT_SUBSECTERASE
 
     DEVICE_ID = 0x01
@@ -1177,6 +1371,10 @@ class At45FlashDevice(_SpiFlashDevice):
     CMD_COMMIT_BUFFER2 = 0x89
     CMD_MAIN_THROUGH_BUFFER1 = 0x82
     CMD_MAIN_THROUGH_BUFFER2 = 0x85
+    CMD_MAIN_TO_BUFFER1 = 0x53
+    CMD_MAIN_TO_BUFFER2 = 0x55
+    CMD_COMPARE_BUFFER1 = 0x60
+    CMD_COMPARE_BUFFER2 = 0x61
     CMD_PROTECT_WRITE = 0x3D
     CMD_PROTECT_LOCK_READ = 0x35
     CMD_PROTECT_SOFT_READ = 0x32
@@ -1243,11 +1441,10 @@ class At45FlashDevice(_SpiFlashDevice):
         return True
 
     def unlock(self):
-        wcmd = bytes((self.CMD_PROTECT_WRITE,
-                      self.SECTOR_PROTECT_PREFIX_A,
-                      self.SECTOR_PROTECT_PREFIX_B,
-                      self.SECTOR_PROTECT_DISABLE))
-        self._spi.exchange(wcmd)
+        self._cmd.command_args(self.CMD_PROTECT_WRITE,
+                               self.SECTOR_PROTECT_PREFIX_A,
+                               self.SECTOR_PROTECT_PREFIX_B,
+                               self.SECTOR_PROTECT_DISABLE)
         duration = self.get_timings('lock')
         if any(duration):
             self._wait_for_completion(duration)
@@ -1258,9 +1455,7 @@ class At45FlashDevice(_SpiFlashDevice):
     def _erase_blocks(self, command, times, start, end, size):
         """Erase one or more blocks"""
         while start < end:
-            wcmd = bytes((command, (start >> 16) & 0xff,
-                          (start >> 8) & 0xff, start & 0xff))
-            self._spi.exchange(wcmd)
+            self._cmd.command_address(command, start)
             self._wait_for_completion(times)
             # very special case for first sector which is split in two
             # parts: 4KiB + 60KiB
@@ -1270,8 +1465,7 @@ class At45FlashDevice(_SpiFlashDevice):
             start += size
 
     def _read_status(self):
-        read_cmd = bytes((self.CMD_READ_STATUS,))
-        data = self._spi.exchange(read_cmd, 1)
+        data = self._cmd.command(self.CMD_READ_STATUS, 1)
         if len(data) != 1:
             raise SerialFlashTimeout("Unable to retrieve flash status")
         return data[0]
@@ -1282,35 +1476,55 @@ class At45FlashDevice(_SpiFlashDevice):
 
     def write(self, address: int,
               data: Union[bytes, bytearray, Iterable[int]]) -> None:
-        """Write a sequence of bytes, starting at the specified address."""
+        """Write a sequence of bytes, starting at the specified address.
+
+           Each page is loaded into one of the two SRAM buffers, in turn, so
+           that loading a page overlaps with the programming of the previous
+           one from the other buffer. Partial pages are first filled in
+           with the current main memory page. Pages the device reports as
+           already matching the buffer are not programmed at all."""
         length = len(data)
         if address+length > len(self):
             raise SerialFlashValueError('Cannot fit in flash area')
         if not isinstance(data, (bytes, bytearray)):
             data = bytes(data)
+        view = memoryview(data)
+        transfer_time = self.get_timings('transfer')
+        # poll for the end of page programming more finely than the page
+        # timings would, so as not to lose what loading the other buffer
+        # gained
+        page_time = (transfer_time[0], sum(self.get_timings('page')))
+        buffers = ((self.CMD_WRITE_BUFFER1, self.CMD_MAIN_TO_BUFFER1,
+                    self.CMD_COMPARE_BUFFER1, self.CMD_COMMIT_BUFFER1),
+                   (self.CMD_WRITE_BUFFER2, self.CMD_MAIN_TO_BUFFER2,
+                    self.CMD_COMPARE_BUFFER2, self.CMD_COMMIT_BUFFER2))
+        current = 0
         pos = 0
         page_size = self.get_size('page')
         while pos < length:
             boffset = (address+pos) & (page_size-1)
             poffset = (address+pos) & ~(page_size-1)
-            # first step: write data to the device RAM buffer
             count = min(length-pos, page_size-boffset)
-            buf = bytearray([0xFF]*boffset)
-            buf.extend(data[pos:pos+count])
-            pad = bytes([0xFF]*(page_size-count-boffset))
-            buf.extend(pad)
-            assert len(buf) == page_size
-            wcmd = bytearray((self.CMD_WRITE_BUFFER1, 0, 0, 0))
-            wcmd.extend(buf)
-            self._spi.exchange(wcmd)
-            self._wait_for_completion(self.get_timings('page'))
-            # second step: commit device buffer into flash cells
-            wcmd = bytes((self.CMD_COMMIT_BUFFER1,
-                          (poffset >> 16) & 0xff, (poffset >> 8) & 0xff,
-                          poffset & 0xff))
-            self._spi.exchange(wcmd)
-            self._wait_for_completion(self.get_timings('page'))
-            pos += page_size
+            write_cmd, load_cmd, compare_cmd, commit_cmd = buffers[current]
+            if count < page_size:
+                # read-modify-write: start from the current page contents,
+                # which needs main memory, so the previous page to be done
+                self._wait_for_completion(page_time)
+                self._cmd.command_address(load_cmd, poffset)
+                self._wait_for_completion(transfer_time)
+            # this buffer is free, even if the other one is still being
+            # programmed
+            self._cmd.command_address(write_cmd, boffset,
+                                      data=view[pos:pos+count])
+            self._wait_for_completion(page_time)
+            self._cmd.command_address(compare_cmd, poffset)
+            self._wait_for_completion(transfer_time)
+            if self._read_status() & self.SR_COMP:
+                self._cmd.command_address(commit_cmd, poffset)
+                # load the next page while this one is programmed
+                current ^= 1
+            pos += count
+        self._wait_for_completion(page_time)
 
     def _fix_page_size(self):
         """Fix AT45 page size to 512 bytes, rather than the default 528 bytes
@@ -1321,8 +1535,7 @@ class At45FlashDevice(_SpiFlashDevice):
         if status & self.SR_PAGE_SIZE_FLAG:
             # nothing to do, alreay using 2^N page size mode
             return
-        wcmd = bytes((0x3d, 0x2a, 0x80, 0xa6))
-        self._spi.exchange(wcmd)
+        self._cmd.command_args(0x3d, 0x2a, 0x80, 0xa6)
         raise IOError("Please power-cycle the device to enable "
                       "binary page size mode")
 
@@ -1360,10 +1573,6 @@ class N25QFlashDevice(_Gen25FlashDevice):
         self._enable_write()
         for sector in range(len(self) >> 16):
             addr = sector << 16
-            wcmd = bytes((self.CMD_WRLR,
-                          (addr >> 16) & 0xff,
-                          (addr >> 8) & 0xff,
-                          (addr >> 0) & 0xff,
-                          (0 << self.SECTOR_LOCK_DOWN) |
-                          (0 << self.SECTOR_WRITE_LOCK)))
-        self._spi.exchange(wcmd)
+        self._cmd.command_address(self.CMD_WRLR, addr,
+                                  extra=(0 << self.SECTOR_LOCK_DOWN) |
+                                        (0 << self.SECTOR_WRITE_LOCK))
@@ -0,0 +1,202 @@
+'''
+Hotplug flashing station.
+
+Watches the USB bus for FT2232 adapters and flashes the attached board
+as soon as one appears, with no keyboard step and no per-board URI.
+Unplug the board and plug in the next one.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import argparse
+import logging
+import time
+from typing import List, Set
+
+from pyftdi.usbtools import UsbTools
+
+from flash_util import VerifyRetriesDefault, SPIFrequencyDefault
+from image_source import ImageSource
+from parallel_flash import runConcurrentFlashJobs, reportFlashJobs
+from verify_tiers import VerifyPlanner, VerifyTiers, VerifyTierNone, VerifyConfidenceDefault
+from station_metrics import StationMetrics
+
+log = logging.getLogger(__name__)
+
+FT2232VendorProduct = (0x0403, 0x6010)
+StationChannelDefault = 2
+StationPollIntervalDefault = 0.5
+
+class FlashStation:
+    '''
+        Polls the USB bus, diffing the set of FT2232 serial numbers present,
+        and runs a flash job on each of the configured channels of every 
+        newly arrived adapter.
+    '''
+    def __init__(self, imagePath:str, channels:List[int]=None,
+                 startAddress:int=0, verify:bool=False,
+                 maxRetries:int=VerifyRetriesDefault, tagVersion:str=None,
+                 pollInterval:float=StationPollIntervalDefault,
+                 metrics:StationMetrics=None, metricsFile:str=None, probeBoot:bool=False,
+                 verifyTier:str=VerifyTierNone, verifySamples:int=None):
+        self.imagePath = imagePath
+        self.channels = channels or [StationChannelDefault]
+        self.startAddress = startAddress
+        self.verify = verify
+        self.maxRetries = maxRetries
+        self.tagVersion = tagVersion
+        self.pollInterval = pollInterval
+        self.metrics = metrics
+        self.metricsFile = metricsFile
+        self.probeBoot = probeBoot
+        self.verifyTier = verifyTier
+        self.verifySamples = verifySamples
+        self.numFlashed = 0
+        self.numFailed = 0
+        self._contents = None
+
+    @property
+    def contents(self) -> bytes:
+        if self._contents is None:
+            self._contents = ImageSource(self.imagePath).read()
+        return self._contents
+
+    @classmethod
+    def scan(cls) -> Set[str]:
+        '''
+            serial numbers of all FT2232 adapters currently on the bus
+        '''
+        serials = set()
+        for devDesc, _ifcount in UsbTools.find_all([FT2232VendorProduct], nocache=True):
+            if devDesc.sn:
+                serials.add(devDesc.sn)
+        return serials
+
+    def deviceURIs(self, serial:str) -> List[str]:
+        return [f'ftdi://ftdi:2232:{serial}/{channel}' for channel in self.channels]
+
+    def flashBoard(self, serial:str) -> bool:
+        '''
+            run a flash job on every configured channel of adapter serial,
+            concurrently, report the outcomes and release the adapter.
+            @return: True if all jobs succeeded
+        '''
+        results, wallTime = runConcurrentFlashJobs(self.deviceURIs(serial), self.contents,
+                                                   startAddress=self.startAddress,
+                                                   verify=self.verify,
+                                                   maxRetries=self.maxRetries,
+                                                   tagVersion=self.tagVersion,
+                                                   probeBoot=self.probeBoot,
+                                                   verifyTier=self.verifyTier,
+                                                   verifySamples=self.verifySamples)
+        for result in results:
+            if result.ok:
+                self.numFlashed += 1
+            else:
+                self.numFailed += 1
+            if self.metrics is not None:
+                self.metrics.recordJob(serial, result)
+        reportFlashJobs(results, wallTime)
+        self.saveMetrics()
+        return all(r.ok for r in results)
+
+    def saveMetrics(self):
+        if self.metrics is not None and self.metricsFile:
+            try:
+                self.metrics.writeTextfile(self.metricsFile)
+            except OSError as e:
+                log.warning(f'Could not write metrics to {self.metricsFile}: {e}')
+        
+    def run(self, maxBoards:int=None):
+        '''
+            flash boards as they are plugged in, until interrupted
+            or maxBoards jobs have run
+        '''
+        print(f'Station ready, waiting for boards (image {self.imagePath})')
+        if self.verifyTier != VerifyTierNone:
+            estimate = VerifyPlanner(SPIFrequencyDefault).estimate(self.verifyTier, len(self.contents),
+                                                                   self.verifySamples)
+            print(f'Verifying with {estimate}')
+        known = set()
+        while maxBoards is None or (self.numFlashed + self.numFailed) < maxBoards:
+            present = self.scan()
+            if self.metrics is not None and present != known:
+                self.metrics.adaptersPresent(present)
+                self.saveMetrics()
+            for serial in sorted(present - known):
+                print(f'[{serial}] attached, flashing')
+                self.flashBoard(serial)
+            # forget departed adapters, so plugging one back in re-flashes
+            known = present
+            time.sleep(self.pollInterval)
+
+
+def getArgParser():
+    parser = argparse.ArgumentParser(description='Flash boards automatically as they are plugged in')
+    parser.add_argument("--write", type=str, required=True,
+                    help="image file to write to every board")
+    parser.add_argument("--address", type=int, default=0,
+                        required=False,
+                    help="start address [0]")
+    parser.add_argument("--channels", type=str, default=str(StationChannelDefault),
+                        required=False,
+                    help=f"comma separated FT2232 channels with a board on them, flashed concurrently [{StationChannelDefault}]")
+    parser.add_argument("--inline-verify", action='store_true',
+                        required=False,
+                    help="read back each sector right after writing it, re-programming bad sectors")
+    parser.add_argument("--retries", type=int, default=VerifyRetriesDefault,
+                        required=False,
+                    help=f"number of retries for a sector failing inline verify [{VerifyRetriesDefault}]")
+    parser.add_argument("--tag", type=str, nargs='?', const='',
+                        required=False,
+                    help="tag the written image (with optional version string) and skip boards already tagged with it")
+    parser.add_argument("--boot-probe", action='store_true',
+                        required=False,
+                    help="time each board's firmware to ready after flashing, failing boards that do not boot")
+    parser.add_argument("--verify", type=str, choices=VerifyTiers, default=VerifyTierNone,
+                        required=False,
+                    help=f"check each written image: not at all, on random pages, with firmware CRCs or by reading it all back [{VerifyTierNone}]")
+    parser.add_argument("--verify-samples", type=int,
+                        required=False,
+                    help="pages compared by a sampled verify [enough for --verify-confidence]")
+    parser.add_argument("--verify-confidence", type=float, default=VerifyConfidenceDefault,
+                        required=False,
+                    help=f"unless --verify-samples is given, sample enough pages to catch a damaged sector with this probability (0-1) [{VerifyConfidenceDefault}]")
+    parser.add_argument("--poll", type=float, default=StationPollIntervalDefault,
+                        required=False,
+                    help=f"USB bus poll interval, in seconds [{StationPollIntervalDefault}]")
+    parser.add_argument("--metrics-file", type=str,
+                        required=False,
+                    help="keep Prometheus metrics in this file (for the node_exporter textfile collector)")
+    parser.add_argument("--metrics-port", type=int,
+                        required=False,
+                    help="serve Prometheus metrics over HTTP on this local port")
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.WARN)
+    args = getArgParser().parse_args()
+    channels = [int(ch) for ch in args.channels.split(',')]
+    metrics = None
+    if args.metrics_file or args.metrics_port:
+        metrics = StationMetrics()
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+    station = FlashStation(args.write, channels=channels, startAddress=args.address,
+                           verify=args.inline_verify, maxRetries=args.retries,
+                           tagVersion=args.tag, pollInterval=args.poll,
+                           metrics=metrics, metricsFile=args.metrics_file,
+                           probeBoot=args.boot_probe, verifyTier=args.verify,
+                           verifySamples=args.verify_samples)
+    if args.verify_samples is None:
+        station.verifySamples = VerifyPlanner.samplesFor(len(station.contents),
+                                                         args.verify_confidence)
+    try:
+        station.run()
+    except KeyboardInterrupt:
+        pass
+    print(f'\n{station.numFlashed} boards flashed, {station.numFailed} failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+'''
+Flashing station metrics.
+
+Collects durations, throughput, flash operation timings, busy polls,
+firmware boot-to-ready times, verify tiers and times, retries, failures (by exception type) and
+per-adapter health across flash jobs, and exposes them in the Prometheus
+text format, either as a file for the node_exporter textfile collector
+or on a local HTTP endpoint.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, List
+
+log = logging.getLogger(__name__)
+
+MetricsPrefix = 'ttflash'
+MetricsHostDefault = '127.0.0.1'
+FlashSecondsBuckets = (5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+ThroughputBuckets = (4096, 8192, 16384, 32768, 65536, 131072, 262144, 524288)
+EraseSectorBuckets = (0.01, 0.025, 0.05, 0.1, 0.2, 0.4, 0.8)
+ProgramSectorBuckets = (0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64)
+BootReadyBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+VerifySecondsBuckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# weight of the latest job in an adapter's smoothed throughput
+AdapterThroughputSmoothing = 0.2
+
+class Histogram:
+    def __init__(self, buckets:Iterable[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value:float, count:int=1):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += count
+                break
+        self.count += count
+        self.sum += value * count
+
+    def render(self, name:str, labels:str='') -> List[str]:
+        sep = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        labelStr = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{labelStr} {self.sum}')
+        lines.append(f'{name}_count{labelStr} {self.count}')
+        return lines
+
+
+class AdapterHealth:
+    def __init__(self):
+        self.present = False
+        self.lastSeen = 0.0
+        self.jobsOk = 0
+        self.jobsFailed = 0
+        self.consecutiveFailures = 0
+        self.bytesPerSecond = 0.0
+
+
+class StationMetrics:
+    '''
+        Thread safe: jobs on several channels may record at once.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.startTime = time.time()
+        self.jobs = {'ok': 0, 'uptodate': 0, 'failed': 0}
+        self.bytesTotal = 0
+        self.busyPolls = 0
+        self.verifyRetries = 0
+        self.failures = {}
+        self.flashSeconds = Histogram(FlashSecondsBuckets)
+        self.throughput = Histogram(ThroughputBuckets)
+        self.eraseSector = Histogram(EraseSectorBuckets)
+        self.programSector = Histogram(ProgramSectorBuckets)
+        self.bootReady = Histogram(BootReadyBuckets)
+        self.verifySeconds = Histogram(VerifySecondsBuckets)
+        # verifications run, by (tier, outcome)
+        self.verifies = {}
+        self.adapters = {}
+        self._server = None
+
+    def _adapter(self, name:str) -> AdapterHealth:
+        if name not in self.adapters:
+            self.adapters[name] = AdapterHealth()
+        return self.adapters[name]
+
+    def adaptersPresent(self, names:Iterable[str]):
+        '''
+            note which adapters are on the bus now
+        '''
+        now = time.time()
+        names = set(names)
+        with self._lock:
+            for name in names:
+                health = self._adapter(name)
+                health.present = True
+                health.lastSeen = now
+            for name, health in self.adapters.items():
+                if name not in names:
+                    health.present = False
+
+    def recordJob(self, adapter:str, result):
+        '''
+            account for a finished flash job
+            @param adapter: adapter (serial) the job ran on
+            @param result: its parallel_flash.FlashJobResult
+        '''
+        with self._lock:
+            health = self._adapter(adapter)
+            if not result.ok:
+                self.jobs['failed'] += 1
+                errorType = type(result.error).__name__
+                self.failures[errorType] = self.failures.get(errorType, 0) + 1
+                health.jobsFailed += 1
+                health.consecutiveFailures += 1
+            else:
+                self.jobs['uptodate' if result.upToDate else 'ok'] += 1
+                health.jobsOk += 1
+                health.consecutiveFailures = 0
+            self.flashSeconds.observe(result.elapsed)
+            self.bytesTotal += result.numBytes
+            if result.numBytes and result.ok:
+                rate = result.bytesPerSecond
+                self.throughput.observe(rate)
+                if health.bytesPerSecond:
+                    health.bytesPerSecond += AdapterThroughputSmoothing * (rate - health.bytesPerSecond)
+                else:
+                    health.bytesPerSecond = rate
+            self.busyPolls += result.busyPolls
+            stats = result.opStats
+            if stats is not None:
+                self.verifyRetries += stats.verifyRetries
+                for seconds, numSectors in stats.eraseTimes:
+                    self.eraseSector.observe(seconds / numSectors, numSectors)
+                for seconds in stats.programTimes:
+                    self.programSector.observe(seconds)
+                if stats.bootLatency is not None:
+                    self.bootReady.observe(stats.bootLatency)
+                if stats.verifyTier is not None:
+                    key = (stats.verifyTier, 'ok' if stats.verifyOk else 'mismatch')
+                    self.verifies[key] = self.verifies.get(key, 0) + 1
+                    self.verifySeconds.observe(stats.verifySeconds)
+
+    def render(self) -> str:
+        '''
+            all metrics, in the Prometheus text exposition format
+        '''
+        p = MetricsPrefix
+        with self._lock:
+            lines = [f'# TYPE {p}_uptime_seconds gauge',
+                     f'{p}_uptime_seconds {time.time() - self.startTime:.1f}',
+                     f'# TYPE {p}_jobs_total counter']
+            for outcome, count in self.jobs.items():
+                lines.append(f'{p}_jobs_total{{result="{outcome}"}} {count}')
+            lines.append(f'# TYPE {p}_failures_total counter')
+            for errorType, count in sorted(self.failures.items()):
+                lines.append(f'{p}_failures_total{{type="{errorType}"}} {count}')
+            lines.append(f'# TYPE {p}_verifies_total counter')
+            for (tier, outcome), count in sorted(self.verifies.items()):
+                lines.append(f'{p}_verifies_total{{tier="{tier}",result="{outcome}"}} {count}')
+            for name, value in (('bytes_total', self.bytesTotal),
+                                ('busy_polls_total', self.busyPolls),
+                                ('verify_retries_total', self.verifyRetries)):
+                lines.append(f'# TYPE {p}_{name} counter')
+                lines.append(f'{p}_{name} {value}')
+            for name, histo in (('flash_seconds', self.flashSeconds),
+                                ('flash_bytes_per_second', self.throughput),
+                                ('erase_sector_seconds', self.eraseSector),
+                                ('program_sector_seconds', self.programSector),
+                                ('boot_ready_seconds', self.bootReady),
+                                ('verify_seconds', self.verifySeconds)):
+                lines.append(f'# TYPE {p}_{name} histogram')
+                lines.extend(histo.render(f'{p}_{name}'))
+            adapterGauges = (('adapter_present', lambda h: int(h.present)),
+                             ('adapter_last_seen_timestamp', lambda h: f'{h.lastSeen:.0f}'),
+                             ('adapter_jobs_ok', lambda h: h.jobsOk),
+                             ('adapter_jobs_failed', lambda h: h.jobsFailed),
+                             ('adapter_consecutive_failures', lambda h: h.consecutiveFailures),
+                             ('adapter_bytes_per_second', lambda h: f'{h.bytesPerSecond:.0f}'))
+            for name, getter in adapterGauges:
+                lines.append(f'# TYPE {p}_{name} gauge')
+                for adapter, health in sorted(self.adapters.items()):
+                    lines.append(f'{p}_{name}{{adapter="{adapter}"}} {getter(health)}')
+        return '\n'.join(lines) + '\n'
+
+    def writeTextfile(self, filepath:str):
+        '''
+            write the metrics for the node_exporter textfile collector,
+            atomically so it never sees a partial file
+        '''
+        tmpPath = f'{filepath}.tmp'
+        with open(tmpPath, 'w') as f:
+            f.write(self.render())
+        os.replace(tmpPath, filepath)
+
+    def serve(self, port:int, host:str=MetricsHostDefault):
+        '''
+            serve the metrics over HTTP, from a background thread
+        '''
+        metrics = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        threading.Thread(target=self._server.serve_forever, name='metrics-http',
+                         daemon=True).start()
+        log.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
@@ -0,0 +1,82 @@
+'''
+Unit tests for write_manifest: sector coverage and range contents.
+
+Run from the flasher directory:
+    python3 -m unittest test_write_manifest
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import os
+import tempfile
+import unittest
+
+from write_manifest import WriteManifest
+
+SectorSize = 16
+
+class WriteManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def manifest(self, *images):
+        '''
+            @param images: (address, contents) pairs
+            @return: a WriteManifest for those images, written to temp files
+        '''
+        entries = []
+        for idx, (address, contents) in enumerate(images):
+            filepath = os.path.join(self.tmpdir.name, f'img{idx}.bin')
+            with open(filepath, 'wb') as f:
+                f.write(contents)
+            entries.append((filepath, address))
+        return WriteManifest(entries)
+
+    def test_aligned_images_have_no_partial_sectors(self):
+        m = self.manifest((0, b'a' * SectorSize), (SectorSize, b'b' * 2 * SectorSize))
+        self.assertEqual(m.partialSectors(SectorSize), [])
+
+    def test_unaligned_start_and_end(self):
+        m = self.manifest((4, b'a' * SectorSize))
+        self.assertEqual(m.erasePlan(SectorSize), [(0, 2 * SectorSize)])
+        self.assertEqual(m.partialSectors(SectorSize), [0, SectorSize])
+
+    def test_sector_shared_by_two_images(self):
+        # together the images fill the middle sector, only the outer ones are partial
+        m = self.manifest((8, b'a' * 16), (24, b'b' * 16))
+        self.assertEqual(m.erasePlan(SectorSize), [(0, 3 * SectorSize)])
+        self.assertEqual(m.partialSectors(SectorSize), [0, 2 * SectorSize])
+
+    def test_gap_within_shared_sector_is_partial(self):
+        m = self.manifest((0, b'a' * 4), (8, b'b' * 4))
+        self.assertEqual(m.partialSectors(SectorSize), [0])
+
+    def test_range_contents_blank_without_preserved(self):
+        m = self.manifest((4, b'abcd'))
+        contents = m.rangeContents(0, SectorSize)
+        self.assertEqual(bytes(contents), b'\xff' * 4 + b'abcd' + b'\xff' * 8)
+
+    def test_range_contents_keeps_preserved_around_images(self):
+        m = self.manifest((4, b'abcd'))
+        old = bytes(range(SectorSize))
+        contents = m.rangeContents(0, SectorSize, {0: old})
+        self.assertEqual(bytes(contents), old[:4] + b'abcd' + old[8:])
+
+    def test_range_contents_ignores_preserved_outside_range(self):
+        m = self.manifest((SectorSize + 4, b'abcd'))
+        contents = m.rangeContents(SectorSize, 2 * SectorSize,
+                                   {0: b'x' * SectorSize, 2 * SectorSize: b'y' * SectorSize})
+        self.assertEqual(bytes(contents), b'\xff' * 4 + b'abcd' + b'\xff' * 8)
+
+    def test_range_contents_spanning_preserved_sectors(self):
+        m = self.manifest((12, b'abcdefgh'))
+        preserved = {0: b'x' * SectorSize, SectorSize: b'y' * SectorSize}
+        self.assertEqual(sorted(preserved), m.partialSectors(SectorSize))
+        contents = m.rangeContents(0, 2 * SectorSize, preserved)
+        self.assertEqual(bytes(contents), b'x' * 12 + b'abcdefgh' + b'y' * 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+'''
+FTDI USB transport tuning.
+
+Small exchanges, like flash status polls, cost about one USB round trip
+each, which the FTDI latency timer largely decides.  Bulk transfers
+depend on the read and write chunk sizes pyftdi hands to the USB stack.
+TransportTuner benchmarks candidate settings on the attached adapter,
+keeping the latency timer and /CS hold giving the quickest small
+exchanges, then the chunk sizes giving the best bulk throughput.  Every
+candidate is checked by reading back a reference block of flash, so a
+setting the board does not cope with is never picked.
+
+Results are kept in a small JSON file, keyed by adapter serial and
+channel, and applied when the FlashUtil opens its port.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from pyftdi.spi import SpiController
+
+log = logging.getLogger(__name__)
+
+TransportProfileFileDefault = '.ftdi_transport.json'
+TuneLatencyCandidates = (1, 2, 4, 8, 16)
+TuneCSHoldCandidates = (1, 3, 6)
+TuneReadChunkCandidates = (4096, 8192, 16384)
+TuneWriteChunkCandidates = (4096, 8192, 16384, 32768)
+TuneSmallExchangesDefault = 200
+TuneBulkSizeDefault = 64*1024
+TuneReferenceSize = 256
+
+class TransportProfile:
+    '''
+        FTDI transport settings for one adapter channel, along with what
+        they measured when tuned
+    '''
+    def __init__(self, latency:int, readChunk:int, writeChunk:int, csHold:int,
+                 smallExchangeSeconds:float=None, readBytesPerSecond:float=None,
+                 writeBytesPerSecond:float=None, tuned:float=None):
+        self.latency = latency
+        self.readChunk = readChunk
+        self.writeChunk = writeChunk
+        self.csHold = csHold
+        self.smallExchangeSeconds = smallExchangeSeconds
+        self.readBytesPerSecond = readBytesPerSecond
+        self.writeBytesPerSecond = writeBytesPerSecond
+        self.tuned = tuned if tuned is not None else time.time()
+
+    @classmethod
+    def current(cls, ftdi, port):
+        '''
+            the settings the adapter is using right now
+        '''
+        return cls(ftdi.get_latency_timer(), ftdi.read_data_get_chunksize(),
+                   ftdi.write_data_get_chunksize(), port._cs_hold)
+
+    @classmethod
+    def fromDict(cls, spec:dict):
+        return cls(spec['latency'], spec['readChunk'], spec['writeChunk'], spec['csHold'],
+                   spec.get('smallExchangeSeconds'), spec.get('readBytesPerSecond'),
+                   spec.get('writeBytesPerSecond'), spec.get('tuned'))
+
+    def asDict(self) -> dict:
+        return {'latency': self.latency, 'readChunk': self.readChunk,
+                'writeChunk': self.writeChunk, 'csHold': self.csHold,
+                'smallExchangeSeconds': self.smallExchangeSeconds,
+                'readBytesPerSecond': self.readBytesPerSecond,
+                'writeBytesPerSecond': self.writeBytesPerSecond, 'tuned': self.tuned}
+
+    def apply(self, ftdi, port):
+        '''
+            configure the FTDI device and (raw) SPI port with these settings
+        '''
+        ftdi.set_latency_timer(self.latency)
+        ftdi.read_data_set_chunksize(self.readChunk)
+        ftdi.write_data_set_chunksize(self.writeChunk)
+        port.set_mode(port.mode, self.csHold)
+
+    def __str__(self):
+        desc = f'latency {self.latency}ms, /CS hold {self.csHold}, ' \
+               f'read chunk {self.readChunk}, write chunk {self.writeChunk}'
+        if self.smallExchangeSeconds is not None:
+            desc += f': {self.smallExchangeSeconds*1e6:.0f}us/exchange'
+        if self.readBytesPerSecond:
+            desc += f', read {self.readBytesPerSecond/1024:.0f} KiB/s'
+        if self.writeBytesPerSecond:
+            desc += f', write {self.writeBytesPerSecond/1024:.0f} KiB/s'
+        return desc
+
+
+class TransportProfileStore:
+    '''
+        tuned TransportProfiles, by adapter serial/channel
+    '''
+    def __init__(self, filepath:str=TransportProfileFileDefault):
+        self.filepath = filepath
+        self._profiles = {}
+        if os.path.exists(filepath):
+            try:
+                with open(filepath, 'r') as f:
+                    self._profiles = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning(f'Ignoring unreadable transport profiles {filepath}: {e}')
+
+    def get(self, adapter:str) -> Optional[TransportProfile]:
+        spec = self._profiles.get(adapter)
+        return TransportProfile.fromDict(spec) if spec is not None else None
+
+    def put(self, adapter:str, profile:TransportProfile):
+        self._profiles[adapter] = profile.asDict()
+        tmpPath = f'{self.filepath}.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(self._profiles, f, indent=1)
+        os.replace(tmpPath, self.filepath)
+
+
+class TransportTuner:
+    '''
+        benchmarks transport settings on the adapter a FlashUtil is
+        connected to.  Only reads the flash.
+    '''
+    def __init__(self, flashUtil, smallExchanges:int=TuneSmallExchangesDefault,
+                 bulkSize:int=TuneBulkSizeDefault):
+        self.flashUtil = flashUtil
+        self.smallExchanges = smallExchanges
+        self.bulkSize = bulkSize
+        self._reference = None
+
+    @property
+    def ftdi(self):
+        return self.flashUtil.spi_controller.ftdi
+
+    @property
+    def port(self):
+        return self.flashUtil.spi_port
+
+    @property
+    def flash(self):
+        # timing and checking reads have to reach the flash, not a read cache
+        flash = self.flashUtil.flash
+        return getattr(flash, 'uncached', flash)
+
+    def _checked(self) -> bool:
+        '''
+            whether the flash still reads back as it did with the original
+            settings
+        '''
+        try:
+            return self.flash.read(0, TuneReferenceSize) == self._reference
+        except Exception as e:
+            log.debug(f'Reference read failed: {e}')
+            return False
+
+    def _timeSmall(self) -> float:
+        flash = self.flash
+        start = time.perf_counter()
+        for _i in range(self.smallExchanges):
+            flash.is_busy()
+        return (time.perf_counter() - start) / self.smallExchanges
+
+    def _timeRead(self) -> float:
+        start = time.perf_counter()
+        self.flash.read(0, self.bulkSize)
+        return self.bulkSize / (time.perf_counter() - start)
+
+    def _timeWrite(self) -> float:
+        # status reads, padded out: the flash ignores what follows the
+        # command byte, so these clock bulk payloads out harmlessly.  
+        # Split up, as pyftdi refuses exchanges over PAYLOAD_MAX_LENGTH
+        flash = self.flash
+        port = self.flashUtil._flash_port
+        # room for the pass-through prefix ahead of the payload
+        maxPayload = SpiController.PAYLOAD_MAX_LENGTH - 1
+        start = time.perf_counter()
+        for offset in range(0, self.bulkSize, maxPayload):
+            size = min(maxPayload, self.bulkSize - offset)
+            port.exchange(bytes((flash.CMD_READ_STATUS,)) + bytes(size - 1), 1)
+        return self.bulkSize / (time.perf_counter() - start)
+
+    def tune(self) -> TransportProfile:
+        '''
+            find the best settings and leave the adapter configured with them
+            @return: the chosen TransportProfile
+        '''
+        ftdi = self.ftdi
+        port = self.port
+        original = TransportProfile.current(ftdi, port)
+        self._reference = self.flash.read(0, TuneReferenceSize)
+        best = None
+        try:
+            for latency in TuneLatencyCandidates:
+                for csHold in TuneCSHoldCandidates:
+                    candidate = TransportProfile(latency, original.readChunk,
+                                                 original.writeChunk, csHold)
+                    candidate.apply(ftdi, port)
+                    if not self._checked():
+                        log.info(f'Rejecting {candidate}: reference read mismatch')
+                        continue
+                    candidate.smallExchangeSeconds = self._timeSmall()
+                    log.debug(f'Tried {candidate}')
+                    if best is None or candidate.smallExchangeSeconds < best.smallExchangeSeconds:
+                        best = candidate
+            if best is None:
+                raise RuntimeError('No transport setting read the flash back correctly')
+
+            best.apply(ftdi, port)
+            best.readBytesPerSecond = 0
+            for readChunk in TuneReadChunkCandidates:
+                ftdi.read_data_set_chunksize(readChunk)
+                rate = self._timeRead()
+                if self._checked() and rate > best.readBytesPerSecond:
+                    best.readChunk, best.readBytesPerSecond = readChunk, rate
+            best.writeBytesPerSecond = 0
+            for writeChunk in TuneWriteChunkCandidates:
+                ftdi.write_data_set_chunksize(writeChunk)
+                rate = self._timeWrite()
+                if self._checked() and rate > best.writeBytesPerSecond:
+                    best.writeChunk, best.writeBytesPerSecond = writeChunk, rate
+        except BaseException:
+            original.apply(ftdi, port)
+            raise
+        best.tuned = time.time()
+        best.apply(ftdi, port)
+        return best
@@ -0,0 +1,159 @@
+'''
+Verification tiers.
+
+Checking a flashed image trades time against confidence:
+
+    none        nothing read back
+    sampled     randomly chosen pages (seeded, so a run can be reproduced)
+                compared over the pass-through
+    hash        a CRC32 per segment, worked out by the management core
+                firmware (see firmware_checksum), so only the answers cross
+                the wire
+    full        everything read back and compared
+
+VerifyPlanner estimates how long each tier takes on a given board, from
+the pass-through SPI clock or, when the adapter has been tuned, the
+measured transport rates, and how likely each is to catch a damaged
+sector.  The station picks a tier knowing both, and the run report
+records which was used.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import math
+from typing import List
+
+from firmware_checksum import FirmwareChecksum
+
+VerifyTierNone = 'none'
+VerifyTierSampled = 'sampled'
+VerifyTierHash = 'hash'
+VerifyTierFull = 'full'
+VerifyTiers = (VerifyTierNone, VerifyTierSampled, VerifyTierHash, VerifyTierFull)
+
+# sampled verifies compare enough pages to catch a damaged sector this often
+VerifyConfidenceDefault = 0.99
+VerifySegmentSizeDefault = 64*1024
+VerifyPageSize = 256
+# damage confidence is worked out for: one erase sector of pages gone wrong
+VerifyFaultPagesDefault = 16
+
+# untuned guesses, the transport profile's measurements are used when there is one
+ExchangeSecondsDefault = 0.002
+# pass-through prefix, read command and 24 bit address ahead of the data
+PassThroughReadOverhead = 5
+# exchanges around each firmware checksum request: reset, mailbox, acks, polls
+FirmwareCRCExchanges = 10
+
+class VerifyEstimate:
+    def __init__(self, tier:str, seconds:float, wireBytes:int, confidence:float,
+                 samples:int=None):
+        '''
+            @param seconds: expected time to verify
+            @param wireBytes: flash contents read over the pass-through
+            @param confidence: probability of catching a damaged sector
+        '''
+        self.tier = tier
+        self.seconds = seconds
+        self.wireBytes = wireBytes
+        self.confidence = confidence
+        self.samples = samples
+
+    def __str__(self):
+        desc = f'{self.tier:8s} ~{self.seconds:.2f}s, {self.wireBytes} bytes read'
+        if self.samples is not None:
+            desc += f' ({self.samples} pages)'
+        return f'{desc}, {100*self.confidence:.1f}% confidence'
+
+
+class VerifyPlanner:
+    def __init__(self, spiFrequency:float, transportProfile=None):
+        '''
+            @param spiFrequency: pass-through SPI clock, in Hz
+            @param transportProfile: (optional) the adapter's tuned TransportProfile
+        '''
+        self.spiFrequency = spiFrequency
+        self.transportProfile = transportProfile
+
+    @property
+    def readBytesPerSecond(self) -> float:
+        profile = self.transportProfile
+        if profile is not None and profile.readBytesPerSecond:
+            return profile.readBytesPerSecond
+        return self.spiFrequency / 8
+
+    @property
+    def exchangeSeconds(self) -> float:
+        profile = self.transportProfile
+        if profile is not None and profile.smallExchangeSeconds:
+            return profile.smallExchangeSeconds
+        return ExchangeSecondsDefault
+
+    def _readSeconds(self, numBytes:int, numReads:int) -> float:
+        return (numBytes + numReads * PassThroughReadOverhead) / self.readBytesPerSecond \
+                    + numReads * self.exchangeSeconds
+
+    @classmethod
+    def sampledConfidence(cls, numPages:int, samples:int,
+                          faultPages:int=VerifyFaultPagesDefault) -> float:
+        '''
+            probability that samples random pages out of numPages include
+            at least one of faultPages damaged ones
+        '''
+        faultPages = min(faultPages, numPages)
+        if samples >= numPages:
+            return 1.0 if faultPages else 0.0
+        miss = 1.0
+        for i in range(samples):
+            miss *= max(0, numPages - faultPages - i) / (numPages - i)
+        return 1.0 - miss
+
+    @classmethod
+    def samplesFor(cls, length:int, confidence:float, faultPages:int=VerifyFaultPagesDefault,
+                   pageSize:int=VerifyPageSize) -> int:
+        '''
+            number of pages to sample for a given confidence of catching
+            faultPages damaged pages in an image of length bytes
+        '''
+        numPages = max(1, math.ceil(length / pageSize))
+        faultPages = min(faultPages, numPages)
+        # the chance of missing, as pages are added to the sample
+        miss = 1.0
+        for samples in range(1, numPages):
+            miss *= (numPages - faultPages - samples + 1) / (numPages - samples + 1)
+            if 1.0 - miss >= confidence:
+                return samples
+        return numPages
+
+    def estimate(self, tier:str, length:int, samples:int=None,
+                 segmentSize:int=VerifySegmentSizeDefault,
+                 pageSize:int=VerifyPageSize) -> VerifyEstimate:
+        '''
+            what verifying length bytes with tier should cost
+            @param samples: (optional) pages sampled [enough for VerifyConfidenceDefault]
+        '''
+        if tier == VerifyTierNone or not length:
+            return VerifyEstimate(tier, 0.0, 0, 0.0 if length else 1.0)
+        if tier == VerifyTierSampled:
+            numPages = math.ceil(length / pageSize)
+            if samples is None:
+                samples = self.samplesFor(length, VerifyConfidenceDefault, pageSize=pageSize)
+            samples = min(samples, numPages)
+            return VerifyEstimate(tier, self._readSeconds(samples * pageSize, samples),
+                                  samples * pageSize,
+                                  self.sampledConfidence(numPages, samples), samples)
+        if tier == VerifyTierHash:
+            numSegments = math.ceil(length / segmentSize)
+            seconds = FirmwareChecksum.expectedSeconds(length) \
+                        + numSegments * FirmwareCRCExchanges * self.exchangeSeconds
+            # a CRC32 misses a random corruption once in 2^32
+            return VerifyEstimate(tier, seconds, 0, 1.0 - 2.0**-32)
+        if tier == VerifyTierFull:
+            return VerifyEstimate(tier, self._readSeconds(length, 1), length, 1.0)
+        raise ValueError(f'Unknown verify tier {tier}')
+
+    def estimates(self, length:int, samples:int=None,
+                  segmentSize:int=VerifySegmentSizeDefault) -> List[VerifyEstimate]:
+        '''
+            estimates for every tier, in VerifyTiers order
+        '''
+        return [self.estimate(tier, length, samples, segmentSize) for tier in VerifyTiers]
@@ -0,0 +1,120 @@
+'''
+Multi-image write manifests.
+
+A manifest lists images and the flash offsets they go to, e.g. firmware
+plus data blobs, so they can all be written in a single session with one
+merged erase plan.  Manifest files are JSON:
+
+    [
+        {"file": "tt3p5.bin", "address": 0},
+        {"file": "config.bin", "address": "0x100000"}
+    ]
+
+Relative file paths are taken relative to the manifest itself.  Images
+need not start or end on sector boundaries: whatever else was in the
+sectors they only partly cover is read back and written again.
+
+@copyright: Copyright (C) 2023 Pat Deegan, https://psychogenic.com
+'''
+import json
+import os
+from typing import Dict, List, Tuple
+
+from image_source import ImageSource
+
+class ManifestEntry:
+    def __init__(self, filepath:str, address:int, contents:bytes):
+        self.filepath = filepath
+        self.address = address
+        self.contents = contents
+
+    @property
+    def end(self) -> int:
+        return self.address + len(self.contents)
+
+    def __str__(self):
+        return f'{self.filepath} @ 0x{self.address:06x}-0x{self.end:06x}'
+
+
+class WriteManifest:
+    def __init__(self, entries:List[Tuple[str, int]]):
+        '''
+            @param entries: (filepath, address) pairs, in any order
+        '''
+        self.entries = []
+        for filepath, address in entries:
+            contents = ImageSource(filepath).read()
+            self.entries.append(ManifestEntry(filepath, address, contents))
+        self.entries.sort(key=lambda e: e.address)
+        self._checkOverlaps()
+
+    @classmethod
+    def load(cls, manifestPath:str):
+        with open(manifestPath, 'r') as f:
+            spec = json.load(f)
+        baseDir = os.path.dirname(os.path.abspath(manifestPath))
+        entries = []
+        for item in spec:
+            address = item.get('address', 0)
+            if isinstance(address, str):
+                address = int(address, 0)
+            entries.append((os.path.join(baseDir, item['file']), address))
+        return cls(entries)
+
+    def _checkOverlaps(self):
+        for prev, entry in zip(self.entries, self.entries[1:]):
+            if entry.address < prev.end:
+                raise ValueError(f'Manifest images overlap: {prev} and {entry}')
+
+    @property
+    def totalBytes(self) -> int:
+        return sum(len(e.contents) for e in self.entries)
+
+    def erasePlan(self, sectorSize:int) -> List[Tuple[int, int]]:
+        '''
+            sector aligned (start, end) ranges covering every image, with
+            adjacent and shared sectors coalesced, in address order
+        '''
+        plan = []
+        for entry in self.entries:
+            start = entry.address - (entry.address % sectorSize)
+            end = ((entry.end + sectorSize - 1) // sectorSize) * sectorSize
+            if plan and start <= plan[-1][1]:
+                plan[-1] = (plan[-1][0], max(end, plan[-1][1]))
+            else:
+                plan.append((start, end))
+        return plan
+
+    def partialSectors(self, sectorSize:int) -> List[int]:
+        '''
+            addresses of the sectors in the erase plan that the images do not
+            entirely cover, so their other contents must be preserved
+        '''
+        partial = []
+        for start, end in self.erasePlan(sectorSize):
+            for address in range(start, end, sectorSize):
+                covered = 0
+                for entry in self.entries:
+                    covered += max(0, min(entry.end, address + sectorSize) - max(entry.address, address))
+                if covered < sectorSize:
+                    partial.append(address)
+        return partial
+
+    def rangeContents(self, start:int, end:int, preserved:Dict[int, bytes]=None) -> bytearray:
+        '''
+            what flash should hold between start and end: the images that
+            fall in that range, and elsewhere the preserved contents of 
+            sectors (by address), or blank (0xFF)
+        '''
+        contents = bytearray(b'\xff' * (end - start))
+        for address, data in (preserved or {}).items():
+            if start <= address < end:
+                contents[address-start:address-start+len(data)] = data
+        for entry in self.entries:
+            if entry.end <= start or entry.address >= end:
+                continue
+            srcStart = max(start, entry.address)
+            srcEnd = min(end, entry.end)
+            contents[srcStart-start:srcEnd-start] = \
+                entry.contents[srcStart-entry.address:srcEnd-entry.address]
+        return contents
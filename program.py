@@ -2,7 +2,5 @@
 import os
 
 
-DeviceURI = 'ftdi://ftdi:2232:TG110925/2'
-while True:
-    input("Press enter to flash")
-    os.system(f"python3 flasher/flash_util.py  --uri {DeviceURI} --write binaries/v2.2.3.bin") 
+# flashes every board plugged in, no need to press enter or edit the URI
+os.system("python3 flasher/station.py --write binaries/v2.2.3.bin --tag v2.2.3")
@@ -20,6 +20,7 @@
 #include <hw/common.h>
 #include <uart.h>
 #include <uart_api.h>
+#include <mem.h>
 
 // there is some Caravel issue happening that prevents the usual SET and CLR from working
 // a fast read followed by write results in the whole register being cleared.
@@ -37,6 +38,29 @@ unsigned int temp;
 // define this to show the selected design number on the uio_out pins [31:24]
 //#define DEBUG_MUX
 
+// Flash checksum service, for flasher/firmware_checksum.py (flash_util.py --verify fast).
+// The host leaves a request in the PLL trim register, unused while the PLL is
+// bypassed, before releasing reset:
+//      [25:24] state, [23:12] first 4k sector, [11:0] sector count - 1
+// and the CRC32 of those sectors is handed back 16 bits at a time:
+//      [25:24] state, [23:16] CRC_MARKER, [15:0] CRC half
+// each half being acknowledged by the host setting the state to CRC_STATE_ACK.
+#define CRC_MAILBOX         reg_hkspi_pll_trim
+#define CRC_STATE(v)        (((v) >> 24) & 0x3)
+#define CRC_STATE_ACK       0
+#define CRC_STATE_REQUEST   1
+#define CRC_STATE_LOW       2
+#define CRC_STATE_HIGH      3
+#define CRC_MARKER          0xA5
+#define CRC_SECTOR_SIZE     4096
+// how long to wait for the host to pick up each half, in timer ticks (1s)
+#define CRC_ACK_TIMEOUT     10000000
+
+// Ready probe, for flasher/boot_probe.py: if the host armed it before
+// releasing reset, the same mailbox is set to READY_DONE once IO is set up.
+#define READY_ARMED         ((CRC_STATE_ACK << 24) | (0x5A << 16))
+#define READY_DONE          ((CRC_STATE_ACK << 24) | (0x5B << 16))
+
 void delay(const int d)
 {
     // Configure timer for a single-shot countdown */
@@ -52,6 +76,62 @@ void delay(const int d)
     }
 }
 
+// CRC32 (as zlib), a nibble at a time: the table is small enough for
+// the little RAM and cache there is
+static const uint32_t crc_nibble_table[16] = {
+    0x00000000, 0x1db71064, 0x3b6e20c8, 0x26d930ac, 0x76dc4190, 0x6b6b51f4, 0x4db26158, 0x5005713c,
+    0xedb88320, 0xf00f9344, 0xd6d6a3e8, 0xcb61b38c, 0x9b64c2b0, 0x86d3d2d4, 0xa00ae278, 0xbdbdf21c
+};
+
+uint32_t flash_crc32(uint32_t address, uint32_t length)
+{
+    const volatile uint32_t *word = (const volatile uint32_t *)(FLASH_BASE + address);
+    uint32_t crc = 0xffffffff;
+    // whole words from flash, least significant byte first
+    for (uint32_t count = length >> 2; count > 0; count--)
+    {
+        uint32_t data = *word++;
+        for (int i = 0; i < 4; i++)
+        {
+            crc ^= data & 0xff;
+            data >>= 8;
+            crc = (crc >> 4) ^ crc_nibble_table[crc & 0xf];
+            crc = (crc >> 4) ^ crc_nibble_table[crc & 0xf];
+        }
+    }
+    return ~crc;
+}
+
+int publish_crc_half(uint32_t state, uint32_t half)
+{
+    CRC_MAILBOX = (state << 24) | (CRC_MARKER << 16) | (half & 0xffff);
+
+    reg_timer0_config = 0;
+    reg_timer0_data = CRC_ACK_TIMEOUT;
+    reg_timer0_config = 1;
+    reg_timer0_update = 1;
+    while (reg_timer0_value > 0)
+    {
+        if (CRC_STATE(CRC_MAILBOX) == CRC_STATE_ACK)
+            return 1;
+        reg_timer0_update = 1;
+    }
+    return 0;
+}
+
+void flash_checksum_service()
+{
+    uint32_t request = CRC_MAILBOX;
+    if (CRC_STATE(request) != CRC_STATE_REQUEST)
+        return;
+
+    uint32_t first = (request >> 12) & 0xfff;
+    uint32_t count = (request & 0xfff) + 1;
+    uint32_t crc = flash_crc32(first * CRC_SECTOR_SIZE, count * CRC_SECTOR_SIZE);
+    if (publish_crc_half(CRC_STATE_LOW, crc))
+        publish_crc_half(CRC_STATE_HIGH, crc >> 16);
+}
+
 void configure_io()
 {
     // to fix issue on 2306
@@ -130,6 +210,9 @@ void configure_io()
 
 void main()
 {
+    int ready_probe = (CRC_MAILBOX == READY_ARMED);
+    flash_checksum_service();
+
     reg_gpio_mode1 = 1;
     reg_gpio_mode0 = 0;
     reg_gpio_ien = 1;
@@ -161,6 +244,9 @@ void main()
     reg_la0_iena = 0x0; // input enable on for LA bank 0
     #endif
 
+    if (ready_probe)
+        CRC_MAILBOX = READY_DONE;
+
 	while(1) {
         #ifdef DEBUG_MUX
         // check with the LA if the design is selected.